@@ -1,9 +1,6 @@
 import argparse
 from argparse import RawTextHelpFormatter
 import configparser
-import gzip
-import pandas as pd
-import shutil
 import subprocess
 import sys
 import os
@@ -52,70 +49,58 @@ species = comp2species[dsrc[0]]
 # Check for GTFs in /gtf
 # Human: gencode.v25.basic.annotation.gtf (hg38)
 # Mouse: gencode.vM15.basic.annotation.gtf (mm10)
+# The compressed download is read as is; an uncompressed GTF from an earlier run is still used
 if not os.path.exists('./gtf'):
     os.makedirs('./gtf')
 if species == 'human':
     gtf = './gtf/gencode.v25.basic.annotation.gtf'
+    if not os.path.exists(gtf):
+        gtf = gtf + '.gz'
     if not os.path.exists(gtf):
         print('Human GTF required, GENCODE v25 basic gene annotation not found')
-        print('Downloading \'gencode.v25.basic.annotation.gtf\' to /gtf ...')
+        print('Downloading \'gencode.v25.basic.annotation.gtf.gz\' to /gtf ...')
         url = 'ftp://ftp.ebi.ac.uk/pub/databases/gencode/Gencode_human/release_25/gencode.v25.basic.annotation.gtf.gz'
-        urllib.request.urlretrieve(url, gtf + '.gz')  
-        with gzip.open(gtf + '.gz', 'rb') as fi:
-            with open('./gtf/gencode.v25.basic.annotation.gtf', 'wb') as fo:
-                shutil.copyfileobj(fi, fo)
-        os.remove(gtf + '.gz')
+        urllib.request.urlretrieve(url, gtf)
     if not os.path.exists(gtf):
-        sys.exit('Unable to download \'gencode.v25.basic.annotation.gtf\' to /gtf')
+        sys.exit('Unable to download \'gencode.v25.basic.annotation.gtf.gz\' to /gtf')
 elif species == 'mouse':
     gtf = './gtf/gencode.vM15.basic.annotation.gtf'
+    if not os.path.exists(gtf):
+        gtf = gtf + '.gz'
     if not os.path.exists(gtf):
         print('Mouse GTF required, GENCODE vM15 basic gene annotation not found')
-        print('Downloading \'gencode.vM15.basic.annotation.gtf\' to /gtf ...')
+        print('Downloading \'gencode.vM15.basic.annotation.gtf.gz\' to /gtf ...')
         url = 'ftp://ftp.ebi.ac.uk/pub/databases/gencode/Gencode_mouse/release_M15/gencode.vM15.basic.annotation.gtf.gz'
-        urllib.request.urlretrieve(url, gtf + '.gz')
-        with gzip.open(gtf + '.gz', 'rb') as fi:
-            with open('./gtf/gencode.vM15.basic.annotation.gtf', 'wb') as fo:
-                shutil.copyfileobj(fi, fo)
-        os.remove(gtf + '.gz')
+        urllib.request.urlretrieve(url, gtf)
     if not os.path.exists(gtf):
-        sys.exit('Unable to download \'gencode.vM15.basic.annotation.gtf\' to /gtf')
+        sys.exit('Unable to download \'gencode.vM15.basic.annotation.gtf.gz\' to /gtf')
 else:
     sys.exit('Species must be \'human\' or \'mouse\'')
 
 # =======================================================================
 # Check for snaptron gene coverage file in /nauc
+# The compressed (BGZF) download is read as is; an uncompressed file from an earlier run is still used
 if not os.path.exists('./nauc'):
     os.makedirs('./nauc')
 gcli = []
 for snaptron_compilation in dsrc:
     nauc = './nauc/' + snaptron_compilation + '_gene_coverage_normalized.tsv'
     if not os.path.exists(nauc):
-        print('Snaptron gene coverage file not found in /nauc (' + snaptron_compilation + '_gene_coverage_normalized.tsv)')
-        print('Downloading \'' + snaptron_compilation + '_gene_coverage_normalized.tsv\' to /nauc ...')
+        nauc = nauc + '.bgz'
+    if not os.path.exists(nauc):
+        print('Snaptron gene coverage file not found in /nauc (' + snaptron_compilation + '_gene_coverage_normalized.tsv.bgz)')
+        print('Downloading \'' + snaptron_compilation + '_gene_coverage_normalized.tsv.bgz\' to /nauc ...')
         url = 'http://snaptron.cs.jhu.edu/data/' + snaptron_compilation + '/gene_coverage_normalized.tsv.bgz'
-        urllib.request.urlretrieve(url, nauc + '.bgz')
-        with gzip.open(nauc + '.bgz', 'rb') as fi:
-            with open(nauc, 'wb') as fo:
-                shutil.copyfileobj(fi, fo)
-        os.remove(nauc + '.bgz')
+        urllib.request.urlretrieve(url, nauc)
     if not os.path.exists(nauc):
-        sys.exit('Unable to download \'' + snaptron_compilation + '_gene_coverage_normalized.tsv\' to /gtf')
-    if len(dsrc) > 1:    
-        gcli.append(pd.read_csv(nauc, sep='\t', index_col=0, header=0))
+        sys.exit('Unable to download \'' + snaptron_compilation + '_gene_coverage_normalized.tsv.bgz\' to /nauc')
+    gcli.append(nauc)
 
 print('Processing gene coverage file(s)')
-if len(dsrc) > 1:
-    nauc = './nauc/' + cfg[config_linked]['snaptron_datasrc'] + '_gene_coverage_normalized.tsv'
-    if not os.path.exists(nauc):
-        df_gcli = pd.concat(gcli, axis=1)
-        df_gcli.index.name = 'gene_id'
-        df_gcli.to_csv(nauc, sep='\t')
-
 # =======================================================================
 subprocess.run('python3 ./bin/rsrNAUC.py' +
                ' --cfgall ' + all_samples +
                ' --cfglinked ' + config_linked +
-               ' --gc ' + nauc +
+               ' --gc ' + ','.join(gcli) +
                ' --gco ' + nauc_output +
                ' --gtf ' + gtf, shell=True)
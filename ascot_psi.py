@@ -1,7 +1,6 @@
 import argparse
 from argparse import RawTextHelpFormatter
 import configparser
-import gzip
 import shutil
 import subprocess
 import sys
@@ -37,6 +36,24 @@ parser.add_argument('--f', action='store',
                     type=float,
                     default=0.8,
                     help='PSI fraction cutoff')
+parser.add_argument('--j', action='store',
+                    default=None,
+                    help='Local Snaptron junction file(s) to query instead of the Snaptron server,\n'
+                         'e.g. ./junctions/{datasrc}_junctions.bgz')
+parser.add_argument('--q', action='store',
+                    type=int,
+                    default=4,
+                    help='Snaptron bulk queries kept in flight')
+parser.add_argument('--cache', action='store',
+                    default='./cache/snaptron_responses.sqlite',
+                    help='Snaptron response cache reused across runs, \'\' to disable')
+parser.add_argument('--cachesize', action='store',
+                    type=int,
+                    default=2048,
+                    help='Maximum Snaptron cache size in MB')
+parser.add_argument('--resume', action='store',
+                    default=None,
+                    help='Output directory (tempdir_*) of an interrupted run to continue')
 parser.add_argument('--deletefirstoutput', action='store',
                     type=int,
                     default=1,
@@ -54,8 +71,6 @@ all_samples = args.a.upper()
 config_linked = args.c.upper()
 psi_output = args.o
 processes = args.p
-if not os.path.isfile('./software/snaptron/qs'):
-    sys.exit('Snaptron not installed:\n  cd ./software/snaptron\n  make')
 comp2species = {
     'supermouse':'mouse',
     'ct_m_s':'mouse',
@@ -76,53 +91,61 @@ species = comp2species[dsrc[0]]
 
 # =======================================================================
 # Check for GENCODE gtfs (v25/vM15)
+# The compressed download is read as is; an uncompressed GTF from an earlier run is still used
 if not os.path.exists('./gtf'):
     os.makedirs('./gtf')
 if species == 'human':
     gtf = './gtf/gencode.v25.basic.annotation.gtf'
+    if not os.path.exists(gtf):
+        gtf = gtf + '.gz'
     if not os.path.exists(gtf):
         print('Human GTF required, GENCODE v25 basic gene annotation not found')
-        print('Downloading \'gencode.v25.basic.annotation.gtf\' to /gtf ...')
+        print('Downloading \'gencode.v25.basic.annotation.gtf.gz\' to /gtf ...')
         url = 'ftp://ftp.ebi.ac.uk/pub/databases/gencode/Gencode_human/release_25/gencode.v25.basic.annotation.gtf.gz'
-        urllib.request.urlretrieve(url, gtf + '.gz')  
-        with gzip.open(gtf + '.gz', 'rb') as fi:
-            with open('./gtf/gencode.v25.basic.annotation.gtf', 'wb') as fo:
-                shutil.copyfileobj(fi, fo)
-        os.remove(gtf + '.gz')
+        urllib.request.urlretrieve(url, gtf)
     if not os.path.exists(gtf):
-        sys.exit('Unable to download \'gencode.v25.basic.annotation.gtf\' to /gtf')
+        sys.exit('Unable to download \'gencode.v25.basic.annotation.gtf.gz\' to /gtf')
 elif species == 'mouse':
     gtf = './gtf/gencode.vM15.basic.annotation.gtf'
+    if not os.path.exists(gtf):
+        gtf = gtf + '.gz'
     if not os.path.exists(gtf):
         print('Mouse GTF required, GENCODE vM15 basic gene annotation not found')
-        print('Downloading \'gencode.vM15.basic.annotation.gtf\' to /gtf ...')
+        print('Downloading \'gencode.vM15.basic.annotation.gtf.gz\' to /gtf ...')
         url = 'ftp://ftp.ebi.ac.uk/pub/databases/gencode/Gencode_mouse/release_M15/gencode.vM15.basic.annotation.gtf.gz'
-        urllib.request.urlretrieve(url, gtf + '.gz')  
-        with gzip.open(gtf + '.gz', 'rb') as fi:
-            with open('./gtf/gencode.vM15.basic.annotation.gtf', 'wb') as fo:
-                shutil.copyfileobj(fi, fo)
-        os.remove(gtf + '.gz')
+        urllib.request.urlretrieve(url, gtf)
     if not os.path.exists(gtf):
-        sys.exit('Unable to download \'gencode.vM15.basic.annotation.gtf\' to /gtf')
+        sys.exit('Unable to download \'gencode.vM15.basic.annotation.gtf.gz\' to /gtf')
 else:
     sys.exit('Species must be \'human\' or \'mouse\'')
 
 # =======================================================================
+snaptron = ''
+if args.j is not None:
+    snaptron = ' --junctions \'' + args.j + '\''
+elif args.cache != '':
+    snaptron = ' --cache \'' + args.cache + '\' --cachesize ' + str(args.cachesize)
+if args.resume is not None:
+    snaptron = snaptron + ' --resume \'' + args.resume + '\''
 subprocess.run('python3 ./bin/rsrMain.py' +
                ' --exons ' + exon_list +
                ' --p ' + str(processes) +
                ' --deldir ' + str(args.deleteoutputdir) +
                ' --gtf ' + gtf +
                ' --cfg ' + all_samples +
-               ' --out ' + './unlinked_output.tsv', shell=True)
+               ' --out ' + './unlinked_output.tsv' +
+               ' --store ' + './unlinked_output_store' +
+               ' --q ' + str(args.q) +
+               snaptron, shell=True)
 subprocess.run('python3 ./bin/rsrMerge.py' +
                ' --cfgall ' + all_samples +
                ' --cfglinked ' + config_linked +
                ' --i ' + './unlinked_output.tsv' +
+               ' --store ' + './unlinked_output_store' +
                ' --o ' + psi_output +
                ' --min ' + str(args.min) + 
                ' --f ' + str(args.f), shell=True)
 
 if args.deletefirstoutput == 1:
     os.remove('./unlinked_output.tsv')
-os.rmdir('../snaptron_tmp')
+    shutil.rmtree('./unlinked_output_store')
@@ -0,0 +1,295 @@
+import argparse
+from argparse import RawTextHelpFormatter
+import filecmp
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+pd.options.mode.chained_assignment = None
+import warnings
+warnings.simplefilter(action='ignore', category=FutureWarning)
+from rsrFunctions import classifyExons, dropExons, firstRunDrops, secondRunDrops, writeNewInput
+
+
+parser = argparse.ArgumentParser(formatter_class=RawTextHelpFormatter, description="""
+==================================================================
+ Benchmark the exon drop rules between classification runs:
+ list-based pruning (before the drop lists became sets) against
+ firstRunDrops/secondRunDrops and writeNewInput of rsrFunctions
+==================================================================
+""")
+parser.add_argument('--sizes', action='store',
+                    default='12500,25000,50000,100000',
+                    help='Comma-separated numbers of exons of the synthetic chromosomes')
+parser.add_argument('--oldmax', action='store',
+                    type=int,
+                    default=100000,
+                    help='Largest chromosome the list-based pruning is timed on')
+parser.add_argument('--seed', action='store',
+                    type=int,
+                    default=1,
+                    help='Random seed of the synthetic chromosomes')
+parser.add_argument('--spacing', action='store',
+                    default='1000,4000',
+                    help='Smallest and largest distance between the loci of the synthetic chromosomes;\n'
+                         '  the default packs them densely, the exon lists in ./exons have about\n'
+                         '  one exon per 17-54 kb on chr1 (e.g. 10000,60000)')
+
+
+class PSIText(dict):
+    """ Exon ID -> PSI string, with the lookup() of rsrStore.PSIStrings """
+    def lookup(self, exon_ids):
+        return [self[x] for x in exon_ids]
+
+
+def syntheticChromosome(n, seed, spacing=(1000, 4000)):
+    """
+    y_input_v1.csv lines of a chromosome of about n exons, with the exon
+    dictionaries and PSI tables classifyExons needs.  Loci of alternative
+    splice sites, cassette exons, linked and mutually exclusive exon pairs
+    and lone exons are spaced along the chromosome, so the drop rules have
+    merged, filtered, LINKED and unclassified exons to prune.  Loci are
+    spacing[0] to spacing[1] bases apart.
+    """
+    r = random.Random(seed)
+    lines = []
+    exid2loc, exid2strand, PSImax, PSImin = {}, {}, [], []
+    LPSI, RPSI = PSIText(), PSIText()
+
+    def psi():
+        return r.choice([100.0, 100.0, 0.0, -1.0, 10.0, 25.0, 30.0, round(r.uniform(0, 100), 3)])
+
+    def junctions(start, end):
+        # 1st/2nd/3rd exclusion junction (start, end, percentage); 999 marks a side without one
+        js = [start, end, r.choice([999, 100, 67, 50, 33])]
+        for x in range(2):
+            if r.random() < 0.3:
+                s = start + r.randint(-50, 50)
+                js = js + [s, s + r.randint(10, 200), r.randint(1, 50)]
+            else:
+                js = js + [-1, -1, -1]
+        return js
+
+    def addExon(start, end, strand, left, right):
+        exonID = 'ExB-' + str(len(lines) + 1).zfill(7)
+        exid2loc[exonID] = 'chrB:' + str(start) + '-' + str(end)
+        exid2strand[exonID] = strand
+        high = sorted([psi() for x in range(5)], reverse=True) + sorted([psi() for x in range(5)], reverse=True)
+        if r.random() < 0.3:
+            high = [100.0] * 10
+        PSImax.append(high)
+        PSImin.append([min(x, r.choice([x, 90.0, psi()])) for x in high])
+        LPSI[exonID] = ','.join(str(psi()) for x in range(4))
+        RPSI[exonID] = ','.join(str(psi()) for x in range(4))
+        lines.append(','.join([exonID] + [str(x) for x in left + right]) + ',\n')
+
+    locus = 1000
+    while len(lines) < n:
+        locus = locus + r.randint(spacing[0], spacing[1])
+        strand = r.choice('+-')
+        kind = r.random()
+        if kind < 0.3:
+            # Alternative splice sites: exons sharing both exclusion junctions, skipping
+            # the whole locus for half of them, which makes their records cassettes
+            end = locus + r.randint(100, 300)
+            start = end - r.randint(30, 150)
+            skip = junctions(locus, locus + 600) if r.random() < 0.5 else None
+            for x in range(r.randint(2, 5)):
+                s, e = (start + x * r.randint(1, 10), end) if r.random() < 0.5 else (start, end + x * r.randint(1, 10))
+                if skip is None:
+                    addExon(s, e, strand, junctions(locus, s - 1), junctions(e + 1, locus + 600))
+                else:
+                    addExon(s, e, strand, list(skip), list(skip))
+        elif kind < 0.45:
+            # Cassette exon: the left and the right exclusion junction are the same
+            s = locus + r.randint(20, 100)
+            skip = junctions(locus, s + 400)
+            addExon(s, s + r.randint(30, 150), strand, skip, list(skip))
+        elif kind < 0.65:
+            # Linked exons: the left exon's 1st left exclusion junction is the right exon's
+            # 1st right one; an exon at the location of the pair is dropped after run 2
+            s1 = locus + r.randint(20, 100)
+            e1 = s1 + r.randint(30, 100)
+            s2 = e1 + r.randint(20, 150)
+            e2 = s2 + r.randint(30, 100)
+            link = [e1 - r.randint(0, 10), s2 + r.randint(0, 10), r.choice([100, 80, 50])] + [-1] * 6
+            addExon(s1, e1, strand, link, junctions(link[0] - r.choice([0, 1, 5]), e2 + r.randint(0, 500)))
+            addExon(s2, e2, strand, junctions(s1 - r.randint(0, 900), link[0] - 3), list(link))
+            if r.random() < 0.3:
+                addExon(s1, e2, strand, junctions(s1 - 500, s1 - 1), junctions(e2 + 1, e2 + 500))
+        elif kind < 0.85:
+            # Mutually exclusive exons: each one's exclusion junctions end at the other
+            s1 = locus + r.randint(20, 100)
+            e1 = s1 + r.randint(30, 100)
+            s2 = e1 + r.randint(10, 150)
+            e2 = s2 + r.randint(30, 100)
+            addExon(s1, e1, strand, junctions(locus, s2 - 1), junctions(e2 + 1, e2 + 500))
+            addExon(s2, e2, strand, junctions(locus, s1 - 1), junctions(e1 + 1, e2 + 500))
+        else:
+            s = locus + r.randint(20, 500)
+            e = s + r.randint(30, 200)
+            addExon(s, e, strand, junctions(s - r.randint(100, 900), s - 1), junctions(e + 1, e + r.randint(100, 900)))
+    r.shuffle(lines)
+
+    exonIDs = list(exid2loc)
+    PSImax = pd.DataFrame(PSImax, index=exonIDs,
+                          columns=[side + 'PSImax' + str(x) for side in 'LR' for x in range(1, 6)])
+    PSImin = pd.DataFrame(PSImin, index=exonIDs,
+                          columns=[side + 'PSImin' + str(x) for side in 'LR' for x in range(1, 6)])
+    return lines, exid2loc, exid2strand, PSImax, PSImin, LPSI, RPSI
+
+
+# =========================================================================================
+# List-based pruning, as worker1 ran it before the drop lists became sets: every
+# 'x in dropList', dropList.remove(x) and 'x not in LINKEDmatch' scans a list
+def oldFirstRunDrops(frames):
+    dropList = []
+    df_main = frames['df2_LASSRASS']
+    for ix in range(len(df_main.index)):
+        if df_main['MergedCount'][ix] >= 2:
+            dropList.append(df_main['ExonID'][ix])
+        elif df_main['ExonClass'][ix].split(':')[0] == 'Filtered':
+            dropList.append(df_main['ExonID'][ix])
+    df_main = frames['df6_REFINE']
+    for ix in range(len(df_main.index)):
+        LASSinfo = df_main['MetadataLASS'][ix].split(',')
+        RASSinfo = df_main['MetadataRASS'][ix].split(',')
+        LINKEDinfo = df_main['MetadataLINKED'][ix].split(',')
+        if df_main['Cassette'][ix] == 'Yes' or df_main['MetadataMUTEX'][ix] != 'None':
+            if len(LASSinfo) > 1:
+                for x in LASSinfo:
+                    if x in dropList:
+                        dropList.remove(x)
+            if len(RASSinfo) > 1:
+                for x in RASSinfo:
+                    if x in dropList:
+                        dropList.remove(x)
+        if df_main['MetadataLINKED'][ix] != 'None':
+            if len(LINKEDinfo) == 0:
+                if df_main['ExonID'][ix] in dropList:
+                    dropList.remove(df_main['ExonID'][ix])
+    return dropList
+
+
+def oldSecondRunDrops(frames):
+    df_main = frames['df6_REFINE'].copy()
+    df_main['Temp'] = ':'
+    df_main['ExonLocation'] = df_main['ExonChr'].map(str) + df_main['Temp'] + \
+                              df_main['ExonStart'].astype(str) + df_main['Temp'] + \
+                              df_main['ExonEnd'].astype(str) + df_main['Temp'] + \
+                              df_main['ExonStrand'].astype(str)
+    df_main = df_main.drop('Temp', axis=1)
+
+    dropList = []
+    LINKEDmatch = []
+    for ix in range(len(df_main.index)):
+        if df_main['ExonClass'][ix] == 'LINKED':
+            if df_main['ExonLocation'][ix] not in LINKEDmatch:
+                LINKEDmatch.append(df_main['ExonLocation'][ix])
+    for ix in range(len(df_main.index)):
+        if df_main['ExonClass'][ix] != 'LINKED':
+            if df_main['ExonLocation'][ix] in LINKEDmatch:
+                dropList.append(df_main['ExonID'][ix])
+        if df_main['ExonClass'][ix] == 'Unclassified':
+            if df_main['Cassette'][ix] == 'No':
+                if df_main['MetadataLASS'][ix] == 'None':
+                    if df_main['MetadataRASS'][ix] == 'None':
+                        if df_main['MetadataLINKED'][ix] == 'None':
+                            if df_main['MetadataMUTEX'][ix] == 'None':
+                                dropList.append(df_main['ExonID'][ix])
+        if df_main['Cassette'][ix] == 'Yes':
+            if df_main['LPSImax1'][ix] <= 10:
+                dropList.append(df_main['ExonID'][ix])
+            elif df_main['RPSImax1'][ix] <= 10:
+                dropList.append(df_main['ExonID'][ix])
+    return dropList
+
+
+def oldWriteNewInput(wd, ic, dl):
+    prevFilename = wd + '/y_input_v' + str(ic) + '.csv'
+    newFilename = wd + '/y_input_v' + str(ic + 1) + '.csv'
+    nf = open(newFilename, 'w')
+    with open(prevFilename, 'r') as f:
+        for line in f:
+            sp = line.split(',')
+            if sp[0] not in dl:
+                nf.write(line)
+    nf.close()
+
+
+def timed(fn, *args):
+    currentTime = time.time()
+    result = fn(*args)
+    return result, time.time() - currentTime
+
+
+def benchmark(n, seed, timeOld, spacing):
+    """ Seconds of each pruning step of the old and the new version on a chromosome of n exons """
+    lines, exid2loc, exid2strand, PSImax, PSImin, LPSI, RPSI = syntheticChromosome(n, seed, spacing)
+    wd = tempfile.mkdtemp(prefix='benchPrune_')
+    try:
+        with open(wd + '/y_input_v1.csv', 'w') as f:
+            f.writelines(lines)
+        frames1, classifyTime = timed(classifyExons, 'y_input_v1.csv', 6, wd, exid2loc, exid2strand,
+                                      PSImax, PSImin, LPSI, RPSI)
+        drop1, prune1 = timed(firstRunDrops, frames1)
+        exons = dropExons(frames1['exons'], drop1)
+        frames2 = classifyExons('y_input_v1.csv', 6, wd, exid2loc, exid2strand, PSImax, PSImin, LPSI, RPSI,
+                                False, exons)
+        drop2, prune2 = timed(secondRunDrops, frames2)
+        x, write = timed(writeNewInput, wd, 1, drop1)
+        os.rename(wd + '/y_input_v2.csv', wd + '/y_input_new.csv')
+        result = {'exons': len(lines), 'classify': classifyTime, 'drops': len(drop1) + len(drop2),
+                  'new': [prune1, prune2, write], 'old': None, 'mismatches': []}
+        if timeOld:
+            oldDrop1, oldPrune1 = timed(oldFirstRunDrops, frames1)
+            oldDrop2, oldPrune2 = timed(oldSecondRunDrops, frames2)
+            x, oldWrite = timed(oldWriteNewInput, wd, 1, oldDrop1)
+            result['old'] = [oldPrune1, oldPrune2, oldWrite]
+            # Both versions must prune the same exons
+            if set(oldDrop1) != drop1:
+                result['mismatches'].append('rule 1 drop lists')
+            if set(oldDrop2) != drop2:
+                result['mismatches'].append('rule 2 drop lists')
+            if not filecmp.cmp(wd + '/y_input_v2.csv', wd + '/y_input_new.csv', shallow=False):
+                result['mismatches'].append('y_input_v2.csv')
+        return result
+    finally:
+        shutil.rmtree(wd)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    sizes = [int(x) for x in args.sizes.split(',')]
+    spacing = [int(x) for x in args.spacing.split(',')]
+    print('Exons, drops, classify (sec), then rule 1 / rule 2 / writeNewInput (sec) and their total')
+    results = []
+    for n in sizes:
+        result = benchmark(n, args.seed, n <= args.oldmax, spacing)
+        results.append(result)
+        line = str(result['exons']).rjust(8) + str(result['drops']).rjust(8) + \
+            str(round(result['classify'], 2)).rjust(9)
+        for version in ['new', 'old']:
+            if result[version] is None:
+                line = line + '   ' + version + ': skipped'
+            else:
+                line = line + '   ' + version + ': ' + ' / '.join(str(round(x, 3)) for x in result[version]) + \
+                    ' = ' + str(round(sum(result[version]), 3))
+        print(line, flush=True)
+        if len(result['mismatches']) > 0:
+            sys.exit('Error: old and new pruning differ in ' + ', '.join(result['mismatches']) +
+                     ' at ' + str(result['exons']) + ' exons')
+
+    # Doubling the exons doubles the time of linear pruning and quadruples quadratic pruning;
+    # between two sizes, time grows as exons^x with x = log(time ratio) / log(size ratio)
+    for version in ['new', 'old']:
+        timedResults = [x for x in results if x[version] is not None]
+        exponents = [np.log(sum(b[version]) / sum(a[version])) / np.log(float(b['exons']) / a['exons'])
+                     for a, b in zip(timedResults[:-1], timedResults[1:])]
+        if len(exponents) > 0:
+            print(version + ' pruning grows as exons^x, x = ' + ', '.join(str(round(x, 2)) for x in exponents) +
+                  ' from one size to the next')
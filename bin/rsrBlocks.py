@@ -0,0 +1,300 @@
+"""
+Classification of a chromosome in genomic blocks that run in parallel.
+
+The footprint of an exon spans the exon and the coordinates of all its
+exclusion junctions.  Exons with overlapping footprints are chained into
+segments: LASS/RASS/LINKED/MUTEX records only join exons that share a
+coordinate, so no record crosses a segment, and no sort key of
+classifyExons ties between exons of different segments.  Segments are packed
+in genomic order into blocks of about block_size exons, and the blocks of
+all chromosomes are classified by one process pool, largest first, instead
+of one process per chromosome.
+
+Each block is classified with the properties of the whole chromosome its
+steps depend on (the context argument of classifyExons).  ChromosomeBlocks
+runs the three classification runs of a chromosome, with the exons dropped
+between them, as rounds of blocks and puts the blocks back together into the
+df6_REFINE.csv and df_constitutive.csv whole-chromosome classification
+writes: records are renumbered over the chromosome in key order, df6 rows
+are put in the order of step 4 and constitutive exons in input order.
+"""
+import os
+import re
+import time
+
+import numpy as np
+import pandas as pd
+
+from rsrFunctions import (LASS_KEY, RASS_KEY, dropExons, joinColumns, readExonInput, restoreTypes,
+                          writeNewInput, writeTimestamp)
+
+# Coordinates an exon shares with the exons it can form a record with
+FOOTPRINT_COLUMNS = ['ExonStart', 'ExonEnd', '1_ELS', '1_ELE', '2_ELS', '2_ELE', '3_ELS', '3_ELE',
+                     '1_ERS', '1_ERE', '2_ERS', '2_ERE', '3_ERS', '3_ERE']
+
+# Record IDs given by classifyExons in a block directory (blockNNNNNN)
+BLOCK_RECORD = re.compile(r'(?:LASS|RASS|LINKED|MUTEX)_block\d+\.\d{7}')
+
+
+def exon_segments(df):
+    """
+    Segment of every exon of df (readExonInput), numbered in genomic order.  A
+    segment starts at the first exon whose footprint starts after the end of
+    all footprints before it; -1 marks a missing junction.
+    """
+    coords = np.column_stack([df[x].values.astype(np.int64) for x in FOOTPRINT_COLUMNS])
+    lo = np.where(coords == -1, np.iinfo(np.int64).max, coords).min(axis=1)
+    hi = coords.max(axis=1)
+    order = np.argsort(lo, kind='mergesort')
+    new_segment = np.ones(len(order), dtype=bool)
+    new_segment[1:] = lo[order][1:] > np.maximum.accumulate(hi[order])[:-1]
+    segments = np.empty(len(order), dtype=np.int64)
+    segments[order] = np.cumsum(new_segment) - 1
+    return segments
+
+
+def has_lass_records(df):
+    """
+    Whether step 1 makes LASS records of df (LASS key and LPSImax1 of every
+    exon): a key group is recorded when at least two of its exons reach the
+    merge threshold, except the group of the last key (see mergeSpliceSites).
+    A group whose first exon is below the threshold has no exon that reaches it.
+    """
+    with np.errstate(invalid='ignore'):
+        passed = df['LPSImax1'].values.astype(float) >= 25
+    counts = df['LASS'][passed].value_counts()
+    counts = counts[counts.index != df['LASS'].max()]
+    return bool((counts >= 2).any())
+
+
+def pack_segments(counts, block_size):
+    """ Consecutive segments of counts (Series of exons per segment, sorted) in blocks of about block_size exons """
+    blocks = []
+    size = block_size
+    for segment, count in counts.items():
+        if size + count > block_size:
+            blocks.append([])
+            size = 0
+        blocks[-1].append(segment)
+        size = size + count
+    return blocks
+
+
+class ChromosomeBlocks(object):
+    """
+    Classification of the chromosome in sdir (y_input_v1.csv) in blocks, with
+    the three runs and drop rules of whole-chromosome classification.
+    next_blocks() gives the blocks to classify next, add_result() takes each
+    block's result back, and once next_blocks() is empty write_results()
+    writes the chromosome's df6_REFINE.csv and df_constitutive.csv.
+    """
+
+    def __init__(self, sdir, exid2loc, exid2strand, PSImax, PSImin, block_size):
+        self.sdir = sdir
+        self.chrstr = [x for x in re.split(r'[/\\]', sdir) if x != ''][-1] + '.'
+        self.block_size = block_size
+        with open(sdir + '/y_input_v1.csv', 'r') as f:
+            self.lines = np.array(f.readlines(), dtype=object)
+        df = readExonInput(sdir + '/y_input_v1.csv', exid2loc, exid2strand)
+        df['Segment'] = exon_segments(df)
+        df['LASS'] = joinColumns(df, LASS_KEY)
+        df['RASS'] = joinColumns(df, RASS_KEY)
+        df['LPSImax1'] = PSImax['LPSImax1'].reindex(df['ExonID']).values
+        self.input = df[['ExonID', 'Segment', 'LASS', 'RASS', 'LPSImax1']]
+        segment = pd.Series(df['Segment'].values, index=df['ExonID'].values)
+        self.segment = segment[~segment.index.duplicated()]
+        # PSImin columns that are integer in step0 of the whole chromosome
+        psimin = PSImin.reindex(df['ExonID'])
+        self.min_int = [x for x in ['LPSImin1', 'RPSImin1'] if (psimin[x] == -1).all()]
+
+        self.run = 1
+        self.input_count = 1
+        self.checkpoint_count = 1
+        self.current_time = time.time()
+        self.block_count = 0
+        self.exons = None
+        self.df6 = None
+        self.records = None
+        self.drops = None
+        self.has_df6 = True
+        # ExonStart is a string column once the chromosome has LASS records, which each
+        # run predicts from its input
+        self.start_str = has_lass_records(self.input)
+        self.context_of = {}
+        self.flags_of = {}
+        self.pending = set(np.unique(df['Segment'].values).tolist())
+        self.round = []
+
+    def segments(self):
+        """ Segments of the current input """
+        df = self.input if self.exons is None else self.exons[0]
+        return set(np.unique(df['Segment'].values).tolist())
+
+    def key_segments(self):
+        """ Segments holding the first and the last LASS/RASS key of the current input """
+        df = self.input if self.exons is None else self.exons[0]
+        holders = []
+        for side in ['LASS', 'RASS']:
+            for end, key in [('first', df[side].min()), ('last', df[side].max())]:
+                holders.append((end, side, df['Segment'].values[(df[side] == key).values][0]))
+        return holders
+
+    def key_flags(self, holders, segment):
+        """ Ends of the key order (see key_segments) a segment holds """
+        return frozenset((end, side) for end, side, x in holders if x == segment)
+
+    def next_blocks(self):
+        """ Blocks to classify next, as dicts with the arguments of worker1; [] once all runs are done """
+        if self.round:
+            self.merge_round()
+        while self.run is not None:
+            if self.pending:
+                blocks = self.make_blocks(self.pending)
+                self.pending = set()
+                return blocks
+            # Segments classified with the wrong ExonStart type and without LASS records of their own,
+            # which make ExonStart a string column anyway, are classified again (none, when the
+            # prediction of has_lass_records() holds)
+            self.start_str = bool((self.records['Class'] == 'LASS').any())
+            own = set(self.records['Segment'][self.records['Class'] == 'LASS'].tolist())
+            self.pending = set(x for x in self.segments() if x not in own and
+                               self.context_of[x]['startStr'] != self.start_str)
+            if not self.pending:
+                self.finish_run()
+        return []
+
+    def make_blocks(self, segments):
+        df = self.input if self.exons is None else self.exons[0]
+        rows = df['Segment'].isin(segments).values
+        counts = df['Segment'][rows].value_counts().sort_index()
+        holders = self.key_segments()
+        with open(self.sdir + '/rsr-cleanup.log', 'a') as f:
+            f.write('Run ' + str(self.run) + ': classifying ' + str(len(counts.index)) + ' of ' +
+                    str(len(self.segments())) + ' segments, ' + str(int(counts.sum())) + ' of ' +
+                    str(len(df.index)) + ' exons\n')
+        for x in counts.index:
+            self.flags_of[x] = self.key_flags(holders, x)
+        blocks = []
+        for block_segments in pack_segments(counts, self.block_size):
+            self.block_count = self.block_count + 1
+            bdir = self.sdir + '/block' + str(self.block_count).zfill(6)
+            if not os.path.exists(bdir):
+                os.makedirs(bdir)
+            in_block = df['Segment'].isin(block_segments).values
+            context = {'first': [side for end, side, x in holders if end == 'first' and x in block_segments],
+                       'last': [side for end, side, x in holders if end == 'last' and x in block_segments],
+                       'startStr': self.start_str, 'minInt': self.min_int, 'segments': None}
+            exons = None
+            if self.exons is None:
+                with open(bdir + '/y_input_v1.csv', 'w') as f:
+                    f.writelines(self.lines[in_block])
+                context['segments'] = df['Segment'].values[in_block]
+            else:
+                exons = (self.exons[0][in_block].reset_index(drop=True), self.exons[1].iloc[:0])
+            blocks.append({'dir': bdir, 'context': context, 'exons': exons, 'size': int(in_block.sum()),
+                           'segments': block_segments, 'chromosome': self})
+        return blocks
+
+    def add_result(self, block, result):
+        self.round.append((block, result))
+
+    def merge_round(self):
+        """ Results of the blocks of the last round in place of the earlier results of their segments """
+        segments = set()
+        for block, result in self.round:
+            segments.update(block['segments'])
+            for x in block['segments']:
+                self.context_of[x] = block['context']
+        if self.exons is None:
+            self.exons = (pd.concat([result['exons'][0] for block, result in self.round]),
+                          pd.concat([result['exons'][1] for block, result in self.round]))
+        drops = []
+        for block, result in self.round:
+            for rule, dropList in enumerate(result['drops'], 1):
+                # Drop rules can name records, which are not in the input
+                dropList = sorted(x for x in dropList if x in self.segment.index)
+                drops.append(pd.DataFrame({'ExonID': dropList, 'Rule': rule,
+                                           'Segment': self.segment.reindex(dropList).values}))
+        self.df6 = self.replace(self.df6, [result['df6'] for block, result in self.round], segments)
+        self.records = self.replace(self.records, [result['records'] for block, result in self.round], segments)
+        self.drops = self.replace(self.drops, drops, segments)
+        self.round = []
+
+    @staticmethod
+    def replace(df, results, segments):
+        if df is not None:
+            results = [df[~df['Segment'].isin(segments)]] + results
+        return pd.concat(results).reset_index(drop=True)
+
+    def checkpoint(self):
+        writeTimestamp(self.sdir, self.checkpoint_count, self.current_time)
+        self.current_time = time.time()
+        self.checkpoint_count = self.checkpoint_count + 1
+
+    def finish_run(self):
+        """ Drop the exons of the run's drop rule and start the next run, if any """
+        self.checkpoint()
+        if self.run == 3:
+            self.run = None
+            return
+        dropList = set(self.drops['ExonID'][self.drops['Rule'] == self.run])
+        writeNewInput(self.sdir, self.input_count, dropList)
+        self.input_count = self.input_count + 1
+        self.checkpoint()
+        # Later runs classify the input of the first run without the dropped exons;
+        # when no exon was dropped the input is unchanged and so are the results
+        if os.path.getsize(self.sdir + '/y_input_v' + str(self.input_count) + '.csv') == 0:
+            # No exons left to classify
+            self.has_df6 = self.run == 1
+            self.run = None
+            return
+        self.run = self.run + 1
+        exons = dropExons(self.exons, dropList)
+        self.start_str = has_lass_records(exons[0])
+        if len(exons[0].index) < len(self.exons[0].index):
+            segments = self.segments()
+            self.exons = exons
+            # Only segments that lost exons, now hold a different end of the key order or were
+            # classified with another ExonStart type are classified again; the others have the
+            # same input and context, and so the same results.  A segment is the smallest unit
+            # reused: one dropped exon sends its whole segment back, so the share of a run that
+            # is reused shrinks as exons are packed into fewer, larger segments
+            present = self.segments()
+            holders = self.key_segments()
+            dropped = set(self.drops['Segment'][self.drops['ExonID'].isin(dropList)].tolist())
+            self.pending = set(x for x in present if x in dropped or
+                               self.key_flags(holders, x) != self.flags_of[x] or
+                               self.context_of[x]['startStr'] != self.start_str)
+            gone = segments - present
+            self.df6, self.records, self.drops = [x[~x['Segment'].isin(gone)]
+                                                  for x in [self.df6, self.records, self.drops]]
+
+    def record_ids(self):
+        """ Final ID of every record, numbered per class over the chromosome in key order """
+        ids = {}
+        for record_class, df in self.records.groupby('Class'):
+            keys = sorted(zip(df['Key'].tolist(), df['RecordID'].tolist()))
+            for x, (key, record_id) in enumerate(keys, 1):
+                ids[record_id] = record_class + '_' + self.chrstr + str(x).zfill(7)
+        return ids
+
+    def write_results(self):
+        df_constitutive = self.exons[1].drop_duplicates('ExonID').set_index('ExonID')
+        exon_ids = self.input['ExonID']
+        df_constitutive = df_constitutive.loc[exon_ids[exon_ids.isin(df_constitutive.index)].values]
+        df_constitutive.reset_index().to_csv(self.sdir + '/df_constitutive.csv')
+
+        if not self.has_df6:
+            if os.path.isfile(self.sdir + '/df6_REFINE.csv'):
+                os.remove(self.sdir + '/df6_REFINE.csv')
+            return
+        ids = self.record_ids()
+        df_main = self.df6.drop('Segment', axis=1)
+        for col in ['ExonID', 'ExonClass', 'MetadataLINKED', 'MetadataMUTEX']:
+            df_main[col] = df_main[col].astype(str).str.replace(BLOCK_RECORD, lambda m: ids[m.group(0)], regex=True)
+        df_main = restoreTypes(df_main)
+        # Rows in the order of step 4, which sorts by MUTEX key and then ExonStart
+        df_main['MUTEX'] = joinColumns(df_main, ['ExonChr', '1_ELS', '1_ERE', 'ExonStrand'])
+        df_main = df_main.sort_values(by=['MUTEX', 'ExonStart'], ascending=[True, True])
+        df_main = df_main.drop('MUTEX', axis=1).reset_index(drop=True)
+        df_main.to_csv(self.sdir + '/df6_REFINE.csv', sep=',')
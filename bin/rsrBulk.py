@@ -11,8 +11,9 @@ import pandas as pd
 import itertools
 import csv
 import tempfile
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from builtins import bytes
-import math
+from rsrSnaptron import make_client, SNAPTRON_URL
 import warnings
 warnings.simplefilter(action='ignore', category=FutureWarning)
 
@@ -23,86 +24,13 @@ chromosome_list = [
     'chr21', 'chr22', 'chrX' , 'chrY' , 'chrM'
     ]  # only coordinates with these chromosomes will be processed
 
-# %%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
-# Global variables
-cwd = os.getcwd()
-os.environ["CUR_DIR"] = cwd
+# Metrics reported for every exon, in bulkoutput.csv order
+PSI_METRICS = ['LeftPSI', 'RightPSI', 'AvgPSI']
+JC_METRICS = ['LeftJunctionCount', 'RightJunctionCount', 'TotalJunctionCount']
 
 # %%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
-# Inclusion/Exclusion Junction Reporting
-if not os.path.exists('y_inLR.csv'):
-    b = open('y_inLR.csv','w')
-    b.close()
-if not os.path.exists('y_exLR.csv'):
-    b = open('y_exLR.csv','w')
-    b.close()
-
-# Parse arguments
-parser = argparse.ArgumentParser(formatter_class=RawTextHelpFormatter, description="""
-  ====================================
-   RSR - Find PSI for cassette exons.
-  ====================================
-
-  REQUIRES --input parameter; others are optional
-  
-  Input file is a text file with a list of queries, one per line.  Example syntax:
-  
-ExIDv1-0001	chr1:118512175-118512222	+
-ExIDv1-0002	chr1:118512705-118512728	+
-ExIDv1-0003	chr1:118523321-118523347	+
-ExIDv1-0004	chr1:118531978-118532085	+
-
-  (Reminder: the fields are seprated by tabs, not spaces)
-  
-  Snaptron parameters are stored in the config file:
-    -Samples (snaptron_samples)
-    -Datasource (snaptron_datasrc)
-    -Query filter (snaptron_filter)
-""")
-parser.add_argument('--input', action='store',
-                    metavar = 'path',
-                    required=True,
-                    help='TSV file with queries, one query per line: exid(tab)chr:begin-end(tab)strand')
-parser.add_argument('--query-temp', action='store',
-                    metavar='path',
-                    required=False,
-                    help='Path to file where first and second pass queries should be stored; by '
-                         'default queries are stored in temporary files deleted upon exit.')
-parser.add_argument('--cfg', action='store',
-                    default='master',
-                    dest='config_id',
-                    metavar = '',
-                    help='Config file identifier\n  e.g. -cfg 123456 for /cfg/123456_config.ini')
-parser.add_argument('--preset', action='store',
-                    default='MAIN',
-                    dest='config_section',
-                    metavar = '',
-                    help='Optional: choose a preset section in config instead of \'MAIN\'\n  e.g. -preset SUPERMOUSE')
-parser.add_argument('--inclusion-fraction', action='store',
-                    type=float, default=0.7,
-                    help='A junction is considered an inclusion junction if it accounts for at least '
-                         'this fraction of the splicing events incident on the exon.')
-parser.add_argument('--queries-per-batch', action='store',
-                    type=int, default=50,
-                    help='Number of queries to send to server in single "bulk" batch.  50 is maxmimum supported.')
-parser.add_argument('--coverage-sum', action='store',
-                    type=int, default=10,
-                    help='Ignore junctions with less than this many total reads supporting it across selected samples.')
-parser.add_argument('--max-length', action='store',
-                    type=int, default=200000,
-                    help='Ignore junctions spanning an intron longer than this.')
-parser.add_argument('--keep-intermediates', action='store_true',
-                    default=False,
-                    help='Keep intermediate files containing queries and responses')
-parser.add_argument('--verbose', action='store_true',
-                    default=False,
-                    help='Be talkative')
-parser.add_argument('--debug', action='store_true',
-                    default=False,
-                    dest='error_log',
-                    help='Record errors in \'error.log\'')
-args = parser.parse_args()
-error_log = args.error_log
+# Global variables
+error_log = False
 
 
 def error(msg):
@@ -112,37 +40,6 @@ def error(msg):
     raise RuntimeError(msg)
 
 
-# Check config directory
-dir_path = cwd + "/cfg"
-if not os.path.exists(dir_path) or not os.listdir(dir_path):
-    error('Error: no config directory')
-
-if not any(map(lambda x: x.endswith('.ini'), os.listdir(dir_path))):
-    error('no .ini files in config directory')
-
-# Open config files
-userconfig = configparser.ConfigParser()
-with codecs.open(cwd + '/cfg/' + args.config_id + '_config.ini', 'r', encoding='utf-8') as f:
-    userconfig.read_file(f)
-masterconfig = configparser.ConfigParser()
-with codecs.open(cwd + '/cfg/master_config.ini', 'r', encoding='utf-8') as f:
-    masterconfig.read_file(f)
-
-# Parse
-dont_filter_by_sample_id = None
-if 'dont_filter_by_sample_id' in userconfig[args.config_section]:
-    dont_filter_by_sample_id = userconfig[args.config_section]['dont_filter_by_sample_id']
-linked_samples = userconfig[args.config_section]['snaptron_samples'] #samples separated by comma/dash
-unlinked_samples = re.sub(r'-', ',', linked_samples) #samples: replace dashes with commas
-qs_cov_filt = b'coverage_sum>=%d' % args.coverage_sum
-qs_len_filt = b'length<=%d' % args.max_length
-rail_ids = unlinked_samples.split(',')
-unlinked_samples = bytes(unlinked_samples, 'utf-8')
-if dont_filter_by_sample_id == "1":
-    sys.stdout.write("not filtering by sample id\n")
-    unlinked_samples = bytes("", 'utf-8')
-
-
 def mkdir_quiet(dr):
     """ Create directories needed to ensure 'dr' exists; no complaining """
     import errno
@@ -154,14 +51,6 @@ def mkdir_quiet(dr):
                 raise
 
 
-temp_dir = None
-if args.query_temp is not None:
-    temp_dir = args.query_temp
-    mkdir_quiet(temp_dir)
-else:
-    temp_dir = tempfile.mkdtemp()
-
-
 def parse_row(row):
     if len(row) != 3:
         error('Malformed row of --input file: %s' % str(row))
@@ -179,19 +68,6 @@ def parse_row(row):
     return exid, chrom, st, en, strand
 
 
-def compose_junction_client_bulk_query(fn):
-    with open(fn, 'r') as fh:
-        for i, row in enumerate(csv.reader(fh, delimiter='\t', quoting=csv.QUOTE_NONE)):
-            rw = parse_row(row)
-            if rw is None:
-                break
-            exid, chrom, st, en, strand = rw
-            region = bytes('%s:%d-%d' % (chrom, st-1, en+1), 'utf-8')
-            filters = b'&'.join([qs_cov_filt, qs_len_filt, b'strand=' + bytes(strand, 'utf-8')])
-            exid, chrom, strand = map(lambda x: bytes(x, 'utf-8'), [exid, chrom, strand])
-            yield [exid, chrom, st, en, strand, region, filters, unlinked_samples, i]
-
-
 def grouper(n, iterable):
     it = iter(iterable)
     while True:
@@ -201,15 +77,141 @@ def grouper(n, iterable):
        yield chunk
 
 
-def junction_query_batches(fn, queries_per_batch, verbose=False):
-    query_fn = os.path.join(temp_dir, 'pass1.tsv')
-    result_fn = os.path.join(temp_dir, 'pass1.tsv.snap_results.tsv')
-    for i, chunk in enumerate(grouper(queries_per_batch, compose_junction_client_bulk_query(fn))):
-        assert not os.path.exists(query_fn)
-        assert not os.path.exists(result_fn)
-        exon_infos = {}
-        with open(query_fn, 'wb') as ofh:
-            ofh.write(b'\t'.join([b'region', b'filters', b'samples', b'group']) + b'\n')
+class SampleCounts(object):
+    """
+    Per-sample read counts of every junction in a Snaptron response, decoded
+    from the 'samples' column (',rail_id:count,rail_id:count,...') in one
+    pass into a sparse junction x rail_id matrix in CSR form.  Rows follow
+    the response's rows; columns are the rail ids in 'rail_index'.  Samples
+    not in rail_index are dropped.
+    """
+    def __init__(self, samples, rail_index):
+        samples = pd.Series(samples, dtype=object).astype(str)
+        samples = samples.where(~samples.str.startswith(','), samples.str[1:])
+        ntok = np.where(samples == '', 0, samples.str.count(',') + 1)
+        tokens = np.array(','.join(samples[samples != '']).replace(':', ',').split(','), dtype=object)
+        if ntok.sum() == 0:
+            tokens = tokens[:0]
+        rails, counts = tokens[0::2], tokens[1::2].astype(np.int64)
+        cols = rail_index.get_indexer(rails)
+        keep = cols >= 0
+        rows = np.repeat(np.arange(len(samples)), ntok)[keep]
+        self.indptr = np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=len(samples)))])
+        self.indices = cols[keep]
+        self.data = counts[keep]
+        self.ncols = len(rail_index)
+
+    def row(self, i):
+        """ Dense counts of junction i over all columns, 0 where absent """
+        dense = np.zeros(self.ncols, dtype=np.int64)
+        sl = slice(self.indptr[i], self.indptr[i + 1])
+        dense[self.indices[sl]] = self.data[sl]
+        return dense
+
+
+class BulkQuery(object):
+    """
+    Snaptron bulk query and PSI calculation for a list of exons.
+
+    Reads the snaptron_samples/snaptron_datasrc preset once and keeps one
+    Snaptron client open, so callers such as rsrMain.py can stream any number
+    of exon batches through batches() without restarting anything.
+    """
+    def __init__(self, config_section='MAIN', config_id='master', inclusion_fraction=0.7,
+                 queries_per_batch=50, coverage_sum=10, max_length=200000, junctions=None,
+                 snaptron_url=SNAPTRON_URL, concurrency=4, cache=None, cache_size=2 * 1024 ** 3,
+                 keep_intermediates=False, query_temp=None, verbose=False, cwd=None):
+        if cwd is None:
+            cwd = os.getcwd()
+        self.inclusion_fraction = inclusion_fraction
+        self.queries_per_batch = queries_per_batch
+        self.concurrency = max(1, concurrency)
+        self.keep_intermediates = keep_intermediates
+        self.verbose = verbose
+        self.exons_queried = 0  # exons sent to Snaptron
+        self.exons_done = 0  # exons in batches yielded by batches()
+
+        # Check config directory
+        dir_path = cwd + "/cfg"
+        if not os.path.exists(dir_path) or not os.listdir(dir_path):
+            error('Error: no config directory')
+
+        if not any(map(lambda x: x.endswith('.ini'), os.listdir(dir_path))):
+            error('no .ini files in config directory')
+
+        # Open config file
+        userconfig = configparser.ConfigParser()
+        with codecs.open(cwd + '/cfg/' + config_id + '_config.ini', 'r', encoding='utf-8') as f:
+            userconfig.read_file(f)
+        preset = userconfig[config_section]
+
+        # Parse
+        dont_filter_by_sample_id = None
+        if 'dont_filter_by_sample_id' in preset:
+            dont_filter_by_sample_id = preset['dont_filter_by_sample_id']
+        self.linked_samples = preset['snaptron_samples'] #samples separated by comma/dash
+        unlinked_samples = re.sub(r'-', ',', self.linked_samples) #samples: replace dashes with commas
+        self.qs_cov_filt = b'coverage_sum>=%d' % coverage_sum
+        self.qs_len_filt = b'length<=%d' % max_length
+        self.rail_ids = unlinked_samples.split(',')
+        self.rail_index = pd.Index(pd.unique(np.array(self.rail_ids, dtype=object)))
+        self.rail_pos = self.rail_index.get_indexer(self.rail_ids)  # rail_ids may repeat
+
+        # Sample groups as a sparse aggregation matrix over rail_ids: the group
+        # and rail_ids position of every member of a '-' linked group, and the
+        # position of every single-sample group (first occurrence of a rail_id)
+        first = {}
+        for i, rail_id in enumerate(self.rail_ids):
+            first.setdefault(rail_id, i)
+        groups = [x.split('-') for x in self.linked_samples.split(',')]
+        self.n_groups = len(groups)
+        self.single_groups = np.array([i for i, g in enumerate(groups) if len(g) == 1], dtype=np.int64)
+        self.single_members = np.array([first[g[0]] for g in groups if len(g) == 1], dtype=np.int64)
+        self.linked_groups = np.array([i for i, g in enumerate(groups) if len(g) > 1 for y in g], dtype=np.int64)
+        self.linked_members = np.array([first[y] for g in groups if len(g) > 1 for y in g], dtype=np.int64)
+        self.unlinked_samples = bytes(unlinked_samples, 'utf-8')
+        if dont_filter_by_sample_id == "1":
+            sys.stdout.write("not filtering by sample id\n")
+            self.unlinked_samples = bytes("", 'utf-8')
+
+        # Queries and responses only touch the disk when asked to keep them
+        self.temp_dir = None
+        if keep_intermediates:
+            if query_temp is not None:
+                self.temp_dir = query_temp
+                mkdir_quiet(self.temp_dir)
+            else:
+                self.temp_dir = tempfile.mkdtemp()
+
+        self.client = make_client(preset['snaptron_datasrc'], junctions=junctions,
+                                  url=snaptron_url, connections=self.concurrency,
+                                  cache=cache, cache_size=cache_size)
+
+    def compose_junction_client_bulk_query(self, rows):
+        """ rows: iterable of tab-separated exid/range/strand lines, e.g. an open input file """
+        rows = (x for x in rows if not x.startswith('#'))
+        for i, row in enumerate(csv.reader(rows, delimiter='\t', quoting=csv.QUOTE_NONE)):
+            rw = parse_row(row)
+            if rw is None:
+                break
+            exid, chrom, st, en, strand = rw
+            region = bytes('%s:%d-%d' % (chrom, st-1, en+1), 'utf-8')
+            filters = b'&'.join([self.qs_cov_filt, self.qs_len_filt, b'strand=' + bytes(strand, 'utf-8')])
+            exid, chrom, strand = map(lambda x: bytes(x, 'utf-8'), [exid, chrom, strand])
+            yield [exid, chrom, st, en, strand, region, filters, self.unlinked_samples, i]
+
+    def junction_query_batches(self, rows, skip=0):
+        """
+        Split the input into pass-1 bulk queries, leaving out the first 'skip'
+        exons; yields (queries, exon_infos) per batch
+        """
+        queries = self.compose_junction_client_bulk_query(rows)
+        for _ in itertools.islice(queries, skip):
+            pass
+        self.exons_queried += skip
+        for chunk in grouper(self.queries_per_batch, queries):
+            exon_infos = {}
+            queries = []
             for ln in chunk:
                 exid, chrom, st, en, strand, region, filters, unlinked_samples, group_id = ln
                 exon_infos[group_id] = {'exon_id': exid,
@@ -217,193 +219,227 @@ def junction_query_batches(fn, queries_per_batch, verbose=False):
                                        'start': st,
                                        'end': en,
                                        'strand': strand}
-                ofh.write(b'\t'.join([region, filters, unlinked_samples, bytes(str(group_id), 'utf-8')]) + b'\n')
-        cmd = ['python', './software/snaptron/qs', '--bulk-query-file=' + query_fn,
-           '--datasrc=' + userconfig[args.config_section]['snaptron_datasrc']]
-        cmd = ' '.join(cmd)
-        if verbose:
-            print(cmd)
-        ret = os.system(cmd)
-        if ret != 0:
-            raise RuntimeError('Snaptron query script returned %d' % ret)
-        with open(result_fn, 'rb') as rfh:
-            df = pd.read_csv(rfh, sep='\t')
-        if not args.keep_intermediates:
-            os.remove(query_fn)
-            os.remove(result_fn)
-        else:
-            print (query_fn, temp_dir, i)
-            os.rename(query_fn, os.path.join(temp_dir, 'pass1_queries_batch%d.tsv' % (i+1)))
-            os.rename(result_fn, os.path.join(temp_dir, 'pass1_responses_batch%d.tsv' % (i+1)))
-        yield df, exon_infos
-
-
-def handle_junction_query(df, exon_info):
-    """
-    Use results from the first-pass junction query to construct second-pass
-    exclusion junction queries.
-    """
-    assert df.shape[0] > 0
-    exon_id, exon_chr, exon_start, exon_end, strand = \
-        exon_info['exon_id'], exon_info['chromosome'], exon_info['start'], \
-        exon_info['end'], exon_info['strand']
-
-    inclusion_left, inclusion_right = None, None
-    EJL_pass = 1  # 0 = EJL fraction/total too small; -1 = empty dataframe
-    EJR_pass = 1  # 0 = EJR fraction/total too small; -1 = empty dataframe
-
-    # Slice df_pm1 for exon left/right exon junctions and find index of max coverage_sum
-    df_EJL = df.loc[df['end'] == exon_start - 1]
-    df_EJR = df.loc[df['start'] == exon_end + 1]
-    index_EJL_max, index_EJR_max = None, None
-    EJLsum, EJRsum = 0, 0
-    if df_EJL.empty and df_EJR.empty:
-        return None
-
-    if not df_EJL.empty:
-        EJLsum = df_EJL['coverage_sum'].sum()
-        index_EJL_max = df_EJL['coverage_sum'].idxmax()
-    if not df_EJR.empty:
-        EJRsum = df_EJR['coverage_sum'].sum()
-        index_EJR_max = df_EJR['coverage_sum'].idxmax()
-
-    # Inclusion/Exclusion Junction Reporting
-    inLRstr = ""
-    inContinue = 0    
-    
-    # Find inclusion junctions, left and right of exon
-    # Left:    
-    if df_EJL.empty:
-        EJL_pass = -1
-    elif df_EJL.get_value(index_EJL_max, 'coverage_sum') / EJLsum < args.inclusion_fraction:
-        EJL_pass = 0
-    else:
-        inclusion_left = [
-            bytes(df_EJL.get_value(index_EJL_max, 'chromosome'), 'utf-8'),
-            int(df_EJL.get_value(index_EJL_max, 'start')),
-            int(df_EJL.get_value(index_EJL_max, 'end')),
-            bytes(df_EJL.get_value(index_EJL_max, 'strand'), 'utf-8')
-        ]
-        assert inclusion_left[0] == exon_chr
+                queries.append([region, filters, unlinked_samples, group_id])
+            self.exons_queried += len(chunk)
+            yield queries, exon_infos
+
+    def bulk_query(self, queries, passi, batchi):
+        """ Run one bulk query; called from the scheduler's worker threads """
+        keep = None
+        if self.keep_intermediates:
+            keep = (os.path.join(self.temp_dir, 'pass%d_queries_batch%d.tsv' % (passi, batchi)),
+                    os.path.join(self.temp_dir, 'pass%d_responses_batch%d.tsv' % (passi, batchi)))
+        if self.verbose:
+            print('Snaptron pass %d, batch %d: %d queries' % (passi, batchi, len(queries)))
+        return self.client.bulk_query(queries, keep=keep)
+
+    def handle_junction_query(self, df, exon_info):
+        """
+        Use results from the first-pass junction query to construct second-pass
+        exclusion junction queries.
+        """
+        assert df.shape[0] > 0
+        exon_id, exon_chr, exon_start, exon_end, strand = \
+            exon_info['exon_id'], exon_info['chromosome'], exon_info['start'], \
+            exon_info['end'], exon_info['strand']
+
+        inclusion_left, inclusion_right = None, None
+        EJL_pass = 1  # 0 = EJL fraction/total too small; -1 = empty dataframe
+        EJR_pass = 1  # 0 = EJR fraction/total too small; -1 = empty dataframe
+
+        # Slice df_pm1 for exon left/right exon junctions and find index of max coverage_sum
+        df_EJL = df.loc[df['end'] == exon_start - 1]
+        df_EJR = df.loc[df['start'] == exon_end + 1]
+        index_EJL_max, index_EJR_max = None, None
+        EJLsum, EJRsum = 0, 0
+        if df_EJL.empty and df_EJR.empty:
+            return None
+
+        if not df_EJL.empty:
+            EJLsum = df_EJL['coverage_sum'].sum()
+            index_EJL_max = df_EJL['coverage_sum'].idxmax()
+        if not df_EJR.empty:
+            EJRsum = df_EJR['coverage_sum'].sum()
+            index_EJR_max = df_EJR['coverage_sum'].idxmax()
 
         # Inclusion/Exclusion Junction Reporting
-        inLRstr = inLRstr + exon_id.decode("utf-8") + ','
-        df_EJL = df_EJL.sort_values('coverage_sum', ascending=False)
-        csSum = df_EJL['coverage_sum'].sum()
-        inexCounter = 0
-        for x in df_EJL.index.values:
-            inLRstr = inLRstr + str(df_EJL.get_value(x, 'start')) + ','
-            inLRstr = inLRstr + str(df_EJL.get_value(x, 'end')) + ','
-            inLRstr = inLRstr + str(int(round(df_EJL.get_value(x, 'coverage_sum')*100/csSum))) + ','
-            inexCounter = inexCounter + 1
-            if inexCounter >= 3:
-                break
-        while inexCounter < 3:
-            inLRstr = inLRstr + '-1,-1,-1,'
-            inexCounter = inexCounter + 1
-        inContinue = 1
-
-    # Right:
-    if df_EJR.empty:
-        EJR_pass = -1
-    elif df_EJR.get_value(index_EJR_max, 'coverage_sum') / EJRsum < args.inclusion_fraction:
-        EJR_pass = 0
-    else:
-        inclusion_right = [
-            bytes(df_EJR.get_value(index_EJR_max, 'chromosome'), 'utf-8'),
-            int(df_EJR.get_value(index_EJR_max, 'start')),
-            int(df_EJR.get_value(index_EJR_max, 'end')),
-            bytes(df_EJR.get_value(index_EJR_max, 'strand'), 'utf-8')
-        ]
-        assert inclusion_right[0] == exon_chr
-        
-        # Inclusion/Exclusion Junction Reporting
-        if inContinue == 1:
-            df_EJR = df_EJR.sort_values('coverage_sum', ascending=False)
-            csSum = df_EJR['coverage_sum'].sum()
+        inLRstr = ""
+        inContinue = 0    
+
+        # Find inclusion junctions, left and right of exon
+        # Left:    
+        if df_EJL.empty:
+            EJL_pass = -1
+        elif df_EJL.at[index_EJL_max, 'coverage_sum'] / EJLsum < self.inclusion_fraction:
+            EJL_pass = 0
+        else:
+            inclusion_left = [
+                bytes(df_EJL.at[index_EJL_max, 'chromosome'], 'utf-8'),
+                int(df_EJL.at[index_EJL_max, 'start']),
+                int(df_EJL.at[index_EJL_max, 'end']),
+                bytes(df_EJL.at[index_EJL_max, 'strand'], 'utf-8')
+            ]
+            assert inclusion_left[0] == exon_chr
+
+            # Inclusion/Exclusion Junction Reporting
+            inLRstr = inLRstr + exon_id.decode("utf-8") + ','
+            df_EJL = df_EJL.sort_values('coverage_sum', ascending=False)
+            csSum = df_EJL['coverage_sum'].sum()
             inexCounter = 0
-            for x in df_EJR.index.values:
-                inLRstr = inLRstr + str(df_EJR.get_value(x, 'start')) + ','
-                inLRstr = inLRstr + str(df_EJR.get_value(x, 'end')) + ','
-                inLRstr = inLRstr + str(int(round(df_EJR.get_value(x, 'coverage_sum')*100/csSum))) + ','
+            for x in df_EJL.index.values:
+                inLRstr = inLRstr + str(df_EJL.at[x, 'start']) + ','
+                inLRstr = inLRstr + str(df_EJL.at[x, 'end']) + ','
+                inLRstr = inLRstr + str(int(round(df_EJL.at[x, 'coverage_sum']*100/csSum))) + ','
                 inexCounter = inexCounter + 1
                 if inexCounter >= 3:
                     break
             while inexCounter < 3:
                 inLRstr = inLRstr + '-1,-1,-1,'
                 inexCounter = inexCounter + 1
-            with open('y_inLR.csv', 'a') as inex:
-                inex.write(inLRstr + '\n')
-
-    # %%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
-    # Snaptron query for boundary junctions
-    boundary_coordinates = None
-    if EJL_pass == 1 and EJR_pass == 1:
-        st_str, en_str = bytes(str(inclusion_left[1]), 'utf-8'), bytes(str(inclusion_right[2]), 'utf-8')
-        boundary_coordinates = b''.join([exon_chr, b':', st_str, b'-', en_str])
-    elif EJL_pass == 1 and EJR_pass != 1:  # Query only single bp of left boundary
-        st_str, en_str = bytes(str(inclusion_left[1]), 'utf-8'), bytes(str(inclusion_left[1]), 'utf-8')
-        boundary_coordinates = b''.join([exon_chr, b':', st_str, b'-', en_str])
-    elif EJL_pass != 1 and EJR_pass == 1:  # Query only single bp of right boundary
-        st_str, en_str = bytes(str(inclusion_right[2]), 'utf-8'), bytes(str(inclusion_right[2]), 'utf-8')
-        boundary_coordinates = b''.join([exon_chr, b':', st_str, b'-', en_str])
-
-    exon_info['ejl_pass'] = EJL_pass
-    exon_info['ejr_pass'] = EJR_pass
-    exon_info['inclusion_left'] = inclusion_left
-    exon_info['inclusion_right'] = inclusion_right
-    return boundary_coordinates
-
-
-def handle_junction_query_batch(df, exon_infos, batchi, verbose=False):
-    query2_fn = os.path.join(temp_dir, 'pass2.tsv')
-    result2_fn = os.path.join(temp_dir, 'pass2.tsv.snap_results.tsv')
-    with open(query2_fn, 'wb') as ofh:
-        ofh.write(b'\t'.join([b'region', b'filters', b'samples', b'group']) + b'\n')
+            inContinue = 1
+
+        # Right:
+        if df_EJR.empty:
+            EJR_pass = -1
+        elif df_EJR.at[index_EJR_max, 'coverage_sum'] / EJRsum < self.inclusion_fraction:
+            EJR_pass = 0
+        else:
+            inclusion_right = [
+                bytes(df_EJR.at[index_EJR_max, 'chromosome'], 'utf-8'),
+                int(df_EJR.at[index_EJR_max, 'start']),
+                int(df_EJR.at[index_EJR_max, 'end']),
+                bytes(df_EJR.at[index_EJR_max, 'strand'], 'utf-8')
+            ]
+            assert inclusion_right[0] == exon_chr
+
+            # Inclusion/Exclusion Junction Reporting
+            if inContinue == 1:
+                df_EJR = df_EJR.sort_values('coverage_sum', ascending=False)
+                csSum = df_EJR['coverage_sum'].sum()
+                inexCounter = 0
+                for x in df_EJR.index.values:
+                    inLRstr = inLRstr + str(df_EJR.at[x, 'start']) + ','
+                    inLRstr = inLRstr + str(df_EJR.at[x, 'end']) + ','
+                    inLRstr = inLRstr + str(int(round(df_EJR.at[x, 'coverage_sum']*100/csSum))) + ','
+                    inexCounter = inexCounter + 1
+                    if inexCounter >= 3:
+                        break
+                while inexCounter < 3:
+                    inLRstr = inLRstr + '-1,-1,-1,'
+                    inexCounter = inexCounter + 1
+                exon_info['inLR'] = inLRstr
+
+        # %%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
+        # Snaptron query for boundary junctions
+        boundary_coordinates = None
+        if EJL_pass == 1 and EJR_pass == 1:
+            st_str, en_str = bytes(str(inclusion_left[1]), 'utf-8'), bytes(str(inclusion_right[2]), 'utf-8')
+            boundary_coordinates = b''.join([exon_chr, b':', st_str, b'-', en_str])
+        elif EJL_pass == 1 and EJR_pass != 1:  # Query only single bp of left boundary
+            st_str, en_str = bytes(str(inclusion_left[1]), 'utf-8'), bytes(str(inclusion_left[1]), 'utf-8')
+            boundary_coordinates = b''.join([exon_chr, b':', st_str, b'-', en_str])
+        elif EJL_pass != 1 and EJR_pass == 1:  # Query only single bp of right boundary
+            st_str, en_str = bytes(str(inclusion_right[2]), 'utf-8'), bytes(str(inclusion_right[2]), 'utf-8')
+            boundary_coordinates = b''.join([exon_chr, b':', st_str, b'-', en_str])
+
+        exon_info['ejl_pass'] = EJL_pass
+        exon_info['ejr_pass'] = EJR_pass
+        exon_info['inclusion_left'] = inclusion_left
+        exon_info['inclusion_right'] = inclusion_right
+        return boundary_coordinates
+
+    def handle_junction_query_batch(self, df, exon_infos):
+        """ Second-pass boundary junction queries for a batch of first-pass results """
+        queries = []
         for group_id in set(df.Group):
             assert group_id in exon_infos
             exon_info = exon_infos[group_id]
-            region = handle_junction_query(df.loc[df.Group == group_id], exon_info)
+            region = self.handle_junction_query(df.loc[df.Group == group_id], exon_info)
             if region is None:
                 continue
-            filters = b'&'.join([qs_cov_filt, qs_len_filt, b'strand=' + exon_info['strand']])
-            ofh.write(b'\t'.join([region, filters, unlinked_samples, bytes(str(group_id), 'utf-8')]) + b'\n')
-
-    cmd = ['python', './software/snaptron/qs', '--bulk-query-file=' + query2_fn,
-           '--datasrc=' + userconfig[args.config_section]['snaptron_datasrc']]
-    cmd = ' '.join(cmd)
-    if verbose:
-        print(cmd)
-    ret = os.system(cmd)
-    if ret != 0:
-        raise RuntimeError('Snaptron query script returned %d' % ret)
-    nlines = len(open(result2_fn).readlines())
-    result_df = None
-    if nlines > 1:
-        result_df = pd.read_csv(result2_fn, sep='\t')
-    if not args.keep_intermediates:
-        os.remove(query2_fn)
-        os.remove(result2_fn)
-    else:
-        os.rename(query2_fn, os.path.join(temp_dir, 'pass2_queries_batch%d.tsv' % batchi))
-        os.rename(result2_fn, os.path.join(temp_dir, 'pass2_responses_batch%d.tsv' % batchi))
-    return result_df
-
-
-# Iterate over batches of query exons
-batchi = 0
-avg_psis, tot_junc_counts = [], []
-for df, exon_infos in junction_query_batches(args.input, args.queries_per_batch, verbose=args.verbose):
-    batchi += 1
-    # Iterate over Snaptron groups, each corresponding to a single query exon
-    df2_full = handle_junction_query_batch(df, exon_infos, batchi, verbose=args.verbose)
-    if df2_full is None:
-        continue
-    for group_id in set(df2_full.Group):
-
-        df2 = df2_full.loc[df2_full.Group == group_id]
+            filters = b'&'.join([self.qs_cov_filt, self.qs_len_filt, b'strand=' + exon_info['strand']])
+            queries.append([region, filters, self.unlinked_samples, group_id])
+        return queries
+
+    def batch_records(self, df2_full, exon_infos):
+        """ Per-exon records for a batch from its second-pass results """
+        records = []
+        # Iterate over Snaptron groups, each corresponding to a single query exon
+        done = set()
+        if not df2_full.empty:
+            df2_full = df2_full.reset_index(drop=True)
+            counts = SampleCounts(df2_full['samples'], self.rail_index)
+            for group_id in set(df2_full.Group):
+                exon_info = exon_infos[group_id]
+                records.append(self.exon_psi(df2_full.loc[df2_full.Group == group_id], exon_info, counts))
+                done.add(group_id)
+            self.batch_psi(records)
+        for group_id in exon_infos:
+            if group_id not in done and exon_infos[group_id].get('inLR') is not None:
+                record = dict((x, None) for x in PSI_METRICS + JC_METRICS + ['exLR'])
+                record['exon_id'] = exon_infos[group_id]['exon_id'].decode('utf-8')
+                record['inLR'] = exon_infos[group_id]['inLR']
+                records.append(record)
+        return records
+
+    def batches(self, rows, skip=0):
+        """
+        Query Snaptron for every exon in 'rows' and compute its PSI/junction counts.
+        Yields one list of per-exon records per bulk query batch, in input order;
+        the first 'skip' exons (e.g. batches finished by an earlier run) are left
+        out.  self.exons_done counts the exons up to the end of the last batch
+        yielded, including skipped ones.
+        A record holds the exon's comma-joined metric strings (PSI_METRICS +
+        JC_METRICS, None if it had no boundary junctions) and its y_inLR/y_exLR
+        reporting lines (or None).
+
+        Up to self.concurrency bulk queries are in flight at once.  A batch's
+        pass-2 query is submitted as soon as its pass-1 response has been handled,
+        and pass-2 responses go to the PSI stage as they arrive; only the order
+        batches are yielded in is fixed.
+        """
+        pass1 = self.junction_query_batches(rows, skip)
+        self.exons_done += skip
+        exon_infos = {}  # batchi -> exon_infos
+        batch_sizes = {}  # batchi -> number of exons
+        finished = {}  # batchi -> records, waiting for earlier batches
+        running = {}  # future -> (pass, batchi)
+        submitted, yielded = 0, 0
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            while True:
+                # Keep the pool full, but don't run too far ahead of a slow batch
+                while pass1 is not None and len(running) < self.concurrency \
+                        and submitted - yielded < 2 * self.concurrency:
+                    batch = next(pass1, None)
+                    if batch is None:
+                        pass1 = None
+                        break
+                    submitted += 1
+                    exon_infos[submitted] = batch[1]
+                    batch_sizes[submitted] = len(batch[1])
+                    running[pool.submit(self.bulk_query, batch[0], 1, submitted)] = (1, submitted)
+                if not running:
+                    break
+                done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in done:
+                    passi, batchi = running.pop(future)
+                    df = future.result()
+                    if passi == 1:
+                        queries = self.handle_junction_query_batch(df, exon_infos[batchi])
+                        running[pool.submit(self.bulk_query, queries, 2, batchi)] = (2, batchi)
+                    else:
+                        finished[batchi] = self.batch_records(df, exon_infos.pop(batchi))
+                while yielded + 1 in finished:
+                    yielded += 1
+                    self.exons_done += batch_sizes.pop(yielded)
+                    yield finished.pop(yielded)
+
+    def exon_psi(self, df2, exon_info, counts):
+        """
+        Exclusion junctions, PSI and junction counts for one exon from its pass-2
+        junctions; 'counts' holds the sample counts of the response df2 was cut from
+        """
         exclusion_left, exclusion_right = [], []
-        exon_info = exon_infos[group_id]
         EJL_pass, EJR_pass = exon_info['ejl_pass'], exon_info['ejr_pass']
         inclusion_left, inclusion_right = exon_info['inclusion_left'], exon_info['inclusion_right']
         exon_id = exon_info['exon_id']
@@ -411,6 +447,7 @@ for df, exon_infos in junction_query_batches(args.input, args.queries_per_batch,
         # Inclusion/Exclusion Junction Reporting
         exLRstr = ""
         exLRcontinue = 1
+        exLR = None
         
         # %%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
         # Slice df_boundary for boundary left junctions, record exclusion junctions
@@ -426,10 +463,10 @@ for df, exon_infos in junction_query_batches(args.input, args.queries_per_batch,
             else:
                 for x in range(len(df_BJL.index)):
                     exclusion_left.append([
-                        df_BJL.get_value(x, 'chromosome'),
-                        df_BJL.get_value(x, 'start'),
-                        df_BJL.get_value(x, 'end'),
-                        df_BJL.get_value(x, 'strand')
+                        df_BJL.at[x, 'chromosome'],
+                        df_BJL.at[x, 'start'],
+                        df_BJL.at[x, 'end'],
+                        df_BJL.at[x, 'strand']
                     ])
                 
                 # Inclusion/Exclusion Junction Reporting
@@ -437,9 +474,9 @@ for df, exon_infos in junction_query_batches(args.input, args.queries_per_batch,
                 csSum = df_BJL['coverage_sum'].sum()
                 inexCounter = 0
                 for x in df_BJL.index.values:
-                    exLRstr = exLRstr + str(df_BJL.get_value(x, 'start')) + ','
-                    exLRstr = exLRstr + str(df_BJL.get_value(x, 'end')) + ','
-                    exLRstr = exLRstr + str(int(round(df_BJL.get_value(x, 'coverage_sum')*100/csSum))) + ','
+                    exLRstr = exLRstr + str(df_BJL.at[x, 'start']) + ','
+                    exLRstr = exLRstr + str(df_BJL.at[x, 'end']) + ','
+                    exLRstr = exLRstr + str(int(round(df_BJL.at[x, 'coverage_sum']*100/csSum))) + ','
                     inexCounter = inexCounter + 1
                     if inexCounter >= 3:
                         break
@@ -461,294 +498,306 @@ for df, exon_infos in junction_query_batches(args.input, args.queries_per_batch,
                     # Constitutive Right Junction
                     incRstr = str(inclusion_right[1]) + ',' + str(inclusion_right[2]) + ',999'
                     exLRstr = exLRstr + incRstr + ',-1,-1,-1,-1,-1,-1,'
-                    with open('y_exLR.csv', 'a') as inex:
-                        inex.write(exLRstr + '\n')
+                    exLR = exLRstr
                 else:
                     for x in range(len(df_BJR.index)):
                         exclusion_right.append([
-                            df_BJR.get_value(x, 'chromosome'),
-                            df_BJR.get_value(x, 'start'),
-                            df_BJR.get_value(x, 'end'),
-                            df_BJR.get_value(x, 'strand')
+                            df_BJR.at[x, 'chromosome'],
+                            df_BJR.at[x, 'start'],
+                            df_BJR.at[x, 'end'],
+                            df_BJR.at[x, 'strand']
                         ])
 
                     # Inclusion/Exclusion Junction Reporting
                     csSum = df_BJR['coverage_sum'].sum()
                     inexCounter = 0
                     for x in df_BJR.index.values:
-                        exLRstr = exLRstr + str(df_BJR.get_value(x, 'start')) + ','
-                        exLRstr = exLRstr + str(df_BJR.get_value(x, 'end')) + ','
-                        exLRstr = exLRstr + str(int(round(df_BJR.get_value(x, 'coverage_sum')*100/csSum))) + ','
+                        exLRstr = exLRstr + str(df_BJR.at[x, 'start']) + ','
+                        exLRstr = exLRstr + str(df_BJR.at[x, 'end']) + ','
+                        exLRstr = exLRstr + str(int(round(df_BJR.at[x, 'coverage_sum']*100/csSum))) + ','
                         inexCounter = inexCounter + 1
                         if inexCounter >= 3:
                             break
                     while inexCounter < 3:
                         exLRstr = exLRstr + '-1,-1,-1,'
                         inexCounter = inexCounter + 1
-                    with open('y_exLR.csv', 'a') as inex:
-                        inex.write(exLRstr + '\n')
+                    exLR = exLRstr
 
         # %%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
-        # B. Calculate PSI and total junction counts
+        # B. Junction counts per rail_id; PSI is calculated for the whole batch in batch_psi()
         # %%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
 
-        # Initiate inclusion/exclusion junction dataframes (and b2b dataframe)
-        df_LeftInclusion = pd.DataFrame({"rail_id": rail_ids})
-        df_RightInclusion = pd.DataFrame({"rail_id": rail_ids})
-        df_LeftExclusion = pd.DataFrame({"rail_id": rail_ids})
-        df_RightExclusion = pd.DataFrame({"rail_id": rail_ids})
-        df_b2b = pd.DataFrame({"rail_id": rail_ids})
+        # Read counts per rail_id of the first junction in df2 with these coordinates
+        def junction_counts(start, end):
+            match = df2.index[(df2['start'] == start) & (df2['end'] == end)]
+            return counts.row(match[0])[self.rail_pos]
+
+        zeros = np.zeros(len(self.rail_ids), dtype=np.int64)
+        left_inclusion, left_exclusion = zeros, zeros
+        right_inclusion, right_exclusion = zeros, zeros
 
-        # Fill out boundary-to-boundary (b2b) dataframe
+        # Boundary-to-boundary (b2b) junction
         # Used to remove duplicate counting of b2b junction in TJC
+        b2b = zeros
         if EJL_pass == 1 and EJR_pass == 1:
-            match_start = df2['start'] == inclusion_left[1]
-            match_end = df2['end'] == inclusion_right[2]
-            df_match = df2[match_start & match_end].reset_index(drop=True)
-            dict_samplecounts = {}
-            if df_match.shape[0] > 0:
-                dict_str = df_match['samples'][0]
-                if dict_str[0] == ',':
-                    dict_str = dict_str[1:]
-                dict_samplecounts = {x.split(':')[0]: x.split(':')[1] for x in dict_str.split(',')}
-            df_b2b['b2b'] = df_b2b["rail_id"].map(dict_samplecounts.get).fillna(value=0)
-            df_b2b = df_b2b.apply(pd.to_numeric).drop('rail_id', 1)
-            df_b2b = df_b2b.sum(axis=1)
-
-        # Fill out df_LeftInclusion
-        if EJL_pass == 1:
-            match_start = df2['start'] == inclusion_left[1]
-            match_end = df2['end'] == inclusion_left[2]
-            df_match = df2[match_start & match_end].reset_index(drop=True)
-            dict_str = df_match['samples'][0]
-            if dict_str[0] == ',':
-                dict_str = dict_str[1:]
-            dict_samplecounts = {x.split(':')[0]: x.split(':')[1] for x in dict_str.split(',')}
-            df_LeftInclusion[exon_id] = df_LeftInclusion["rail_id"].map(dict_samplecounts.get).fillna(value=0)
-            df_LeftInclusion = df_LeftInclusion.apply(pd.to_numeric).drop('rail_id', 1)
-            df_LeftInclusion = df_LeftInclusion.sum(axis=1)
-
-        # Fill out df_RightInclusion
-        if EJR_pass == 1:
-            match_start = df2['start'] == inclusion_right[1]
-            match_end = df2['end'] == inclusion_right[2]
-            df_match = df2[match_start & match_end].reset_index(drop=True)
-            dict_str = df_match['samples'][0]
-            if dict_str[0] == ',':
-                dict_str = dict_str[1:]
-            dict_samplecounts = {x.split(':')[0]: x.split(':')[1] for x in dict_str.split(',')}
-            df_RightInclusion[exon_id] = df_RightInclusion["rail_id"].map(dict_samplecounts.get).fillna(value=0)
-            df_RightInclusion = df_RightInclusion.apply(pd.to_numeric).drop('rail_id', 1)
-            df_RightInclusion = df_RightInclusion.sum(axis=1)
-
-        # Fill out df_LeftExclusion
+            if ((df2['start'] == inclusion_left[1]) & (df2['end'] == inclusion_right[2])).any():
+                b2b = junction_counts(inclusion_left[1], inclusion_right[2])
+
+        # Inclusion/exclusion junctions
         if EJL_pass == 1:
-            for x in range(len(exclusion_left)):
-                match_start = df2['start'] == exclusion_left[x][1]
-                match_end = df2['end'] == exclusion_left[x][2]
-                df_match = df2[match_start & match_end].reset_index(drop=True)
-                dict_str = df_match['samples'][0]
-                if dict_str[0] == ',':
-                    dict_str = dict_str[1:]
-                dict_samplecounts = {x.split(':')[0]: x.split(':')[1] for x in dict_str.split(',')}
-                df_LeftExclusion[exon_id + b'_' + bytes(str(x), 'utf-8')] = df_LeftExclusion["rail_id"].map(dict_samplecounts.get)
-
-            df_LeftExclusion = df_LeftExclusion.fillna(value=0).apply(pd.to_numeric)
-            df_tempL = df_LeftExclusion
-            df_LeftExclusion = df_LeftExclusion.drop('rail_id', 1)
-            df_LeftExclusion = df_LeftExclusion.sum(axis=1)
-
-        # Fill out df_RightExclusion
+            left_inclusion = junction_counts(inclusion_left[1], inclusion_left[2])
+            for junction in exclusion_left:
+                left_exclusion = left_exclusion + junction_counts(junction[1], junction[2])
         if EJR_pass == 1:
-            for x in range(len(exclusion_right)):
-                match_start = df2['start'] == exclusion_right[x][1]
-                match_end = df2['end'] == exclusion_right[x][2]
-                df_match = df2[match_start & match_end].reset_index(drop=True)
-                dict_str = df_match['samples'][0]
-                if dict_str[0] == ',':
-                    dict_str = dict_str[1:]
-                dict_samplecounts = {x.split(':')[0]: x.split(':')[1] for x in dict_str.split(',')}
-                df_RightExclusion[exon_id + b'_' + bytes(str(x), 'utf-8')] = df_RightExclusion["rail_id"].map(dict_samplecounts.get)
-
-            df_RightExclusion = df_RightExclusion.fillna(value=0).apply(pd.to_numeric)
-            df_RightExclusion = df_RightExclusion.drop('rail_id', 1)
-            df_RightExclusion = df_RightExclusion.sum(axis=1)
-
-        # Calculate PSI [Left/Right/Avg] and JunctionCount [Left/Right/Total]
-        if EJL_pass == 1 and EJR_pass == 1:
-            df_LeftJunctionCount = df_LeftInclusion.add(df_LeftExclusion).astype(int)
-            df_RightJunctionCount = df_RightInclusion.add(df_RightExclusion).astype(int)
-            df_TotalJunctionCount = df_LeftJunctionCount.add(df_RightJunctionCount).subtract(df_b2b).astype(int) #.subtract(df_b2b) to remove boundary to boundary junction
-            df_LeftPSI = df_LeftInclusion.div(df_LeftJunctionCount)
-            df_RightPSI = df_RightInclusion.div(df_RightJunctionCount)
-            df_AvgPSI = df_LeftPSI.add(df_RightPSI).multiply(0.5)
-
-            # Link '-' delimited samples together
-            df_PSIandTJC = pd.DataFrame({"rail_id": rail_ids})
-            df_PSIandTJC['LPSI'] = df_LeftPSI
-            df_PSIandTJC['RPSI'] = df_RightPSI
-            df_PSIandTJC['APSI'] = df_AvgPSI
-            df_PSIandTJC['LJC'] = df_LeftJunctionCount
-            df_PSIandTJC['RJC'] = df_RightJunctionCount
-            df_PSIandTJC['TJC'] = df_TotalJunctionCount
-            df_PSIandTJC = df_PSIandTJC.set_index('rail_id')
-            LinkedSamples = linked_samples.split(',')
-            LPSI_newcol = []
-            RPSI_newcol = []
-            APSI_newcol = []
-            LJC_newcol = []
-            RJC_newcol = []
-            TJC_newcol = []
-            for x in range(len(LinkedSamples)):
-                linked_rail_ids = LinkedSamples[x].split('-')
-                if len(linked_rail_ids) > 1:
-                    totalLPSI = 0
-                    totalRPSI = 0
-                    totalAPSI = 0
-                    totalLJC = 0
-                    totalRJC = 0
-                    totalTJC = 0
-                    
-                    for y in linked_rail_ids:
-                        addLPSI = df_PSIandTJC.get_value(y, 'LPSI')
-                        addRPSI = df_PSIandTJC.get_value(y, 'RPSI')
-                        addAPSI = df_PSIandTJC.get_value(y, 'APSI')
-                        addLJC = df_PSIandTJC.get_value(y, 'LJC')
-                        addRJC = df_PSIandTJC.get_value(y, 'RJC')
-                        addTJC = df_PSIandTJC.get_value(y, 'TJC')
-                        
-                        #If statements handle if rail_id occurs multiple times in snaptron_samples
-                        if type(addLPSI) is np.ndarray:
-                            addLPSI = addLPSI[0]
-                        if type(addRPSI) is np.ndarray:
-                            addRPSI = addRPSI[0]
-                        if type(addAPSI) is np.ndarray:
-                            addAPSI = addAPSI[0]
-                        if type(addLJC) is np.ndarray:
-                            addLJC = addLJC[0]
-                        if type(addRJC) is np.ndarray:
-                            addRJC = addRJC[0]
-                        if type(addTJC) is np.ndarray:
-                            addTJC = addTJC[0]
-
-                        if math.isnan(addLPSI):
-                            addLPSI = 0
-                        if math.isnan(addRPSI):
-                            addRPSI = 0
-                        if math.isnan(addAPSI):
-                            addAPSI = 0
-                        
-                        totalLPSI = totalLPSI + addLPSI * addLJC
-                        totalRPSI = totalRPSI + addRPSI * addRJC
-                        totalAPSI = totalAPSI + addAPSI * addTJC
-                        totalLJC = totalLJC + addLJC
-                        totalRJC = totalRJC + addRJC
-                        totalTJC = totalTJC + addTJC
-                    
-                    if totalLJC == 0:
-                        totalLPSI = 0
-                    else:
-                        totalLPSI = totalLPSI / totalLJC
-                    if totalRJC == 0:
-                        totalRPSI = 0
-                    else:
-                        totalRPSI = totalRPSI / totalRJC
-                    if totalTJC == 0:
-                        totalAPSI = 0
-                    else:
-                        totalAPSI = totalAPSI / totalTJC
-                    
-                    LPSI_newcol.extend([totalLPSI])
-                    RPSI_newcol.extend([totalRPSI])
-                    APSI_newcol.extend([totalAPSI])
-                    LJC_newcol.extend([totalLJC])
-                    RJC_newcol.extend([totalRJC])
-                    TJC_newcol.extend([totalTJC])
-                else:
-                    addLPSI = df_PSIandTJC.get_value(linked_rail_ids[0], 'LPSI')
-                    addRPSI = df_PSIandTJC.get_value(linked_rail_ids[0], 'RPSI')
-                    addAPSI = df_PSIandTJC.get_value(linked_rail_ids[0], 'APSI')
-                    addLJC = df_PSIandTJC.get_value(linked_rail_ids[0], 'LJC')
-                    addRJC = df_PSIandTJC.get_value(linked_rail_ids[0], 'RJC')                    
-                    addTJC = df_PSIandTJC.get_value(linked_rail_ids[0], 'TJC')
-                    if type(addLPSI) is np.ndarray:
-                        addLPSI = addLPSI[0]
-                    if type(addRPSI) is np.ndarray:
-                        addRPSI = addRPSI[0]
-                    if type(addAPSI) is np.ndarray:
-                        addAPSI = addAPSI[0]
-                    if type(addLJC) is np.ndarray:
-                        addLJC = addLJC[0]
-                    if type(addRJC) is np.ndarray:
-                        addRJC = addRJC[0]
-                    if type(addTJC) is np.ndarray:
-                        addTJC = addTJC[0]                        
-                    LPSI_newcol.extend([addLPSI])
-                    RPSI_newcol.extend([addRPSI])
-                    APSI_newcol.extend([addAPSI])
-                    LJC_newcol.extend([addLJC])
-                    RJC_newcol.extend([addRJC])
-                    TJC_newcol.extend([addTJC])
-                    
-            df_LeftPSI = pd.Series(LPSI_newcol)
-            df_RightPSI = pd.Series(RPSI_newcol)
-            df_AvgPSI = pd.Series(APSI_newcol)
-            df_LeftJunctionCount = pd.Series(LJC_newcol)
-            df_RightJunctionCount = pd.Series(RJC_newcol)
-            df_TotalJunctionCount = pd.Series(TJC_newcol)
-
-            # Convert to csv
-            LeftJunctionCount = df_LeftJunctionCount.to_frame().T.to_csv(index=False, header=False)
-            RightJunctionCount = df_RightJunctionCount.to_frame().T.to_csv(index=False, header=False)
-            TotalJunctionCount = df_TotalJunctionCount.to_frame().T.to_csv(index=False, header=False)
-
-            LeftPSI = df_LeftPSI.fillna(value=0).multiply(100).round(3).astype(float).to_frame().T.to_csv(index=False, header=False)
-            RightPSI = df_RightPSI.fillna(value=0).multiply(100).round(3).astype(float).to_frame().T.to_csv(index=False, header=False)
-            AvgPSI = df_AvgPSI.fillna(value=0).multiply(100).round(3).astype(float).to_frame().T.to_csv(index=False, header=False)
-        elif EJL_pass != 1 and EJR_pass == 1:
-            df_RightJunctionCount = df_RightInclusion.add(df_RightExclusion).astype(int)
-            df_RightPSI = df_RightInclusion.div(df_RightJunctionCount)
-            RightJunctionCount = df_RightJunctionCount.to_frame().T.to_csv(index=False, header=False)
-            RightPSI = df_RightPSI.fillna(value=0).multiply(100).round(3).astype(float).to_frame().T.to_csv(index=False, header=False)
-            if EJL_pass == 0:
-                LeftJunctionCount = 'ExonJunctionLeft<args.inclusion_fraction\n'
-                TotalJunctionCount = 'ExonJunctionLeft<args.inclusion_fraction\n'
-                LeftPSI = 'ExonJunctionLeft<args.inclusion_fraction\n'
-                AvgPSI = 'ExonJunctionLeft<args.inclusion_fraction\n'
-            elif EJL_pass == -1:
-                LeftJunctionCount = 'ExonJunctionLeftEmptyDataframe\n'
-                TotalJunctionCount = 'ExonJunctionLeftEmptyDataframe\n'
-                LeftPSI = 'ExonJunctionLeftEmptyDataframe\n'
-                AvgPSI = 'ExonJunctionLeftEmptyDataframe\n'
-        elif EJL_pass == 1 and EJR_pass != 1:
-            df_LeftJunctionCount = df_LeftInclusion.add(df_LeftExclusion).astype(int)
-            df_LeftPSI = df_LeftInclusion.div(df_LeftJunctionCount)
-            LeftJunctionCount = df_LeftJunctionCount.to_frame().T.to_csv(index=False, header=False)
-            LeftPSI = df_LeftPSI.fillna(value=0).multiply(100).round(3).astype(float).to_frame().T.to_csv(index=False, header=False)
-            if EJR_pass == 0:
-                RightJunctionCount = 'ExonJunctionRight<args.inclusion_fraction\n'
-                TotalJunctionCount = 'ExonJunctionRight<args.inclusion_fraction\n'
-                RightPSI = 'ExonJunctionRight<args.inclusion_fraction\n'
-                AvgPSI = 'ExonJunctionRight<args.inclusion_fraction\n'
-            elif EJR_pass == -1:
-                RightJunctionCount = 'ExonJunctionRightEmptyDataframe\n'
-                TotalJunctionCount = 'ExonJunctionRightEmptyDataframe\n'
-                RightPSI = 'ExonJunctionRightEmptyDataframe\n'
-                AvgPSI = 'ExonJunctionRightEmptyDataframe\n'
-
-        avg_psis.append([exon_id, b'LeftPSI', bytes(LeftPSI.rstrip(), 'utf-8')])
-        avg_psis.append([exon_id, b'RightPSI', bytes(RightPSI.rstrip(), 'utf-8')])
-        avg_psis.append([exon_id, b'AvgPSI', bytes(AvgPSI.rstrip(), 'utf-8')])
-        tot_junc_counts.append([exon_id, b'LeftJunctionCount', bytes(LeftJunctionCount.rstrip(), 'utf-8')])
-        tot_junc_counts.append([exon_id, b'RightJunctionCount', bytes(RightJunctionCount.rstrip(), 'utf-8')])
-        tot_junc_counts.append([exon_id, b'TotalJunctionCount', bytes(TotalJunctionCount.rstrip(), 'utf-8')])
-
-if not os.path.exists('bulkoutput.csv'):
-    f = open('bulkoutput.csv','w')
-    f.close()
-
-with open('bulkoutput.csv', 'a') as f:
-    for avg_psi_line in avg_psis:
-        f.write(b','.join(avg_psi_line).decode('utf-8') + '\n')
-    for tot_junc_count_line in tot_junc_counts:
-        f.write(b','.join(tot_junc_count_line).decode('utf-8') + '\n')
+            right_inclusion = junction_counts(inclusion_right[1], inclusion_right[2])
+            for junction in exclusion_right:
+                right_exclusion = right_exclusion + junction_counts(junction[1], junction[2])
+
+        return {'exon_id': exon_id.decode('utf-8'),
+                'inLR': exon_info.get('inLR'),
+                'exLR': exLR,
+                'ejl_pass': EJL_pass,
+                'ejr_pass': EJR_pass,
+                'counts': (left_inclusion, left_exclusion, right_inclusion, right_exclusion, b2b)}
+
+    def link_samples(self, psi, jc):
+        """
+        Aggregate (exons x rail_ids) PSI and junction count arrays over the
+        sample groups of snaptron_samples.  A '-' linked group gets the junction
+        count weighted PSI of its members, a single sample is passed through.
+        Members are summed in snaptron_samples order so results match summing
+        them one by one.
+        """
+        n = psi.shape[0]
+        linked_psi = np.zeros((n, self.n_groups))
+        linked_jc = np.zeros((n, self.n_groups), dtype=np.int64)
+        linked_psi[:, self.single_groups] = psi[:, self.single_members]
+        linked_jc[:, self.single_groups] = jc[:, self.single_members]
+        if len(self.linked_groups) > 0:
+            member_psi = psi[:, self.linked_members]
+            member_jc = jc[:, self.linked_members]
+            weighted = np.zeros((n, self.n_groups))
+            total = np.zeros((n, self.n_groups), dtype=np.int64)
+            np.add.at(weighted, (slice(None), self.linked_groups), np.where(np.isnan(member_psi), 0, member_psi) * member_jc)
+            np.add.at(total, (slice(None), self.linked_groups), member_jc)
+            groups = np.unique(self.linked_groups)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                linked_psi[:, groups] = np.where(total[:, groups] == 0, 0, weighted[:, groups] / total[:, groups])
+            linked_jc[:, groups] = total[:, groups]
+        return linked_psi, linked_jc
+
+    def batch_psi(self, records):
+        """
+        Calculate PSI [Left/Right/Avg] and JunctionCount [Left/Right/Total] for a
+        batch of exon_psi() records at once, as (exons x rail_ids) arrays, and
+        fill in their PSI_METRICS/JC_METRICS strings.  Exons with both inclusion
+        junctions are reported per linked sample group, exons with only one per
+        rail_id.  The former also get their numeric rows under 'values'
+        (metric -> array, holding the same numbers as the strings).
+        """
+        def percent(psi):
+            return np.round(np.where(np.isnan(psi), 0, psi) * 100, 3)
+
+        def psi_lines(psi):
+            return pd.DataFrame(psi).to_csv(index=False, header=False).splitlines()
+
+        def jc_lines(jc):
+            return pd.DataFrame(jc).to_csv(index=False, header=False).splitlines()
+
+        def fill(batch, metrics, lines):
+            for record, line in zip(batch, lines):
+                record[metrics] = line
+
+        def stack(batch, i):
+            return np.vstack([record['counts'][i] for record in batch])
+
+        both = [r for r in records if r['ejl_pass'] == 1 and r['ejr_pass'] == 1]
+        left = [r for r in records if r['ejl_pass'] == 1 and r['ejr_pass'] != 1]
+        right = [r for r in records if r['ejl_pass'] != 1 and r['ejr_pass'] == 1]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            if both:
+                left_inclusion, right_inclusion, b2b = stack(both, 0), stack(both, 2), stack(both, 4)
+                left_jc = left_inclusion + stack(both, 1)
+                right_jc = right_inclusion + stack(both, 3)
+                total_jc = left_jc + right_jc - b2b  # remove boundary to boundary junction
+                left_psi = left_inclusion / left_jc
+                right_psi = right_inclusion / right_jc
+                avg_psi = (left_psi + right_psi) * 0.5
+
+                left_psi, left_jc = self.link_samples(left_psi, left_jc)
+                right_psi, right_jc = self.link_samples(right_psi, right_jc)
+                avg_psi, total_jc = self.link_samples(avg_psi, total_jc)
+                left_psi, right_psi, avg_psi = percent(left_psi), percent(right_psi), percent(avg_psi)
+                fill(both, 'LeftPSI', psi_lines(left_psi))
+                fill(both, 'RightPSI', psi_lines(right_psi))
+                fill(both, 'AvgPSI', psi_lines(avg_psi))
+                fill(both, 'LeftJunctionCount', jc_lines(left_jc))
+                fill(both, 'RightJunctionCount', jc_lines(right_jc))
+                fill(both, 'TotalJunctionCount', jc_lines(total_jc))
+                for i, record in enumerate(both):
+                    record['values'] = {'LeftPSI': left_psi[i], 'RightPSI': right_psi[i], 'AvgPSI': avg_psi[i],
+                                        'LeftJunctionCount': left_jc[i], 'RightJunctionCount': right_jc[i],
+                                        'TotalJunctionCount': total_jc[i]}
+            if left:
+                left_inclusion = stack(left, 0)
+                left_jc = left_inclusion + stack(left, 1)
+                fill(left, 'LeftPSI', psi_lines(percent(left_inclusion / left_jc)))
+                fill(left, 'LeftJunctionCount', jc_lines(left_jc))
+            if right:
+                right_inclusion = stack(right, 2)
+                right_jc = right_inclusion + stack(right, 3)
+                fill(right, 'RightPSI', psi_lines(percent(right_inclusion / right_jc)))
+                fill(right, 'RightJunctionCount', jc_lines(right_jc))
+
+        for record in left:
+            if record['ejr_pass'] == 0:
+                msg = 'ExonJunctionRight<args.inclusion_fraction'
+            else:
+                msg = 'ExonJunctionRightEmptyDataframe'
+            for metric in ['RightJunctionCount', 'TotalJunctionCount', 'RightPSI', 'AvgPSI']:
+                record[metric] = msg
+        for record in right:
+            if record['ejl_pass'] == 0:
+                msg = 'ExonJunctionLeft<args.inclusion_fraction'
+            else:
+                msg = 'ExonJunctionLeftEmptyDataframe'
+            for metric in ['LeftJunctionCount', 'TotalJunctionCount', 'LeftPSI', 'AvgPSI']:
+                record[metric] = msg
+        for record in records:
+            del record['ejl_pass'], record['ejr_pass'], record['counts']
+
+
+if __name__ == '__main__':
+    # Parse arguments
+    parser = argparse.ArgumentParser(formatter_class=RawTextHelpFormatter, description="""
+  ====================================
+   RSR - Find PSI for cassette exons.
+  ====================================
+
+  REQUIRES --input parameter; others are optional
+  
+  Input file is a text file with a list of queries, one per line.  Example syntax:
+  
+ExIDv1-0001	chr1:118512175-118512222	+
+ExIDv1-0002	chr1:118512705-118512728	+
+ExIDv1-0003	chr1:118523321-118523347	+
+ExIDv1-0004	chr1:118531978-118532085	+
+
+  (Reminder: the fields are seprated by tabs, not spaces)
+  
+  Snaptron parameters are stored in the config file:
+    -Samples (snaptron_samples)
+    -Datasource (snaptron_datasrc)
+    -Query filter (snaptron_filter)
+""")
+    parser.add_argument('--input', action='store',
+                        metavar = 'path',
+                        required=True,
+                        help='TSV file with queries, one query per line: exid(tab)chr:begin-end(tab)strand')
+    parser.add_argument('--query-temp', action='store',
+                        metavar='path',
+                        required=False,
+                        help='Directory where first and second pass queries and responses are stored with '
+                             '--keep-intermediates; by default a new temporary directory is used.')
+    parser.add_argument('--cfg', action='store',
+                        default='master',
+                        dest='config_id',
+                        metavar = '',
+                        help='Config file identifier\n  e.g. -cfg 123456 for /cfg/123456_config.ini')
+    parser.add_argument('--preset', action='store',
+                        default='MAIN',
+                        dest='config_section',
+                        metavar = '',
+                        help='Optional: choose a preset section in config instead of \'MAIN\'\n  e.g. -preset SUPERMOUSE')
+    parser.add_argument('--inclusion-fraction', action='store',
+                        type=float, default=0.7,
+                        help='A junction is considered an inclusion junction if it accounts for at least '
+                             'this fraction of the splicing events incident on the exon.')
+    parser.add_argument('--queries-per-batch', action='store',
+                        type=int, default=50,
+                        help='Number of queries to send to server in single "bulk" batch.  50 is maxmimum supported.')
+    parser.add_argument('--coverage-sum', action='store',
+                        type=int, default=10,
+                        help='Ignore junctions with less than this many total reads supporting it across selected samples.')
+    parser.add_argument('--max-length', action='store',
+                        type=int, default=200000,
+                        help='Ignore junctions spanning an intron longer than this.')
+    parser.add_argument('--keep-intermediates', action='store_true',
+                        default=False,
+                        help='Keep intermediate files containing queries and responses')
+    parser.add_argument('--junctions', action='store',
+                        metavar='path',
+                        default=None,
+                        help='Query local Snaptron junction file(s) instead of the Snaptron server;\n'
+                             '  \'{datasrc}\' in the path is replaced by each snaptron_datasrc compilation')
+    parser.add_argument('--snaptron-url', action='store',
+                        default=SNAPTRON_URL,
+                        help='Snaptron server to query')
+    parser.add_argument('--concurrency', action='store',
+                        type=int, default=4,
+                        help='Number of bulk queries kept in flight (and connections open) to the Snaptron server')
+    parser.add_argument('--cache', action='store',
+                        metavar='path',
+                        default=None,
+                        help='Cache Snaptron server responses in this SQLite file, reused across runs')
+    parser.add_argument('--cache-size', action='store',
+                        type=int, default=2048,
+                        help='Maximum size of the response cache in MB; least recently used\n'
+                             '  responses are evicted beyond this')
+    parser.add_argument('--verbose', action='store_true',
+                        default=False,
+                        help='Be talkative')
+    parser.add_argument('--debug', action='store_true',
+                        default=False,
+                        dest='error_log',
+                        help='Record errors in \'error.log\'')
+    args = parser.parse_args()
+    error_log = args.error_log
+
+    # Inclusion/Exclusion Junction Reporting
+    if not os.path.exists('y_inLR.csv'):
+        b = open('y_inLR.csv','w')
+        b.close()
+    if not os.path.exists('y_exLR.csv'):
+        b = open('y_exLR.csv','w')
+        b.close()
+
+    bulk = BulkQuery(config_section=args.config_section, config_id=args.config_id,
+                     inclusion_fraction=args.inclusion_fraction, queries_per_batch=args.queries_per_batch,
+                     coverage_sum=args.coverage_sum, max_length=args.max_length, junctions=args.junctions,
+                     snaptron_url=args.snaptron_url, concurrency=args.concurrency,
+                     cache=args.cache, cache_size=args.cache_size * 1024 ** 2,
+                     keep_intermediates=args.keep_intermediates, query_temp=args.query_temp,
+                     verbose=args.verbose)
+
+    # Iterate over batches of query exons
+    avg_psis, tot_junc_counts = [], []
+    with open(args.input, 'r') as fh:
+        for records in bulk.batches(fh):
+            for record in records:
+                if record['inLR'] is not None:
+                    with open('y_inLR.csv', 'a') as inex:
+                        inex.write(record['inLR'] + '\n')
+                if record['exLR'] is not None:
+                    with open('y_exLR.csv', 'a') as inex:
+                        inex.write(record['exLR'] + '\n')
+                if record['LeftPSI'] is None:
+                    continue
+                for metric in PSI_METRICS:
+                    avg_psis.append(','.join([record['exon_id'], metric, record[metric]]))
+                for metric in JC_METRICS:
+                    tot_junc_counts.append(','.join([record['exon_id'], metric, record[metric]]))
+
+    if bulk.client.stats() is not None:
+        print(bulk.client.stats())
+    bulk.client.close()
+
+    if not os.path.exists('bulkoutput.csv'):
+        f = open('bulkoutput.csv','w')
+        f.close()
+
+    with open('bulkoutput.csv', 'a') as f:
+        for avg_psi_line in avg_psis:
+            f.write(avg_psi_line + '\n')
+        for tot_junc_count_line in tot_junc_counts:
+            f.write(tot_junc_count_line + '\n')
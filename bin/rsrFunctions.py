@@ -1,9 +1,221 @@
-def classifyExons(argInfile, argSteps, sdir, exid2loc, exid2strand, PSImax, PSImin, LPSI, RPSI):
+def restoreTypes(df):
+    """
+    Give object columns the dtypes pandas.read_csv infers for them: columns of
+    numbers become int64/float64, mixed columns (e.g. ExonStart once LASS
+    records hold '|'-joined start sites) become strings.  Steps of
+    classifyExons therefore see the same values they did when each step
+    re-read the previous step's csv file.
+    """
+    import pandas as pd
+    for col in df.columns:
+        if df[col].dtype == object:
+            try:
+                df[col] = pd.to_numeric(df[col])
+            except (ValueError, TypeError):
+                df[col] = df[col].astype(str)
+    return df
+
+
+def joinColumns(df, cols):
+    """ ':'-joined string values of columns cols, per row """
+    joined = df[cols[0]].astype(str)
+    for col in cols[1:]:
+        joined = joined + ':' + df[col].astype(str)
+    return joined
+
+
+def spliceSites(sites, fn):
+    """
+    Smallest (fn=min) or largest (fn=max) site of each exon; ExonStart/ExonEnd
+    hold '|'-joined sites for LASS/RASS records, which makes them strings.
+    """
+    import numpy as np
+    import pandas as pd
+    if pd.api.types.is_numeric_dtype(sites):
+        return sites.values.astype(np.int64)
+    split = sites.str.split('|').explode().astype(np.int64)
+    if fn is min:
+        return split.groupby(level=0).min().values
+    return split.groupby(level=0).max().values
+
+
+def rankPSI(rows, k=5):
+    """
+    The k highest PSIs of each row of a PSI matrix, highest first, and the k
+    lowest, lowest first, selected with np.partition.  -1 (too few junctions)
+    ranks below every PSI for the highest and above every PSI for the lowest.
+    """
+    import numpy as np
+    high = -np.sort(np.partition(-rows, k - 1, axis=1)[:, :k], axis=1)
+    low = np.where(rows == -1, np.inf, rows)
+    low = np.sort(np.partition(low, k - 1, axis=1)[:, :k], axis=1)
+    low[low == np.inf] = -1
+    return high, low
+
+
+def mergeSpliceSites(df_main, side, chrstr, PSIthreshold, clst, first=True, last=True):
+    """
+    Step1 of classifyExons for one side: merge exons sharing a LASS (or RASS)
+    key into a single record.  Exons are sorted by key and PSI (highest first)
+    and each key group is headed by its first exon; a head below PSIthreshold
+    (except the first exon of the table) leaves the next exon to head the
+    group.  Exons after the head merge into it when their PSI reaches
+    PSIthreshold and are filtered otherwise.  As in a scan that writes each
+    group out when the next one starts, the group of the last key is not
+    recorded.  first=False/last=False turn these exceptions off for a table
+    that is part of a larger one (see rsrBlocks).
+
+    Returns the sorted df_main, the new records, and the new ExonClass of
+    merged and of filtered exons (Series indexed by ExonID).
+    """
+    import numpy as np
+    import pandas as pd
+    import time
+
+    if side == 'LASS':
+        psiCol, siteCol, offset, metaCol = 'LPSImax1', 'ExonStart', -1, 'MetadataLASS'
+        juncCols, pctCol = ['1_ELE', '2_ELE', '3_ELE'], '1_ELP'
+    else:
+        psiCol, siteCol, offset, metaCol = 'RPSImax1', 'ExonEnd', 1, 'MetadataRASS'
+        juncCols, pctCol = ['1_ERS', '2_ERS', '3_ERS'], '1_ERP'
+
+    df_main = df_main.sort_values(by=[side, psiCol], ascending=[True, False])
+    df_main = df_main.reset_index(drop=True)
+    n = len(df_main.index)
+    if n == 0:
+        return df_main, df_main.iloc[:0], pd.Series([], dtype=object), pd.Series([], dtype=object)
+
+    # Key groups are runs of equal keys in the sorted table
+    key = df_main[side].values
+    pos = np.arange(n)
+    keyStart = np.ones(n, dtype=bool)
+    keyStart[1:] = key[1:] != key[:-1]
+    keyStart = np.flatnonzero(keyStart)
+    groupID = np.repeat(np.arange(len(keyStart)), np.diff(np.append(keyStart, n)))
+
+    psi = df_main[psiCol].values.astype(float)
+    with np.errstate(invalid='ignore'):
+        passed = psi >= PSIthreshold
+        lowHead = psi < PSIthreshold
+    if first:
+        lowHead[0] = False
+    head = np.minimum.reduceat(np.where(lowHead, n, pos), keyStart)[groupID]
+    member = (pos > head) & passed
+    filteredRows = (pos > head) & ~passed
+
+    # Groups of two or more exons are recorded, except the last group of the table
+    size = np.bincount(groupID[member], minlength=len(keyStart)) + 1
+    recorded = size > 1
+    recorded[-1] = recorded[-1] and not last
+    number = np.cumsum(recorded)
+    inRecord = ((pos == head) | member) & recorded[groupID]
+    recID = np.array([side + '_' + chrstr + str(x).zfill(7) for x in number[groupID[inRecord]]], dtype=object)
+
+    merged = pd.Series('Merged:' + recID, index=df_main['ExonID'].values[inRecord], dtype=object)
+    filtered = pd.Series('Filtered:LowPSI:' + side, index=df_main['ExonID'].values[filteredRows], dtype=object)
+
+    groups = np.flatnonzero(recorded)
+    keyEnd = np.append(keyStart[1:], n)
+    for g in groups:
+        clst.write(side + ' recorded at index ' + str(keyEnd[g]) + time.strftime(', %m/%d/%y, %H:%M:%S') + '\n')
+
+    # New records are copies of the group heads
+    df_records = df_main.iloc[np.unique(head[inRecord])].copy()
+    df_group = pd.DataFrame({'group': groupID[inRecord],
+                             'ExonID': df_main['ExonID'].values[inRecord],
+                             'site': df_main[siteCol].values[inRecord].astype(np.int64)})
+    df_group['sitestr'] = df_group['site'].astype(str)
+    joined = df_group.groupby('group', sort=True).agg({'sitestr': '|'.join, 'ExonID': ','.join})
+    df_records[siteCol] = joined['sitestr'].values
+    df_records['ExonID'] = [side + '_' + chrstr + str(x).zfill(7) for x in range(1, len(groups) + 1)]
+    df_records[metaCol] = joined['ExonID'].values
+    df_records['ExonClass'] = side
+
+    # The record's 1st exclusion junction must not end (start) at one of the merged
+    # start (end) sites: fall back to the 2nd or 3rd junction, or -1 if all of them do
+    siteKeys = df_group['group'].values * 2 ** 32 + (df_group['site'].values + offset)
+    onSite = [np.isin(groups * 2 ** 32 + df_records[x].values.astype(np.int64), siteKeys) for x in juncCols]
+    copy2 = onSite[0] & ~onSite[1]
+    copy3 = onSite[0] & onSite[1] & ~onSite[2]
+    noJunc = onSite[0] & onSite[1] & onSite[2]
+    df_records[juncCols] = df_records[juncCols].astype(object)
+    df_records[pctCol] = df_records[pctCol].astype(object)
+    for copy, x in [(copy2, juncCols[1]), (copy3, juncCols[2])]:
+        df_records.loc[copy, juncCols[0]] = df_records.loc[copy, x]
+        df_records.loc[copy, pctCol] = 222
+        df_records.loc[copy, x] = 'copied to ' + juncCols[0]
+    df_records.loc[noJunc, juncCols[0]] = -1  # unable to find true 1st junction
+    df_records.loc[noJunc, pctCol] = -111
+    return df_main, df_records, merged, filtered
+
+
+# Keys of exons with a left/right alternative splice site, joined by joinColumns
+LASS_KEY = ['ExonChr', '1_ELS', 'ExonEnd', '1_ERE', 'ExonStrand']
+RASS_KEY = ['ExonChr', '1_ELS', 'ExonStart', '1_ERE', 'ExonStrand']
+
+
+def readExonInput(path, exid2loc, exid2strand):
+    """ y_exLR records of a y_input_v*.csv file with each exon's location and strand """
+    import pandas as pd
+    # Inclusion/Exclusion Junction Coordinates (No PSI info in these files)
+    # y_exLR = 1st/2nd/3rd highest EXCLUSION junctions (start/end/percentage) for left and right
+    with open(path, 'r') as f:
+        df_main = pd.read_csv(f, sep=',', index_col=False,
+                              names=['ExonID',
+                                     '1_ELS', '1_ELE', '1_ELP',
+                                     '2_ELS', '2_ELE', '2_ELP',
+                                     '3_ELS', '3_ELE', '3_ELP',
+                                     '1_ERS', '1_ERE', '1_ERP',
+                                     '2_ERS', '2_ERE', '2_ERP',
+                                     '3_ERS', '3_ERE', '3_ERP'])
+    df_main['ExonChr'] = df_main['ExonID'].map(exid2loc)
+    df_main[['ExonChr', 'ExonStart', 'ExonEnd']] = df_main['ExonChr'].str.split(r':|-', expand=True)
+    df_main['ExonStrand'] = df_main['ExonID'].map(exid2strand)
+    return df_main
+
+
+def classifyExons(argInfile, argSteps, sdir, exid2loc, exid2strand, PSImax, PSImin, LPSI, RPSI, keep=False,
+                  exons=None, context=None):
+    """
+    Classify the exons of one chromosome in six steps, passing each step's
+    table to the next in memory.  Returns a dict with the table of every step
+    that ran (df1_exLR ... df6_REFINE), df_constitutive and 'exons', the
+    parsed input of step0.  With keep=True the step tables are also written
+    to sdir as <name>.csv for debugging.
+
+    PSImax/PSImin: LPSImax1 ... RPSImax5 and LPSImin1 ... RPSImin5 of every
+    exon from rankPSI(), with exon IDs as index.
+    exons: 'exons' of an earlier run, e.g. pruned with dropExons(), to
+    classify instead of reading and parsing argInfile again.
+    context: classify the table as a block of a larger one (rsrBlocks), given
+    the properties of the whole table the steps depend on: 'first'/'last',
+    the sides ('LASS', 'RASS') whose first exon/last key group in sort order
+    is in the block; 'startStr', whether ExonStart is a string column (the
+    table has LASS records); 'minInt', the PSImin columns that are integer
+    (only -1); 'segments', the segment of every line of argInfile, kept in a
+    Segment column.  frames['records'] then holds each LASS/RASS/LINKED/
+    MUTEX record with the key it is numbered by in the whole table.
+    """
+    import numpy as np
     import pandas as pd
     pd.options.mode.chained_assignment = None
     import re
     import time
 
+    frames = {}
+    recordKeys = []
+
+    def checkpoint(name, df):
+        df = df.reset_index(drop=True)
+        if keep:
+            df.to_csv(sdir + '/' + name + '.csv', sep=',')
+        frames[name] = restoreTypes(df)
+
+    def addRecords(recordClass, recordIDs, segments, keys):
+        # Records are numbered by key within the block; the number breaks ties between blocks' keys
+        recordKeys.append(pd.DataFrame({'RecordID': recordIDs, 'Class': recordClass, 'Segment': segments,
+                                        'Key': [key + (x + 1,) for x, key in enumerate(keys)]}))
+
     chrstr = [x for x in re.split(r'[/\\]', sdir) if x != ''][-1] + '.'
 
     steps = [0, 0, 0, 0, 0, 0]
@@ -15,21 +227,8 @@ def classifyExons(argInfile, argSteps, sdir, exid2loc, exid2strand, PSImax, PSIm
     clst.write('rsr-classify.py run started on ' + time.strftime('%m/%d/%y, %H:%M:%S') + '\n')
 
     # Step0: Load y_exLR, Setup df_main, report constitutive
-    if steps[0] == 1:
-        # Inclusion/Exclusion Junction Coordinates (No PSI info in these files)
-        # y_exLR = 1st/2nd/3rd highest EXCLUSION junctions (start/end/percentage) for left and right
-        with open(sdir + '/' + argInfile, 'r') as f:
-            df_main = pd.read_csv(f, sep=',', index_col=False,
-                                  names=['ExonID',
-                                         '1_ELS', '1_ELE', '1_ELP',
-                                         '2_ELS', '2_ELE', '2_ELP',
-                                         '3_ELS', '3_ELE', '3_ELP',
-                                         '1_ERS', '1_ERE', '1_ERP',
-                                         '2_ERS', '2_ERE', '2_ERP',
-                                         '3_ERS', '3_ERE', '3_ERP'])
-        df_main['ExonChr'] = df_main['ExonID'].map(exid2loc)
-        df_main[['ExonChr', 'ExonStart', 'ExonEnd']] = df_main['ExonChr'].str.split(r':|-', expand=True)
-        df_main['ExonStrand'] = df_main['ExonID'].map(exid2strand)
+    if steps[0] == 1 and exons is None:
+        df_main = readExonInput(sdir + '/' + argInfile, exid2loc, exid2strand)
         df_main['ExonClass'] = 'Unclassified'
         df_main['MergedCount'] = 0
         df_main['MetadataLASS'] = 'None'
@@ -37,427 +236,290 @@ def classifyExons(argInfile, argSteps, sdir, exid2loc, exid2strand, PSImax, PSIm
 
         # Add columns for detecting alt splice sites that should be linked together
         # LASS = Left Alt Splice Sites, RASS = Right Alt Splice Sites
-        df_main['LASS'] = df_main[['ExonChr', '1_ELS', 'ExonEnd', '1_ERE', 'ExonStrand']].astype(str).apply(
-            lambda x: ':'.join(x), axis=1)
-        df_main['RASS'] = df_main[['ExonChr', '1_ELS', 'ExonStart', '1_ERE', 'ExonStrand']].astype(str).apply(
-            lambda x: ':'.join(x), axis=1)
-
-        df_main['PSImax'] = df_main['ExonID'].map(PSImax)
-        df_main['PSImin'] = df_main['ExonID'].map(PSImin)
-        df_main[['LPSImax1', 'LPSImax2', 'LPSImax3', 'LPSImax4', 'LPSImax5',
-                 'RPSImax1', 'RPSImax2', 'RPSImax3', 'RPSImax4', 'RPSImax5']] = df_main['PSImax'].str.split(',',
-                                                                                                            expand=True)
-        df_main[['LPSImin1', 'LPSImin2', 'LPSImin3', 'LPSImin4', 'LPSImin5',
-                 'RPSImin1', 'RPSImin2', 'RPSImin3', 'RPSImin4', 'RPSImin5']] = df_main['PSImin'].str.split(',',
-                                                                                                            expand=True)
-        df_constitutive = df_main.copy()
-        df_main = df_main.drop(['PSImax', 'PSImin',
-                                'LPSImax2', 'LPSImax3', 'LPSImax4', 'LPSImax5',
+        df_main['LASS'] = joinColumns(df_main, LASS_KEY)
+        df_main['RASS'] = joinColumns(df_main, RASS_KEY)
+
+        df_main[list(PSImax.columns)] = PSImax.reindex(df_main['ExonID']).values
+        df_main[list(PSImin.columns)] = PSImin.reindex(df_main['ExonID']).values
+        # Read back from a csv file, a column of -1 (too few junctions) alone is integer
+        for col in ['LPSImin1', 'RPSImin1']:
+            if (df_main[col] == -1).all() if context is None else col in context['minInt']:
+                df_main[col] = df_main[col].astype(np.int64)
+        # Constitutive exons: both PSImin1 and PSImin5 reach minPSI on each side that has an
+        # exclusion junction (1_ELP/1_ERP = 999 marks a side without one)
+        minPSI = 90
+        noLeft = (df_main['1_ELP'].astype(str) == '999').values
+        noRight = (df_main['1_ERP'].astype(str) == '999').values
+        with np.errstate(invalid='ignore'):
+            leftPass = (df_main['LPSImin1'].values.astype(float) >= minPSI) & \
+                       (df_main['LPSImin5'].values.astype(float) >= minPSI)
+            rightPass = (df_main['RPSImin1'].values.astype(float) >= minPSI) & \
+                        (df_main['RPSImin5'].values.astype(float) >= minPSI)
+        constitutive = np.where(noLeft, noRight | rightPass, np.where(noRight, leftPass, leftPass & rightPass))
+        df_constitutive = df_main.loc[constitutive, ['ExonID', 'ExonChr', 'ExonStart', 'ExonEnd',
+                                                     '1_ELS', '1_ERE', 'ExonStrand']]
+        df_constitutive = df_constitutive.reset_index(drop=True)
+        df_constitutive['LeftPSIstr'] = LPSI.lookup(df_constitutive['ExonID'].values)
+        df_constitutive['RightPSIstr'] = RPSI.lookup(df_constitutive['ExonID'].values)
+
+        df_main = df_main.drop(['LPSImax2', 'LPSImax3', 'LPSImax4', 'LPSImax5',
                                 'RPSImax2', 'RPSImax3', 'RPSImax4', 'RPSImax5',
                                 'LPSImin2', 'LPSImin3', 'LPSImin4', 'LPSImin5',
                                 'RPSImin2', 'RPSImin3', 'RPSImin4', 'RPSImin5'], axis=1)
-        df_main = df_main.reset_index(drop=True)
-        df_main.to_csv(sdir + '/df1_exLR.csv', sep=',')
-
-        keepList = []
-        minPSI = 90
-        for ix in df_constitutive.index:
-            if str(df_constitutive['1_ELP'][ix]) == '999':
-                if str(df_constitutive['1_ERP'][ix]) == '999':
-                    keepList.append(ix)
-                elif float(df_constitutive['RPSImin1'][ix]) >= minPSI:
-                    if float(df_constitutive['RPSImin5'][ix]) >= minPSI:
-                        keepList.append(ix)
-            elif str(df_constitutive['1_ERP'][ix]) == '999':
-                if str(df_constitutive['1_ELP'][ix]) == '999':
-                    keepList.append(ix)
-                elif float(df_constitutive['LPSImin1'][ix]) >= minPSI:
-                    if float(df_constitutive['LPSImin5'][ix]) >= minPSI:
-                        keepList.append(ix)
-            elif float(df_constitutive['LPSImin1'][ix]) >= minPSI:
-                if float(df_constitutive['LPSImin5'][ix]) >= minPSI:
-                    if float(df_constitutive['RPSImin1'][ix]) >= minPSI:
-                        if float(df_constitutive['RPSImin5'][ix]) >= minPSI:
-                            keepList.append(ix)
-
-        df_constitutive = df_constitutive.loc[keepList]
-        df_constitutive = df_constitutive.reset_index(drop=True)
-        df_constitutive = df_constitutive[['ExonID', 'ExonChr', 'ExonStart', 'ExonEnd',
-                                           '1_ELS', '1_ERE', 'ExonStrand']]
-        df_constitutive['LeftPSIstr'] = 'None'
-        df_constitutive['RightPSIstr'] = 'None'
-        for ix in df_constitutive.index:
-            df_constitutive['LeftPSIstr'][ix] = LPSI[df_constitutive['ExonID'][ix]]
-            df_constitutive['RightPSIstr'][ix] = RPSI[df_constitutive['ExonID'][ix]]
-        df_constitutive.to_csv(sdir + '/df_constitutive.csv')
+        if context is not None:
+            df_main['Segment'] = context['segments']
+        exons = (df_main, df_constitutive)
+    if steps[0] == 1:
+        frames['exons'] = exons
+        checkpoint('df1_exLR', exons[0])
+        frames['df_constitutive'] = exons[1]
 
     # Step1: Create LASS/RASS Records
     if steps[1] == 1:
-        with open(sdir + '/df1_exLR.csv', 'r') as f:
-            df_main = pd.read_csv(f, sep=',', index_col=0)
+        df_main = frames['df1_exLR'].copy()
 
-        # Make copy of df_main to append LASS/RASS records
+        # Copy of df_main to record merged/filtered exons in; LASS/RASS records are added at the end
         df_LASSRASS = df_main.copy()
         PSIthreshold = 25  # Minimum LPSI (for LASS) or RPSI (for RASS) for an exon to be merged
-        # ------------------------------------------------
-        # ***************** LASS SECTION *****************
-        # ------------------------------------------------
-        # Merge associated alt splice site exons into single cassette records
-        df_main = df_main.sort_values(by=['LASS', 'LPSImax1'], ascending=[True, False])
-        df_main = df_main.reset_index(drop=True)
-        ExonList = [df_main['ExonID'][0]]  # Track ExonIDs to merge
-        RowSlice = df_main.loc[[0, 1]]  # Need two rows to stop conversion to series
-        RowSlice.index = ['a', 'b']
-        RecordCounter = 1  # Tracks new cassette exon records derived from merged records
-        ex2ix = {}  # Dictionary to convert ExonID to df_main index
-        for ix in range(len(df_main.index)):
-            ex2ix[df_main['ExonID'][ix]] = ix
-        LRex2ix = {}  # Dictionary to convert ExonID to df_LASSRASS index
-        for ix in range(len(df_LASSRASS.index)):
-            LRex2ix[df_LASSRASS['ExonID'][ix]] = ix
-
-        for ix in range(1, len(df_main.index)):
-            if df_main['LASS'][ix] == RowSlice['LASS']['a']:
-                if df_main['LPSImax1'][ix] >= PSIthreshold:
-                    ExonList.append(df_main['ExonID'][ix])
-                else:
-                    eid = df_main['ExonID'][ix]
-                    df_LASSRASS['ExonClass'][LRex2ix[eid]] = 'Filtered:LowPSI:LASS'
-            else:
-                if len(ExonList) > 1:
-                    clst.write('LASS recorded at index ' + str(ix) + time.strftime(', %m/%d/%y, %H:%M:%S') + '\n')
-
-                    # Append record to df_main
-                    ExonStartSites = []
-                    ELElist = []
-                    for eid in ExonList:
-                        exst = int(df_main['ExonStart'][ex2ix[eid]])
-                        ExonStartSites.append(exst)
-                        ELElist.append(exst - 1)
-                        df_LASSRASS['ExonClass'][LRex2ix[eid]] = 'Merged:' + 'LASS_' + chrstr + str(
-                            RecordCounter).zfill(7)
-                        df_LASSRASS['MergedCount'][LRex2ix[eid]] = df_LASSRASS['MergedCount'][LRex2ix[eid]] + 1
-                    RowSlice['ExonStart']['a'] = '|'.join(str(x) for x in ExonStartSites)
-                    RowSlice['ExonID']['a'] = 'LASS_' + chrstr + str(RecordCounter).zfill(7)
-                    RowSlice['MetadataLASS']['a'] = ','.join(ExonList)
-                    RowSlice['ExonClass']['a'] = 'LASS'
-
-                    looplist = ['1_ELE', '2_ELE', '3_ELE']
-                    for x in looplist:
-                        if int(RowSlice[x]['a']) not in ELElist:
-                            if x != '1_ELE':
-                                RowSlice['1_ELE']['a'] = RowSlice[x]['a']
-                                RowSlice['1_ELP']['a'] = 222
-                                RowSlice[x]['a'] = 'copied to 1_ELE'
-                            break
-                        if x == looplist[-1]:
-                            RowSlice['1_ELE']['a'] = -1  # unable to find true 1_ELE
-                            RowSlice['1_ELP']['a'] = -111
-
-                    df_LASSRASS = df_LASSRASS.append(RowSlice.loc['a'])
-                    RecordCounter = RecordCounter + 1
-                    # Setup next record
-                    ExonList = [df_main['ExonID'][ix]]
-                    RowSlice.loc['a'] = df_main.loc[ix]
-                    RowSlice.index = ['a', 'b']
-                    if df_main['LPSImax1'][ix] < PSIthreshold:
-                        RowSlice['LASS']['a'] = 'LowPSI'
-                else:
-                    # Setup next record, do not append
-                    ExonList = [df_main['ExonID'][ix]]
-                    RowSlice.loc['a'] = df_main.loc[ix]
-                    RowSlice.index = ['a', 'b']
-                    if df_main['LPSImax1'][ix] < PSIthreshold:
-                        RowSlice['LASS']['a'] = 'LowPSI'
-
-        # ------------------------------------------------
-        # ***************** RASS SECTION *****************
-        # ------------------------------------------------
-        # Merge associated alt splice site exons into single cassette records
-        df_main = df_main.sort_values(by=['RASS', 'RPSImax1'], ascending=[True, False])
-        df_main = df_main.reset_index(drop=True)
-        ExonList = [df_main['ExonID'][0]]  # Track ExonIDs to merge
-        RowSlice = df_main.loc[[0, 1]]  # Need two rows to stop conversion to series
-        RowSlice.index = ['a', 'b']
-        RecordCounter = 1  # Tracks new cassette exon records derived from merged records
-        ex2ix = {}  # Dictionary to convert ExonID to df_main index
-        for ix in range(len(df_main.index)):
-            ex2ix[df_main['ExonID'][ix]] = ix
-        LRex2ix = {}  # Dictionary to convert ExonID to df_LASSRASS index
-        for ix in range(len(df_LASSRASS.index)):
-            LRex2ix[df_LASSRASS['ExonID'][ix]] = ix
-
-        for ix in range(1, len(df_main.index)):
-            if df_main['RASS'][ix] == RowSlice['RASS']['a']:
-                if df_main['RPSImax1'][ix] >= PSIthreshold:
-                    ExonList.append(df_main['ExonID'][ix])
-                else:
-                    eid = df_main['ExonID'][ix]
-                    df_LASSRASS['ExonClass'][LRex2ix[eid]] = 'Filtered:LowPSI:RASS'
-            else:
-                if len(ExonList) > 1:
-                    clst.write('RASS recorded at index ' + str(ix) + time.strftime(', %m/%d/%y, %H:%M:%S') + '\n')
-
-                    # Append record to df_main
-                    ExonEndSites = []
-                    ERSlist = []
-                    for eid in ExonList:
-                        exen = int(df_main['ExonEnd'][ex2ix[eid]])
-                        ExonEndSites.append(exen)
-                        ERSlist.append(exen + 1)
-                        df_LASSRASS['ExonClass'][LRex2ix[eid]] = 'Merged:' + 'RASS_' + chrstr + str(
-                            RecordCounter).zfill(7)
-                        df_LASSRASS['MergedCount'][LRex2ix[eid]] = df_LASSRASS['MergedCount'][LRex2ix[eid]] + 1
-                    RowSlice['ExonEnd']['a'] = '|'.join(str(x) for x in ExonEndSites)
-                    RowSlice['ExonID']['a'] = 'RASS_' + chrstr + str(RecordCounter).zfill(7)
-                    RowSlice['MetadataRASS']['a'] = ','.join(ExonList)
-                    RowSlice['ExonClass']['a'] = 'RASS'
-
-                    looplist = ['1_ERS', '2_ERS', '3_ERS']
-                    for x in looplist:
-                        if int(RowSlice[x]['a']) not in ERSlist:
-                            if x != '1_ERS':
-                                RowSlice['1_ERS']['a'] = RowSlice[x]['a']
-                                RowSlice['1_ERP']['a'] = 222
-                                RowSlice[x]['a'] = 'copied to 1_ERS'
-                            break
-                        if x == looplist[-1]:
-                            RowSlice['1_ERS']['a'] = -1  # unable to find true 1_ERS
-                            RowSlice['1_ERP']['a'] = -111
-
-                    df_LASSRASS = df_LASSRASS.append(RowSlice.loc['a'])
-                    RecordCounter = RecordCounter + 1
-                    # Setup next record
-                    ExonList = [df_main['ExonID'][ix]]
-                    RowSlice.loc['a'] = df_main.loc[ix]
-                    RowSlice.index = ['a', 'b']
-                    if df_main['RPSImax1'][ix] < PSIthreshold:
-                        RowSlice['RASS']['a'] = 'LowPSI'
-                else:
-                    # Setup next record, do not append
-                    ExonList = [df_main['ExonID'][ix]]
-                    RowSlice.loc['a'] = df_main.loc[ix]
-                    RowSlice.index = ['a', 'b']
-                    if df_main['RPSImax1'][ix] < PSIthreshold:
-                        RowSlice['RASS']['a'] = 'LowPSI'
-
+        ex2ix = pd.Series(np.arange(len(df_LASSRASS.index)), index=df_LASSRASS['ExonID'])
+        ex2ix = ex2ix[~ex2ix.index.duplicated(keep='last')]
+        ExonClass = df_LASSRASS['ExonClass'].values.copy()
+        MergedCount = df_LASSRASS['MergedCount'].values.copy()
+        records = []
+        # RASS groups are formed on the LASS-sorted table, so ties keep the same order
+        for side in ['LASS', 'RASS']:
+            df_main, df_records, merged, filtered = mergeSpliceSites(
+                df_main, side, chrstr, PSIthreshold, clst,
+                first=context is None or side in context['first'], last=context is None or side in context['last'])
+            ExonClass[ex2ix[filtered.index].values] = filtered.values
+            ExonClass[ex2ix[merged.index].values] = merged.values
+            np.add.at(MergedCount, ex2ix[merged.index].values, 1)
+            records.append(df_records)
+            if context is not None:
+                addRecords(side, df_records['ExonID'].values, df_records['Segment'].values,
+                           [(x,) for x in df_records[side].tolist()])
+        df_LASSRASS['ExonClass'] = ExonClass
+        df_LASSRASS['MergedCount'] = MergedCount
+
+        df_LASSRASS = pd.concat([df_LASSRASS] + records)
         df_LASSRASS = df_LASSRASS.drop(['LASS', 'RASS'], axis=1)
         df_main = df_LASSRASS.reset_index(drop=True)
 
         df_main = df_main.reset_index(drop=True)
-        df_main.to_csv(sdir + '/df2_LASSRASS.csv', sep=',')
+        checkpoint('df2_LASSRASS', df_main)
 
     # Step2: Find Cassette Exons
     if steps[2] == 1:
-        with open(sdir + '/df2_LASSRASS.csv', 'r') as f:
-            df_main = pd.read_csv(f, sep=',', index_col=0)
+        df_main = frames['df2_LASSRASS'].copy()
         df_main['Cassette'] = 'No'
         df_main = df_main.reset_index(drop=True)
 
-        for ix in range(len(df_main.index)):
-            if ix % 1000 == 0:
-                clst.write('CASSETTE: ' + str(ix) + time.strftime(', %m/%d/%y, %H:%M:%S') + '\n')
-            if df_main['ExonClass'][ix] in ['Unclassified', 'LASS', 'RASS']:
-                if df_main['1_ELS'][ix] == df_main['1_ERS'][ix] and df_main['1_ELE'][ix] == df_main['1_ERE'][ix]:
-                    df_main['Cassette'][ix] = 'Yes'
-                    df_main['ExonClass'][ix] = 'Cassette'
-        df_main = df_main.reset_index(drop=True)
-        df_main.to_csv(sdir + '/df3_CASSETTE.csv', sep=',')
+        for ix in range(0, len(df_main.index), 1000):
+            clst.write('CASSETTE: ' + str(ix) + time.strftime(', %m/%d/%y, %H:%M:%S') + '\n')
+        # Cassette exons share their left and right 1st exclusion junction
+        cassette = df_main['ExonClass'].isin(['Unclassified', 'LASS', 'RASS']) & \
+            (df_main['1_ELS'] == df_main['1_ERS']) & (df_main['1_ELE'] == df_main['1_ERE'])
+        df_main.loc[cassette, 'Cassette'] = 'Yes'
+        df_main.loc[cassette, 'ExonClass'] = 'Cassette'
+        checkpoint('df3_CASSETTE', df_main)
 
     # Step3: Find Linked Exons
     if steps[3] == 1:
-        with open(sdir + '/df3_CASSETTE.csv', 'r') as f:
-            df_main = pd.read_csv(f, sep=',', index_col=0)
-        df_main['LINKLEFT'] = df_main[['ExonChr', '1_ELS', '1_ELE', 'ExonStrand']].astype(str).apply(
-            lambda x: ':'.join(x), axis=1)
-        df_main['LINKRIGHT'] = df_main[['ExonChr', '1_ERS', '1_ERE', 'ExonStrand']].astype(str).apply(
-            lambda x: ':'.join(x), axis=1)
+        df_main = frames['df3_CASSETTE'].copy()
+        df_main['LINKLEFT'] = joinColumns(df_main, ['ExonChr', '1_ELS', '1_ELE', 'ExonStrand'])
+        df_main['LINKRIGHT'] = joinColumns(df_main, ['ExonChr', '1_ERS', '1_ERE', 'ExonStrand'])
         df_main['MetadataLINKED'] = 'None'
 
         df_main = df_main.sort_values(['ExonChr', '1_ERS', '1_ELS', '1_ERE'], ascending=[True, True, True, True])
-        # Sorting needed to ensure order is correct so that no record is inadvertently skipped in comparison to 'LINKRIGHT'
+        # Sorting fixes the order LINKED records are numbered in, and a right exon is only
+        # paired with left exons sorted before it
         df_main = df_main.reset_index(drop=True)
 
-        # -------------------------------------------------------------
-        # Loop over each LINKLEFT row and search for match in LINKRIGHT
-        # -------------------------------------------------------------
-        RowSlice = df_main.loc[[0, 1]]
-        RowSlice.index = ['a', 'b']
-        RecordCounter = 1
-        ex2ix = {}
-        for ix in range(len(df_main.index)):
-            ex2ix[df_main['ExonID'][ix]] = ix
-        # Create dict to set index bounds for LINKRIGHT match search
-        # Inclusive so if x = chrbounds['chr1'].split(','), range( x[0], x[1]+1 )
-        chrbounds = {}
-        chrid = df_main['ExonChr'][0]
-        chrix = [0, 1]
-        for ix in range(len(df_main.index)):
-            if df_main['ExonChr'][ix] != chrid:
-                chrix[1] = ix - 1
-                chrbounds[chrid] = ','.join(str(x) for x in chrix)
-                chrid = df_main['ExonChr'][ix]
-                chrix[0] = ix
-            if ix == len(df_main.index) - 1:
-                chrix[1] = ix
-                chrbounds[chrid] = ','.join(str(x) for x in chrix)
-
+        # ---------------------------------------------------------------
+        # Join each LINKLEFT key to the matching LINKRIGHT keys and keep
+        # the pairs where the right exon starts after the left exon ends
+        # ---------------------------------------------------------------
         PSIthreshold = 10
-        for ix in range(len(df_main.index)):
-            if df_main['ExonClass'][ix] in ['Unclassified', 'LASS', 'RASS']:
-                if df_main['Cassette'][ix] == 'No':
-                    # Need [df_main['1_ELE'][ix] != -1] and especially [df_main['1_ERS'][ix] != -1]
-                    # because 1_ERS=-1 messes up the purpose of 1_ERS sorting and results in slow searching
-                    if df_main['1_ELP'][ix] != 999 and df_main['1_ELE'][ix] != -1 and df_main['1_ERS'][ix] != -1:
-                        if df_main['LPSImax1'][ix] > PSIthreshold:
-                            leftquery = df_main['LINKLEFT'][ix]
-                            srange = [int(x) for x in chrbounds[df_main['ExonChr'][ix]].split(',')]
-                            for ix2 in range(ix, srange[1] + 1):
-                                leftExonEnd = df_main['ExonEnd'][ix]
-                                if type(leftExonEnd) is str:
-                                    leftExonEnd = [int(x) for x in df_main['ExonEnd'][ix].split('|')]
-                                    leftExonEnd = max(leftExonEnd)
-                                if int(df_main['1_ERS'][ix2]) > leftExonEnd:
-                                    break
-                                elif df_main['ExonClass'][ix2] in ['Unclassified', 'LASS', 'RASS']:
-                                    if df_main['Cassette'][ix2] == 'No':
-                                        if df_main['1_ERP'][ix2] != 999 and df_main['1_ERS'][ix2] != -1:
-                                            if df_main['RPSImax1'][ix2] > PSIthreshold:
-                                                v1 = df_main['ExonStart'][ix2]
-                                                if type(v1) is str:
-                                                    v1 = [int(x) for x in v1.split('|')]
-                                                    v1 = min(v1)
-                                                v2 = df_main['ExonEnd'][ix]
-                                                if type(v2) is str:
-                                                    v2 = [int(x) for x in v2.split('|')]
-                                                    v2 = max(v2)
-                                                if v1 > v2:
-                                                    if df_main['LINKRIGHT'][ix2] == leftquery:
-                                                        RowSlice.loc['a'] = df_main.loc[ix]
-                                                        RowSlice['MetadataLINKED']['a'] = df_main['ExonID'][
-                                                                                              ix] + ',' + \
-                                                                                          df_main['ExonID'][ix2]
-                                                        df_main['MetadataLINKED'][
-                                                            ix] = 'Merged:LINKED_' + chrstr + str(
-                                                            RecordCounter).zfill(7)
-                                                        df_main['MetadataLINKED'][
-                                                            ix2] = 'Merged:LINKED_' + chrstr + str(
-                                                            RecordCounter).zfill(7)
-                                                        RowSlice['ExonEnd']['a'] = df_main['ExonEnd'][ix2]
-                                                        RowSlice['1_ERS']['a'] = df_main['1_ELS'][ix]
-                                                        RowSlice['1_ERE']['a'] = df_main['1_ELE'][ix]
-                                                        RowSlice['ExonID']['a'] = 'LINKED_' + chrstr + str(
-                                                            RecordCounter).zfill(7)
-                                                        RowSlice['ExonClass']['a'] = 'LINKED'
-                                                        df_main = df_main.append(RowSlice.loc['a'])
-                                                        clst.write('LINKED recorded at ' + str(ix) + ', ' +
-                                                                   str(RowSlice['ExonChr']['a']) + ':' +
-                                                                   str(RowSlice['ExonStart']['a']) + '-' +
-                                                                   str(RowSlice['ExonEnd']['a']) +
-                                                                   time.strftime(', %m/%d/%y, %H:%M:%S') + '\n')
-                                                        RecordCounter = RecordCounter + 1
-
-        # Drop duplicate LINKED records
-        dropList = []
-        prev = ''
+        candidate = df_main['ExonClass'].isin(['Unclassified', 'LASS', 'RASS']) & (df_main['Cassette'] == 'No')
+        # 1_ELE/1_ERS = -1 mark exons without a true 1st exclusion junction
+        left = candidate & (df_main['1_ELP'] != 999) & (df_main['1_ELE'] != -1) & (df_main['1_ERS'] != -1) & \
+            (df_main['LPSImax1'] > PSIthreshold)
+        right = candidate & (df_main['1_ERP'] != 999) & (df_main['1_ERS'] != -1) & (df_main['RPSImax1'] > PSIthreshold)
+        df_left = pd.DataFrame({'ix': np.flatnonzero(left.values), 'key': df_main['LINKLEFT'].values[left.values]})
+        df_right = pd.DataFrame({'ix2': np.flatnonzero(right.values), 'key': df_main['LINKRIGHT'].values[right.values]})
+        df_pairs = df_left.merge(df_right, on='key', how='inner')
+        leftExonEnd = spliceSites(df_main['ExonEnd'], max)
+        rightExonStart = spliceSites(df_main['ExonStart'], min)
+        ix, ix2 = df_pairs['ix'].values, df_pairs['ix2'].values
+        # The right exon's 1_ERS is the left exon's 1_ELS, which has to lie before the left exon's end
+        matched = (ix2 >= ix) & (df_main['1_ERS'].values[ix2] <= leftExonEnd[ix]) & \
+               (rightExonStart[ix2] > leftExonEnd[ix])
+        order = np.lexsort((ix2[matched], ix[matched]))
+        ix, ix2 = ix[matched][order], ix2[matched][order]
+
+        LINKEDid = np.array(['LINKED_' + chrstr + str(x).zfill(7) for x in range(1, len(ix) + 1)], dtype=object)
+        df_linked = df_main.iloc[ix].copy()
+        df_linked['MetadataLINKED'] = df_main['ExonID'].values[ix] + ',' + df_main['ExonID'].values[ix2]
+        df_linked['ExonEnd'] = df_main['ExonEnd'].values[ix2]
+        df_linked['1_ERS'] = df_main['1_ELS'].values[ix]
+        df_linked['1_ERE'] = df_main['1_ELE'].values[ix]
+        df_linked['ExonID'] = LINKEDid
+        df_linked['ExonClass'] = 'LINKED'
+        # LINKED records are numbered in the sort order of their left exons
+        if context is not None:
+            addRecords('LINKED', LINKEDid, df_main['Segment'].values[ix],
+                       list(zip(df_main['1_ERS'].values[ix].tolist(), df_main['1_ELS'].values[ix].tolist(),
+                                df_main['1_ERE'].values[ix].tolist())))
+        for x in range(len(ix)):
+            clst.write('LINKED recorded at ' + str(ix[x]) + ', ' + str(df_linked['ExonChr'].values[x]) + ':' +
+                       str(df_linked['ExonStart'].values[x]) + '-' + str(df_linked['ExonEnd'].values[x]) +
+                       time.strftime(', %m/%d/%y, %H:%M:%S') + '\n')
+
+        # Exons in several pairs are marked with their last LINKED record
+        MetadataLINKED = df_main['MetadataLINKED'].values.copy()
+        merged = np.concatenate([ix, ix2])
+        mergedID = np.concatenate([np.arange(len(ix)), np.arange(len(ix))])
+        last = np.lexsort((mergedID, merged))
+        MetadataLINKED[merged[last]] = 'Merged:' + LINKEDid[mergedID[last]]
+        df_main['MetadataLINKED'] = MetadataLINKED
+
+        # Drop LINKED records duplicating the location of the previous one
+        location = joinColumns(df_linked, ['ExonChr', 'ExonStart', 'ExonEnd', 'ExonStrand']).values
+        duplicated = np.zeros(len(location), dtype=bool)
+        duplicated[1:] = location[1:] == location[:-1]
+        df_main = pd.concat([df_main, df_linked[~duplicated]])
+
+        df_main = df_main.drop(['LINKLEFT', 'LINKRIGHT'], axis=1)
         df_main = df_main.reset_index(drop=True)
-        df_main['LINKDUPLICATED'] = df_main[['ExonChr', 'ExonStart', 'ExonEnd', 'ExonStrand']].astype(str).apply(
-            lambda x: ':'.join(x), axis=1)
-        for ix in range(len(df_main.index)):
-            if df_main['ExonClass'][ix] == 'LINKED':
-                if df_main['LINKDUPLICATED'][ix] == prev:
-                    dropList.append(ix)
-                else:
-                    prev = df_main['LINKDUPLICATED'][ix]
-        df_main.drop(df_main.index[dropList], inplace=True)
-
-        df_main = df_main.drop(['LINKLEFT', 'LINKRIGHT', 'LINKDUPLICATED'], axis=1)
-        df_main = df_main.reset_index(drop=True)
-        df_main.to_csv(sdir + '/df4_LINKED.csv', sep=',')
+        checkpoint('df4_LINKED', df_main)
 
     # Step4: Find Mutually Exclusive Regions
     if steps[4] == 1:
-        with open(sdir + '/df4_LINKED.csv', 'r') as f:
-            df_main = pd.read_csv(f, sep=',', index_col=0)
+        df_main = frames['df4_LINKED'].copy()
         df_main['MetadataMUTEX'] = 'None'
-        df_main['MUTEX'] = df_main[['ExonChr', '1_ELS', '1_ERE', 'ExonStrand']].astype(str).apply(
-            lambda x: ':'.join(x), axis=1)
-        df_main = df_main.sort_values(by=['MUTEX', 'ExonStart'], ascending=[True, True])
+        df_main['MUTEX'] = joinColumns(df_main, ['ExonChr', '1_ELS', '1_ERE', 'ExonStrand'])
+        # A block sorts ExonStart as the whole table does: as strings once it has LASS records
+        df_main['MUTEXSTART'] = df_main['ExonStart']
+        if context is not None and context['startStr']:
+            df_main['MUTEXSTART'] = df_main['ExonStart'].astype(str)
+        df_main = df_main.sort_values(by=['MUTEX', 'MUTEXSTART'], ascending=[True, True])
         df_main = df_main.reset_index(drop=True)
 
-        RecordCounter = 1
-        MUTEXid = 'empty'
-        ixList = []
         PSIthreshold = 30
-
-        for ix in range(len(df_main.index)):
-            if ix % 1000 == 0:
-                clst.write('MUTEX: ' + str(ix) + time.strftime(', %m/%d/%y, %H:%M:%S') + '\n')
-            if df_main['MUTEX'][ix] == MUTEXid:
-                cond1 = df_main['ExonClass'][ix] not in ['Cassette', 'LASS', 'RASS', 'LINKED']
-                cond2 = df_main['MetadataLASS'][ix] == 'None'
-                cond3 = df_main['MetadataRASS'][ix] == 'None'
-                if cond1 and cond2 and cond3:
-                    maxPSI = min([int(df_main['LPSImax1'][ix]), int(df_main['RPSImax1'][ix])])
-                    if maxPSI > PSIthreshold:
-                        ixList.append(ix)
-            else:
-                cond1 = df_main['ExonClass'][ix] not in ['Cassette', 'LASS', 'RASS', 'LINKED']
-                cond2 = df_main['MetadataLASS'][ix] == 'None'
-                cond3 = df_main['MetadataRASS'][ix] == 'None'
-                if cond1 and cond2 and cond3:
-                    if len(ixList) > 1:
-                        for a in range(len(ixList)-1):
-                            for b in list(range(len(ixList)))[a:]:
-                                mutex1 = int(df_main['1_ELE'][ixList[a]]) == int(df_main['ExonStart'][ixList[b]]) - 1
-                                mutex2 = int(df_main['1_ELE'][ixList[b]]) == int(df_main['ExonStart'][ixList[a]]) - 1
-                                mutex3 = int(df_main['1_ERS'][ixList[a]]) == int(df_main['ExonEnd'][ixList[b]]) + 1
-                                mutex4 = int(df_main['1_ERS'][ixList[b]]) == int(df_main['ExonEnd'][ixList[a]]) + 1
-                                mutex5 = int(df_main['ExonEnd'][ixList[a]]) < int(df_main['ExonStart'][ixList[b]])
-                                if mutex1 and mutex2 and mutex3 and mutex4 and mutex5:
-                                    df_main['MetadataMUTEX'][ixList[a]] = 'MUTEX_' + chrstr + str(RecordCounter).zfill(7)
-                                    df_main['MetadataMUTEX'][ixList[b]] = 'MUTEX_' + chrstr + str(RecordCounter).zfill(7)
-                                    RecordCounter = RecordCounter + 1
-                        MUTEXid = df_main['MUTEX'][ix]
-                        ixList = [ix]
-                    else:
-                        # Setup next record
-                        MUTEXid = df_main['MUTEX'][ix]
-                        ixList = [ix]
-            if ix == len(df_main.index) - 1:
-                if len(ixList) > 1:
-                    for a in range(len(ixList) - 1):
-                        for b in list(range(len(ixList)))[a:]:
-                            mutex1 = int(df_main['1_ELE'][ixList[a]]) == int(df_main['ExonStart'][ixList[b]]) - 1
-                            mutex2 = int(df_main['1_ELE'][ixList[b]]) == int(df_main['ExonStart'][ixList[a]]) - 1
-                            mutex3 = int(df_main['1_ERS'][ixList[a]]) == int(df_main['ExonEnd'][ixList[b]]) + 1
-                            mutex4 = int(df_main['1_ERS'][ixList[b]]) == int(df_main['ExonEnd'][ixList[a]]) + 1
-                            mutex5 = int(df_main['ExonEnd'][ixList[a]]) < int(df_main['ExonStart'][ixList[b]])
-                            if mutex1 and mutex2 and mutex3 and mutex4 and mutex5:
-                                df_main['MetadataMUTEX'][ixList[a]] = 'MUTEX_' + chrstr + str(RecordCounter).zfill(7)
-                                df_main['MetadataMUTEX'][ixList[b]] = 'MUTEX_' + chrstr + str(RecordCounter).zfill(7)
-                                RecordCounter = RecordCounter + 1
-        df_main = df_main.drop('MUTEX', axis=1)
+        n = len(df_main.index)
+        for ix in range(0, n, 1000):
+            clst.write('MUTEX: ' + str(ix) + time.strftime(', %m/%d/%y, %H:%M:%S') + '\n')
+
+        # Each MUTEX key forms one group, started by its first exon not yet in a cassette,
+        # LASS/RASS or LINKED record; later exons of the key join when both PSIs pass
+        eligible = ~df_main['ExonClass'].isin(['Cassette', 'LASS', 'RASS', 'LINKED']).values & \
+            (df_main['MetadataLASS'] == 'None').values & (df_main['MetadataRASS'] == 'None').values
+        with np.errstate(invalid='ignore'):
+            psiPass = (np.trunc(df_main['LPSImax1'].values.astype(float)) > PSIthreshold) & \
+                      (np.trunc(df_main['RPSImax1'].values.astype(float)) > PSIthreshold)
+        key = df_main['MUTEX'].values
+        pos = np.arange(n)
+        keyStart = np.ones(n, dtype=bool)
+        keyStart[1:] = key[1:] != key[:-1]
+        keyStart = np.flatnonzero(keyStart)
+        groupID = np.repeat(np.arange(len(keyStart)), np.diff(np.append(keyStart, n)))
+        head = np.minimum.reduceat(np.where(eligible, pos, n), keyStart)[groupID] if n else pos
+        rows = np.flatnonzero(eligible & ((pos == head) | ((pos > head) & psiPass)))
+
+        # Exons a < b of a group are mutually exclusive when each one's 1st exclusion junctions
+        # end/start at the other's boundaries and a ends before b starts
+        ExonStart = df_main['ExonStart'].values[rows].astype(np.int64)
+        ExonEnd = df_main['ExonEnd'].values[rows].astype(np.int64)
+        ELE = df_main['1_ELE'].values[rows].astype(np.int64)
+        ERS = df_main['1_ERS'].values[rows].astype(np.int64)
+        df_a = pd.DataFrame({'a': rows, 'group': groupID[rows], 'end': ExonEnd,
+                             'k1': ELE + 1, 'k2': ExonStart - 1, 'k3': ERS - 1, 'k4': ExonEnd + 1})
+        df_b = pd.DataFrame({'b': rows, 'group': groupID[rows], 'start': ExonStart,
+                             'k1': ExonStart, 'k2': ELE, 'k3': ExonEnd, 'k4': ERS})
+        df_pairs = df_a.merge(df_b, on=['group', 'k1', 'k2', 'k3', 'k4'], how='inner')
+        df_pairs = df_pairs[(df_pairs['a'] < df_pairs['b']) & (df_pairs['end'] < df_pairs['start'])]
+        df_pairs = df_pairs.sort_values(['a', 'b'])
+
+        # Pairs are numbered group by group; an exon in several pairs keeps its last MUTEX ID
+        MUTEXid = np.array(['MUTEX_' + chrstr + str(x).zfill(7) for x in range(1, len(df_pairs.index) + 1)],
+                           dtype=object)
+        paired = np.concatenate([df_pairs['a'].values, df_pairs['b'].values])
+        pairID = np.concatenate([np.arange(len(MUTEXid)), np.arange(len(MUTEXid))])
+        last = np.lexsort((pairID, paired))
+        MetadataMUTEX = df_main['MetadataMUTEX'].values.copy()
+        MetadataMUTEX[paired[last]] = MUTEXid[pairID[last]]
+        df_main['MetadataMUTEX'] = MetadataMUTEX
+        if context is not None:
+            addRecords('MUTEX', MUTEXid, df_main['Segment'].values[df_pairs['a'].values],
+                       [(x,) for x in key[df_pairs['a'].values].tolist()])
+        df_main = df_main.drop(['MUTEX', 'MUTEXSTART'], axis=1)
         df_main = df_main.reset_index(drop=True)
-        df_main.to_csv(sdir + '/df5_MUTEX.csv', sep=',')
+        checkpoint('df5_MUTEX', df_main)
 
     # Step5: Refine List
     if steps[5] == 1:
-        with open(sdir + '/df5_MUTEX.csv', 'r') as f:
-            df_main = pd.read_csv(f, sep=',', index_col=0)
+        df_main = frames['df5_MUTEX'].copy()
         df_main = df_main.filter(['ExonID', 'ExonChr', 'ExonStart', 'ExonEnd', 'ExonStrand',
                                   '1_ELS', '1_ERE', 'LPSImax1', 'RPSImax1', 'LPSImin1', 'RPSImin1',
                                   'ExonClass', 'Cassette',
-                                  'MetadataLASS', 'MetadataRASS', 'MetadataLINKED', 'MetadataMUTEX'], axis=1)
-        df_main.to_csv(sdir + '/df6_REFINE.csv', sep=',')
+                                  'MetadataLASS', 'MetadataRASS', 'MetadataLINKED', 'MetadataMUTEX', 'Segment'], axis=1)
+        checkpoint('df6_REFINE', df_main)
+
+    if context is not None:
+        frames['records'] = pd.concat(recordKeys) if recordKeys else \
+            pd.DataFrame({'RecordID': [], 'Class': [], 'Segment': [], 'Key': []})
 
     # ============================================
     clst.close()
+    return frames
+
+
+def dropExons(exons, dl):
+    """ Parsed step0 input ('exons' of classifyExons) without the exons in dl """
+    df_main, df_constitutive = exons
+    df_main = df_main[~df_main['ExonID'].isin(dl)].reset_index(drop=True)
+    df_constitutive = df_constitutive[~df_constitutive['ExonID'].isin(dl)].reset_index(drop=True)
+    return df_main, df_constitutive
+
+
+def firstRunDrops(frames):
+    """
+    Exons dropped after the first classification run: exons merged into both a
+    LASS and a RASS record and exons filtered for low PSI, unless they make up
+    a LASS/RASS record that is a cassette or mutually exclusive exon
+    """
+    df_main = frames['df2_LASSRASS']
+    drop = (df_main['MergedCount'] >= 2) | (df_main['ExonClass'].str.split(':').str[0] == 'Filtered')
+    dropList = set(df_main['ExonID'][drop])
+    df_main = frames['df6_REFINE']
+    rescued = (df_main['Cassette'] == 'Yes') | (df_main['MetadataMUTEX'] != 'None')
+    for col in ['MetadataLASS', 'MetadataRASS']:
+        merged = df_main[col][rescued & df_main[col].str.contains(',', regex=False)]
+        dropList.difference_update(merged.str.split(',').explode())
+    return dropList
+
+
+def secondRunDrops(frames):
+    """
+    Exons dropped after the second run: exons at the location of a LINKED
+    record, exons left unclassified and cassette exons with a low PSI on
+    either side
+    """
+    df_main = frames['df6_REFINE']
+    ExonLocation = joinColumns(df_main, ['ExonChr', 'ExonStart', 'ExonEnd', 'ExonStrand'])
+    linked = df_main['ExonClass'] == 'LINKED'
+    unclassified = (df_main['ExonClass'] == 'Unclassified') & (df_main['Cassette'] == 'No')
+    for col in ['MetadataLASS', 'MetadataRASS', 'MetadataLINKED', 'MetadataMUTEX']:
+        unclassified = unclassified & (df_main[col] == 'None')
+    lowPSI = (df_main['Cassette'] == 'Yes') & ((df_main['LPSImax1'] <= 10) | (df_main['RPSImax1'] <= 10))
+    drop = (~linked & ExonLocation.isin(set(ExonLocation[linked]))) | unclassified | lowPSI
+    return set(df_main['ExonID'][drop])
 
 
 def writeNewInput(wd, ic, dl):
     prevFilename = wd + '/y_input_v' + str(ic) + '.csv'
     newFilename = wd + '/y_input_v' + str(ic + 1) + '.csv'
+    dl = set(dl)
     nf = open(newFilename, 'w')
     with open(prevFilename, 'r') as f:
         for line in f:
@@ -0,0 +1,211 @@
+"""
+Gene records of a GTF and a strand-aware nearest-gene index over them.
+
+gene_table() compiles the 'gene' records of a GTF (plain or gzip/BGZF
+compressed) once into a binary table cached next to the GTF (under ./gtf by
+default), keyed by the md5 of the whole GTF, so later runs load the genes
+without scanning the GTF again.
+
+In GeneIndex genes are kept per (chromosome, strand) in arrays sorted by
+start, so the closest gene of every query interval is found with
+np.searchsorted in one pass instead of writing BED files and running
+'bedtools closest'.  Coordinates and distances follow 'bedtools closest -d'
+on BED intervals: a gene overlapping the query is at distance 0, otherwise
+the distance is the gap between them plus one.
+"""
+import hashlib
+import os
+import re
+
+import numpy as np
+import pandas as pd
+
+from rsrGzip import open_text
+
+NO_GENE = np.iinfo(np.int64).max
+
+# Columns of the gene table; gene_base_id is gene_id without its version
+GENE_COLUMNS = ['gene_id', 'gene_base_id', 'gene_name', 'gene_type', 'chr', 'start', 'end', 'strand']
+
+
+def gtf_checksum(gtf_path, cache_dir='gtf'):
+    """
+    md5 of the whole GTF file.  The digest is kept in cache_dir/<GTF name>.md5
+    with the file's size, modification/change times and inode, and the GTF is
+    only hashed again when one of them differs.  The change time is set by the
+    system on every write, so edits that keep the size and restore the
+    modification time (cp -p, rsync -t, tar) are hashed again too.
+    """
+    stat = os.stat(gtf_path)
+    key = ' '.join(str(x) for x in [stat.st_size, stat.st_mtime_ns, stat.st_ctime_ns, stat.st_ino])
+    record = os.path.join(cache_dir, os.path.basename(gtf_path) + '.md5')
+    if os.path.exists(record):
+        with open(record, 'r') as f:
+            line = f.read().split()
+        if ' '.join(line[:-1]) == key:
+            return line[-1]
+    md5 = hashlib.md5()
+    with open(gtf_path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 ** 2), b''):
+            md5.update(block)
+    try:
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        temp = record + '.' + str(os.getpid())
+        with open(temp, 'w') as f:
+            f.write(key + ' ' + md5.hexdigest() + '\n')
+        os.replace(temp, record)
+    except OSError:
+        pass  # read-only cache_dir: hash the GTF again next time
+    return md5.hexdigest()
+
+
+def parse_genes(gtf_path):
+    """ 'gene' records of a GTF, plain or gzip/BGZF compressed, in file order """
+    rows = []
+    with open_text(gtf_path) as gtf:
+        for line in gtf:
+            if line.startswith('#'):
+                continue
+            elem = line.split('\t')
+            if elem[2] == 'gene':
+                gene_id = ''
+                gene_type = ''
+                gene_name = ''
+                attributes = re.split(r'[ ;]', elem[8].replace('"', ''))
+                for ix in range(len(attributes)):
+                    if attributes[ix] == 'gene_id':
+                        gene_id = attributes[ix + 1]
+                    elif attributes[ix] == 'gene_type':
+                        gene_type = attributes[ix + 1]
+                    elif attributes[ix] == 'gene_name':
+                        gene_name = attributes[ix + 1]
+                rows.append([gene_id, gene_id.split('.')[0], gene_name, gene_type,
+                             elem[0], int(elem[3]), int(elem[4]), elem[6]])
+    return pd.DataFrame(rows, columns=GENE_COLUMNS)
+
+
+def gene_table(gtf_path, cache_dir='gtf'):
+    """
+    Gene records of a GTF as a DataFrame with GENE_COLUMNS, in file order.
+    The table is read from cache_dir/<GTF name>.<checksum>.genes.npz, or
+    parsed from the GTF and written there when the cache has no table for
+    this version of the GTF.
+    """
+    checksum = gtf_checksum(gtf_path, cache_dir)
+    cache = os.path.join(cache_dir, os.path.basename(gtf_path) + '.' + checksum + '.genes.npz')
+    if os.path.exists(cache):
+        with np.load(cache) as table:
+            return pd.DataFrame(dict((col, table[col]) for col in GENE_COLUMNS), columns=GENE_COLUMNS)
+    genes = parse_genes(gtf_path)
+    try:
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        temp = cache + '.' + str(os.getpid()) + '.npz'
+        np.savez(temp, **dict((col, np.asarray(genes[col], dtype=np.int64 if col in ['start', 'end'] else str))
+                              for col in GENE_COLUMNS))
+        os.replace(temp, cache)  # complete tables only, also with several runs compiling the same GTF
+    except OSError:
+        pass  # read-only cache_dir: use the parsed table without caching it
+    return genes
+
+
+class GeneIndex(object):
+    """
+    Genes given as parallel sequences (one entry per gene, in GTF order).
+    is_preferred marks genes chosen over other genes at the same distance,
+    e.g. protein coding genes.
+    """
+    def __init__(self, chroms, starts, ends, strands, gene_ids, is_preferred, chunk_size=10000):
+        self.chunk_size = chunk_size
+        genes = pd.DataFrame({'chrom': chroms, 'strand': strands,
+                              'start': np.asarray(starts, dtype=np.int64), 'end': np.asarray(ends, dtype=np.int64),
+                              'gene_id': gene_ids, 'preferred': np.asarray(is_preferred, dtype=bool)})
+        self.groups = {}
+        for key, ix in genes.groupby(['chrom', 'strand'], sort=False).indices.items():
+            # Stable sort, so genes with the same start keep their GTF order
+            group = genes.iloc[ix].sort_values('start', kind='mergesort')
+            start = group['start'].values
+            end = group['end'].values
+            self.groups[key] = {'start': start, 'end': end,
+                                'gene_id': group['gene_id'].values, 'preferred': group['preferred'].values,
+                                'max_end': np.maximum.accumulate(end),
+                                'end_order': np.argsort(end, kind='mergesort'),
+                                'max_length': int((end - start).max())}
+        for group in self.groups.values():
+            group['sorted_end'] = group['end'][group['end_order']]
+
+    def closest(self, chroms, starts, ends, strands, max_distance):
+        """
+        ID of the closest gene on the same chromosome and strand of each query
+        interval, or None when no gene is closer than max_distance.  Of the
+        genes at the smallest distance, ordered by start and end, the last
+        preferred gene is taken, or else the first gene.
+        """
+        queries = pd.DataFrame({'chrom': chroms, 'strand': strands,
+                                'start': np.asarray(starts, dtype=np.int64), 'end': np.asarray(ends, dtype=np.int64)})
+        genes = np.full(len(queries.index), None, dtype=object)
+        for key, ix in queries.groupby(['chrom', 'strand'], sort=False).indices.items():
+            if key not in self.groups:
+                continue
+            for lo in range(0, len(ix), self.chunk_size):
+                chunk = ix[lo:lo + self.chunk_size]
+                genes[chunk] = self._closest(self.groups[key], queries['start'].values[chunk],
+                                             queries['end'].values[chunk], max_distance)
+        return genes
+
+    @staticmethod
+    def _closest(group, s, e, max_distance):
+        start, end = group['start'], group['end']
+        n = len(start)
+        # Genes [0, before) start before the query ends; they overlap it when one of them ends after its start
+        before = np.searchsorted(start, e, side='left')
+        upstreamEnd = group['max_end'][np.maximum(before - 1, 0)]
+        overlap = (before > 0) & (upstreamEnd > s)
+        upstream = np.where(before > 0, s - upstreamEnd + 1, NO_GENE)
+        downstream = np.where(before < n, start[np.minimum(before, n - 1)] - e + 1, NO_GENE)
+        distance = np.where(overlap, 0, np.minimum(upstream, downstream))
+        genes = np.full(len(s), None, dtype=object)
+        hit = np.flatnonzero(distance < max_distance)
+        if len(hit) == 0:
+            return genes
+        s, e, distance, overlap = s[hit], e[hit], distance[hit], overlap[hit]
+
+        # Genes at the smallest distance, from [lo, hi) ranges of the start or end sorted genes:
+        # genes overlapping a query start after its start minus the longest gene length,
+        # other genes start or end exactly at the distance
+        ov = np.flatnonzero(overlap)
+        gap = np.flatnonzero(~overlap)
+        downstreamStart = e[gap] + distance[gap] - 1
+        upstreamEnd = s[gap] - distance[gap] + 1
+        ranges = [(ov, np.searchsorted(start, s[ov] - group['max_length'], side='right'),
+                   np.searchsorted(start, e[ov], side='left'), None),
+                  (gap, np.searchsorted(start, downstreamStart, side='left'),
+                   np.searchsorted(start, downstreamStart, side='right'), None),
+                  (gap, np.searchsorted(group['sorted_end'], upstreamEnd, side='left'),
+                   np.searchsorted(group['sorted_end'], upstreamEnd, side='right'), group['end_order'])]
+        query, pos = [], []
+        for q, lo, hi, order in ranges:
+            count = hi - lo
+            p = np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count) + np.repeat(lo, count)
+            query.append(np.repeat(q, count))
+            pos.append(p if order is None else order[p])
+        query = np.concatenate(query)
+        pos = np.concatenate(pos)
+        tied = ~overlap[query] | (end[pos] > s[query])
+        query, pos = query[tied], pos[tied]
+
+        # Order the genes of each query by start, end and GTF order (the order of genes
+        # with the same start); take the last preferred gene, or else the first gene
+        order = np.lexsort((pos, end[pos], start[pos], query))
+        query, pos = query[order], pos[order]
+        chosen = np.empty(len(hit), dtype=np.int64)
+        first = np.r_[True, query[1:] != query[:-1]]
+        chosen[query[first]] = pos[first]
+        preferred = group['preferred'][pos]
+        query, pos = query[preferred], pos[preferred]
+        if len(query) > 0:
+            last = np.r_[query[1:] != query[:-1], True]
+            chosen[query[last]] = pos[last]
+        genes[hit] = group['gene_id'][chosen]
+        return genes
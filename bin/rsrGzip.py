@@ -0,0 +1,143 @@
+"""
+Readers for plain, gzip and BGZF compressed inputs (GENCODE *.gtf.gz,
+Snaptron *.tsv.bgz), so downloads are read as they are instead of being
+decompressed to disk first.
+
+BGZF files are series of independent gzip blocks of at most 64 kB, each
+recording its compressed size in the header.  BGZFReader splits the file
+into blocks and inflates batches of them on a thread pool (zlib releases the
+GIL), returning the data in file order; open_virtual starts reading at a
+BGZF virtual offset, as recorded by a reader opened with record_blocks.
+Other gzip files are streamed with
+the gzip module and uncompressed files are opened directly.
+"""
+import gzip
+import io
+import os
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+
+def is_gzip(path):
+    with open(path, 'rb') as f:
+        return f.read(2) == GZIP_MAGIC
+
+
+def bgzf_block_size(header):
+    """
+    Size of the BGZF block starting with 'header' (its first 18 bytes or
+    more), or None if it is not a BGZF block header
+    """
+    if len(header) < 18 or header[:2] != GZIP_MAGIC or not header[3] & 4:
+        return None
+    xlen = struct.unpack('<H', header[10:12])[0]
+    extra = header[12:12 + xlen]
+    pos = 0
+    while pos + 4 <= len(extra):
+        slen = struct.unpack('<H', extra[pos + 2:pos + 4])[0]
+        if extra[pos:pos + 2] == b'BC' and slen == 2:
+            return struct.unpack('<H', extra[pos + 4:pos + 6])[0] + 1
+        pos = pos + 4 + slen
+    return None
+
+
+def is_bgzf(path):
+    with open(path, 'rb') as f:
+        return bgzf_block_size(f.read(64)) is not None
+
+
+def inflate_block(block):
+    """ Data of one BGZF block, checked against its CRC32 and size """
+    xlen = struct.unpack('<H', block[10:12])[0]
+    crc, isize = struct.unpack('<II', block[-8:])
+    data = zlib.decompress(block[12 + xlen:-8], -15)
+    if len(data) != isize or zlib.crc32(data) != crc:
+        raise IOError('Corrupt BGZF block')
+    return data
+
+
+class BGZFReader(io.RawIOBase):
+    """ Decompressed byte stream of a BGZF file, inflated with 'threads' threads """
+    def __init__(self, path, threads=None, batch_blocks=64, voffset=0, record_blocks=False):
+        self.raw = open(path, 'rb')
+        self.raw.seek(voffset >> 16)
+        self.skip = voffset & 0xffff  # uncompressed bytes to drop from the first block
+        self.threads = threads or min(8, os.cpu_count() or 1)
+        self.batch_blocks = batch_blocks * self.threads
+        self.executor = ThreadPoolExecutor(max_workers=self.threads)
+        self.buffer = b''
+        self.offset = 0
+        self.eof = False
+        # With record_blocks, the compressed and uncompressed offsets where each block starts
+        self.record_blocks = record_blocks
+        self.block_coffsets = []
+        self.block_uoffsets = []
+        self.uoffset = 0
+
+    def readable(self):
+        return True
+
+    def next_blocks(self):
+        """ The next batch of compressed blocks """
+        blocks = []
+        while len(blocks) < self.batch_blocks:
+            coffset = self.raw.tell()
+            header = self.raw.read(18)
+            if len(header) == 0:
+                break
+            size = bgzf_block_size(header)
+            if size is None:
+                raise IOError('Not a BGZF block at offset ' + str(self.raw.tell() - len(header)))
+            blocks.append(header + self.raw.read(size - 18))
+            if self.record_blocks:
+                self.block_coffsets.append(coffset)
+                self.block_uoffsets.append(self.uoffset)
+                self.uoffset = self.uoffset + struct.unpack('<I', blocks[-1][-4:])[0]
+        return blocks
+
+    def readinto(self, b):
+        while self.offset == len(self.buffer) and not self.eof:
+            blocks = self.next_blocks()
+            self.eof = len(blocks) == 0
+            self.buffer = b''.join(self.executor.map(inflate_block, blocks))
+            self.offset = min(self.skip, len(self.buffer))
+            self.skip = self.skip - self.offset
+        n = min(len(b), len(self.buffer) - self.offset)
+        b[:n] = self.buffer[self.offset:self.offset + n]
+        self.offset = self.offset + n
+        return n
+
+    def close(self):
+        if not self.closed:
+            self.executor.shutdown()
+            self.raw.close()
+        super(BGZFReader, self).close()
+
+
+def open_virtual(path, voffset, batch_blocks=4):
+    """
+    Decompressed binary stream of a BGZF file from virtual offset 'voffset'
+    (compressed block offset << 16 | offset within the block), for reading a
+    few records without inflating the file up to them
+    """
+    return io.BufferedReader(BGZFReader(path, threads=1, batch_blocks=batch_blocks, voffset=voffset))
+
+
+def open_binary(path, threads=None, record_blocks=False):
+    """
+    Decompressed binary stream of a plain, gzip or BGZF file; with
+    record_blocks, the BGZF reader (stream.raw) keeps the block offsets
+    """
+    if is_bgzf(path):
+        return io.BufferedReader(BGZFReader(path, threads, record_blocks=record_blocks), buffer_size=1024 ** 2)
+    if is_gzip(path):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def open_text(path, threads=None):
+    """ Decompressed text stream of a plain, gzip or BGZF file, read line by line like open(path, 'r') """
+    return io.TextIOWrapper(open_binary(path, threads))
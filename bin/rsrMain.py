@@ -1,19 +1,24 @@
 import argparse
 from argparse import RawTextHelpFormatter
+import hashlib
+import json
 import os
 import sys
-import subprocess
 import multiprocessing
-from multiprocessing import Manager
 import numpy as np
 import pandas as pd
 pd.options.mode.chained_assignment = None
 import pickle
+import queue
 import shutil
-import re
 import time
 import warnings
 warnings.simplefilter(action='ignore', category=FutureWarning)
+from rsrBulk import BulkQuery
+from rsrStore import StoreWriter, PSIStore, PSIStrings, jc_str
+from rsrFunctions import rankPSI, restoreTypes
+from rsrBlocks import ChromosomeBlocks
+from rsrGenes import GeneIndex, gene_table
 
 
 parser = argparse.ArgumentParser(formatter_class=RawTextHelpFormatter, description="""
@@ -27,7 +32,7 @@ parser.add_argument('--exons', action='store',
 parser.add_argument('--p', action='store',
                     type=int,
                     required=True,
-                    help='Number of processors')
+                    help='Number of processors (at most the CPU count is used)')
 parser.add_argument('--cfg', action='store',
                     required=True,
                     help='Config file preset')
@@ -49,220 +54,121 @@ parser.add_argument('--deldir', action='store',
                     type=int,
                     default=1,
                     help='Delete output directory')
+parser.add_argument('--keep', action='store',
+                    type=int,
+                    default=0,
+                    help='Keep the tables of every exon classification step\n'
+                         '(df1_exLR.csv ... df6_REFINE.csv) in each block directory')
+parser.add_argument('--block', action='store',
+                    type=int,
+                    default=5000,
+                    help='Exons per classification block; blocks only split a chromosome\n'
+                         'where no LASS/RASS/LINKED/MUTEX record can cross')
+parser.add_argument('--junctions', action='store',
+                    default=None,
+                    help='Local Snaptron junction file(s) to query instead of the Snaptron server')
+parser.add_argument('--q', action='store',
+                    type=int,
+                    default=4,
+                    help='Snaptron bulk queries kept in flight')
+parser.add_argument('--cache', action='store',
+                    default=None,
+                    help='SQLite file caching Snaptron responses across runs')
+parser.add_argument('--cachesize', action='store',
+                    type=int,
+                    default=2048,
+                    help='Maximum Snaptron cache size in MB')
+parser.add_argument('--store', action='store',
+                    default=None,
+                    help='Directory for binary PSI/junction count matrices of the output exons,\n'
+                         'read by rsrMerge.py --store (default: --out name + \'_store\')')
+parser.add_argument('--resume', action='store',
+                    default=None,
+                    help='Output directory (tempdir_*) of an interrupted run to continue;\n'
+                         'Snaptron batches it finished are not queried again')
 args = parser.parse_args()
 
+# Read-only data shared with pool workers: each worker process attaches to the
+# memory-mapped PSI store and loads the exon dictionaries and PSImax/PSImin
+# tables once, in attachPoolData(), instead of going through Manager dict
+# proxies on every lookup
+poolData = {}
 
-def worker1(sdir, ddir, LPSI, RPSI):
-    from rsrFunctions import classifyExons
-    from rsrFunctions import writeNewInput
-    from rsrFunctions import writeTimestamp
-    exid2loc = pickle.load(open(ddir + '/exid2loc.pickle', 'rb'))
-    exid2strand = pickle.load(open(ddir + '/exid2strand.pickle', 'rb'))
-    PSImax = pickle.load(open(ddir + '/PSImax.pickle', 'rb'))
-    PSImin = pickle.load(open(ddir + '/PSImin.pickle', 'rb'))
-
-    inputCount = 1
-    checkpointCount = 1
-    currentTime = time.time()
-    classifyExons('y_input_v1.csv', 6, sdir, exid2loc, exid2strand, PSImax, PSImin, LPSI, RPSI)
-    writeTimestamp(sdir, checkpointCount, currentTime)
-    currentTime = time.time()
-    checkpointCount = checkpointCount + 1
 
-    dropList = []
-    with open(sdir + '/df2_LASSRASS.csv', 'r') as f:
-        df_main = pd.read_csv(f, sep=',', index_col=0)
-    for ix in range(len(df_main.index)):
-        if df_main['MergedCount'][ix] >= 2:
-            dropList.append(df_main['ExonID'][ix])
-        elif df_main['ExonClass'][ix].split(':')[0] == 'Filtered':
-            dropList.append(df_main['ExonID'][ix])
-    with open(sdir + '/df6_REFINE.csv', 'r') as f:
-        df_main = pd.read_csv(f, sep=',', index_col=0)
-    for ix in range(len(df_main.index)):
-        LASSinfo = df_main['MetadataLASS'][ix].split(',')
-        RASSinfo = df_main['MetadataRASS'][ix].split(',')
-        LINKEDinfo = df_main['MetadataLINKED'][ix].split(',')
-        if df_main['Cassette'][ix] == 'Yes' or df_main['MetadataMUTEX'][ix] != 'None':
-            if len(LASSinfo) > 1:
-                for x in LASSinfo:
-                    if x in dropList:
-                        dropList.remove(x)
-            if len(RASSinfo) > 1:
-                for x in RASSinfo:
-                    if x in dropList:
-                        dropList.remove(x)
-        if df_main['MetadataLINKED'][ix] != 'None':
-            if len(LINKEDinfo) == 0:
-                if df_main['ExonID'][ix] in dropList:
-                    dropList.remove(df_main['ExonID'][ix])
-
-    writeNewInput(sdir, inputCount, dropList)
-    inputCount = inputCount + 1
-    writeTimestamp(sdir, checkpointCount, currentTime)
-    currentTime = time.time()
-    checkpointCount = checkpointCount + 1
-
-    if os.path.getsize(sdir + '/y_input_v' + str(inputCount) + '.csv') > 0:
-        classifyInput = 'y_input_v' + str(inputCount) + '.csv'
-        classifyExons(classifyInput, 6, sdir, exid2loc, exid2strand, PSImax, PSImin, LPSI, RPSI)
-        writeTimestamp(sdir, checkpointCount, currentTime)
-        currentTime = time.time()
-        checkpointCount = checkpointCount + 1
-
-        with open(sdir + '/df6_REFINE.csv', 'r') as f:
-            df_main = pd.read_csv(f, sep=',', index_col=0)
-        df_main['Temp'] = ':'
-        df_main['ExonLocation'] = df_main['ExonChr'].map(str) + df_main['Temp'] + \
-                                  df_main['ExonStart'].astype(str) + df_main['Temp'] + \
-                                  df_main['ExonEnd'].astype(str) + df_main['Temp'] + \
-                                  df_main['ExonStrand'].astype(str)
-        df_main = df_main.drop('Temp', axis=1)
-
-        dropList = []
-        LINKEDmatch = []
-        for ix in range(len(df_main.index)):
-            if df_main['ExonClass'][ix] == 'LINKED':
-                if df_main['ExonLocation'][ix] not in LINKEDmatch:
-                    LINKEDmatch.append(df_main['ExonLocation'][ix])
-        for ix in range(len(df_main.index)):
-            if df_main['ExonClass'][ix] != 'LINKED':
-                if df_main['ExonLocation'][ix] in LINKEDmatch:
-                    dropList.append(df_main['ExonID'][ix])
-            if df_main['ExonClass'][ix] == 'Unclassified':
-                if df_main['Cassette'][ix] == 'No':
-                    if df_main['MetadataLASS'][ix] == 'None':
-                        if df_main['MetadataRASS'][ix] == 'None':
-                            if df_main['MetadataLINKED'][ix] == 'None':
-                                if df_main['MetadataMUTEX'][ix] == 'None':
-                                    dropList.append(df_main['ExonID'][ix])
-            if df_main['Cassette'][ix] == 'Yes':
-                if df_main['LPSImax1'][ix] <= 10:
-                    dropList.append(df_main['ExonID'][ix])
-                elif df_main['RPSImax1'][ix] <= 10:
-                    dropList.append(df_main['ExonID'][ix])
-        writeNewInput(sdir, inputCount, dropList)
-        inputCount = inputCount + 1
-        writeTimestamp(sdir, checkpointCount, currentTime)
-        currentTime = time.time()
-        checkpointCount = checkpointCount + 1
-
-        if os.path.getsize(sdir + '/y_input_v' + str(inputCount) + '.csv') > 0:
-            classifyInput = 'y_input_v' + str(inputCount) + '.csv'
-            classifyExons(classifyInput, 6, sdir, exid2loc, exid2strand, PSImax, PSImin, LPSI, RPSI)
-            writeTimestamp(sdir, checkpointCount, currentTime)
-        else:
-            os.remove(sdir + '/df6_REFINE.csv')
-
-
-def worker2(df_main, fname, metaLASS, metaRASS, LPSI, RPSI):
-    def addPSI(exID_list, leftOrRight):
-        sumList = []
-        if leftOrRight == 'LEFT':
-            for exID in exID_list:
-                sumList.append(list(map(float, LPSI[exID].split(','))))
-        elif leftOrRight == 'RIGHT':
-            for exID in exID_list:
-                sumList.append(list(map(float, RPSI[exID].split(','))))
-        else:
-            sys.exit('Error in addPSI(): improper leftOrRight value')
-        PSIsum = [sum(x) for x in zip(*sumList)]
-        PSIsum = [round(x, 3) for x in PSIsum]
-        for col in range(len(PSIsum)):
-            neg1count = 0
-            for row in range(len(sumList)):
-                if sumList[row][col] == -1:
-                    neg1count = neg1count + 1
-            if neg1count < len(sumList):
-                PSIsum[col] = PSIsum[col] + neg1count
-            elif neg1count == len(sumList):
-                PSIsum[col] = -1
-            elif len(sumList) == 0:
-                sys.exit('Error in addPSI(): sumList is empty')
-        PSIsum = [str(x) for x in PSIsum]
-        return ','.join(PSIsum)
+def attachPoolData(storeDir, dictDir):
+    poolData['store'] = PSIStore(storeDir)
+    poolData['LPSI'] = PSIStrings(poolData['store'], 'LeftPSI')
+    poolData['RPSI'] = PSIStrings(poolData['store'], 'RightPSI')
+    for x in ['exid2loc', 'exid2strand', 'PSImax', 'PSImin']:
+        poolData[x] = pickle.load(open(dictDir + '/' + x + '.pickle', 'rb'))
 
-    dropList = []
-    for ix in df_main.index:
-        if df_main['ExonClass'][ix] == 'LINKED':
-            linkIDs = df_main['MetadataLINKED'][ix].split(',')
-            exonClass = [linkIDs[0].split('_')[0], linkIDs[1].split('_')[0]]
-            if exonClass[0] in ['LASS', 'RASS'] and exonClass[1] in ['LASS', 'RASS'] and exonClass[0] != exonClass[1]:
-                dropList.append(ix)
-            else:
-                if exonClass[0] == 'LASS':
-                    df_main['LeftID'][ix] = metaLASS[linkIDs[0]]
-                elif exonClass[0] == 'RASS':
-                    df_main['LeftID'][ix] = metaRASS[linkIDs[0]].split(',')[0]
-                else:
-                    df_main['LeftID'][ix] = linkIDs[0]
-                if exonClass[1] == 'LASS':
-                    df_main['RightID'][ix] = metaLASS[linkIDs[1]].split(',')[0]
-                elif exonClass[1] == 'RASS':
-                    df_main['RightID'][ix] = metaRASS[linkIDs[1]]
-                else:
-                    df_main['RightID'][ix] = linkIDs[1]
-        elif df_main['ExonClass'][ix] in ['Cassette', 'LASS', 'RASS'] or df_main['MetadataMUTEX'][ix] != 'None':
-            if df_main['MetadataLASS'][ix] != 'None' and df_main['MetadataRASS'][ix] == 'None':
-                df_main['LeftID'][ix] = df_main['MetadataLASS'][ix]
-                df_main['RightID'][ix] = df_main['MetadataLASS'][ix].split(',')[0]
-            if df_main['MetadataLASS'][ix] == 'None' and df_main['MetadataRASS'][ix] != 'None':
-                df_main['LeftID'][ix] = df_main['MetadataRASS'][ix].split(',')[0]
-                df_main['RightID'][ix] = df_main['MetadataRASS'][ix]
-            if df_main['MetadataLASS'][ix] == 'None' and df_main['MetadataRASS'][ix] == 'None':
-                df_main['LeftID'][ix] = df_main['ExonID'][ix]
-                df_main['RightID'][ix] = df_main['ExonID'][ix]
-            if df_main['MetadataLASS'][ix] != 'None' and df_main['MetadataRASS'][ix] != 'None':
-                sys.exit('Error in LeftID/RightID processing: ExonID is both LASS and RASS')
-        else:
-            dropList.append(ix)
-    df_main.drop(dropList, inplace=True)
-
-    for ix in df_main.index:
-        if '|' not in str(df_main['ExonStart'][ix]) and '|' not in str(df_main['ExonEnd'][ix]):
-            df_main['ExonLength'][ix] = str(int(df_main['ExonEnd'][ix]) - int(df_main['ExonStart'][ix]) + 1)
-        elif '|' in str(df_main['ExonStart'][ix]):
-            es = [int(x) for x in df_main['ExonStart'][ix].split('|')]
-            exonLength = []
-            for a in es:
-                exonLength.append(str(int(df_main['ExonEnd'][ix]) - a + 1))
-            df_main['ExonLength'][ix] = '|'.join(exonLength)
-        elif '|' in str(df_main['ExonEnd'][ix]):
-            ee = [int(x) for x in df_main['ExonEnd'][ix].split('|')]
-            exonLength = []
-            for a in ee:
-                exonLength.append(str(a - int(df_main['ExonStart'][ix]) + 1))
-            df_main['ExonLength'][ix] = '|'.join(exonLength)
-        else:
-            sys.exit('Error in calculating exon length: exon is both LASS and RASS')
-
-        if df_main['LeftID'][ix] == 'None' and df_main['RightID'][ix] == 'None':
-            pass
-        elif df_main['LeftID'][ix] != 'None' and df_main['RightID'][ix] != 'None':
-            LID = df_main['LeftID'][ix].split(',')
-            RID = df_main['RightID'][ix].split(',')
-            if len(LID) > 1:
-                df_main['LeftPSIstr'][ix] = addPSI(LID, 'LEFT')
-            elif len(LID) == 1:
-                df_main['LeftPSIstr'][ix] = LPSI[LID[0]]
-            else:
-                sys.exit('Error: LID is empty')
-            if len(RID) > 1:
-                df_main['RightPSIstr'][ix] = addPSI(RID, 'RIGHT')
-            elif len(RID) == 1:
-                df_main['RightPSIstr'][ix] = RPSI[RID[0]]
-            else:
-                sys.exit('Error: RID is empty')
-        else:
-            sys.exit('Error in getting LeftPSIstr/RightPSIstr: an ID is missing')
 
-        if df_main['MetadataLASS'][ix] != 'None':
-            df_main['LASS'][ix] = 'Yes'
-        if df_main['MetadataRASS'][ix] != 'None':
-            df_main['RASS'][ix] = 'Yes'
-        if df_main['MetadataLINKED'][ix] != 'None':
-            df_main['LINKED'][ix] = 'Yes'
-    df_main.to_csv(fname, sep=',')
+def worker1(bdir, context, exons, keep):
+    """
+    Classify one block of a chromosome (see rsrBlocks); exons is None for a
+    block of the first run, which reads bdir/y_input_v1.csv.  Returns the
+    parsed input of a first-run block, df6_REFINE, the records to renumber
+    and the exons each drop rule removes.
+    """
+    from rsrFunctions import classifyExons
+    from rsrFunctions import firstRunDrops
+    from rsrFunctions import secondRunDrops
+    frames = classifyExons('y_input_v1.csv', 6, bdir, poolData['exid2loc'], poolData['exid2strand'],
+                           poolData['PSImax'], poolData['PSImin'], poolData['LPSI'], poolData['RPSI'], keep,
+                           exons, context)
+    return {'exons': frames['exons'] if exons is None else None,
+            'df6': frames['df6_REFINE'],
+            'records': frames['records'],
+            'drops': [firstRunDrops(frames), secondRunDrops(frames)]}
+
+
+def roundPSI(values):
+    """ round(x, 3) of every value, rounded exactly as Python's round() does """
+    scaled = values * 1000
+    rounded = np.round(scaled) / 1000
+    # Rounding the scaled value can only differ from rounding the exact decimal value next to a tie
+    tie = np.abs(scaled - np.floor(scaled) - 0.5) < 1e-6
+    rounded[tie] = [round(x, 3) for x in values[tie].tolist()]
+    return rounded
+
+
+def addPSI(store, idLists, leftOrRight, chunkSize=1000):
+    """
+    Summed PSI of the exons in each list of idLists, one row per list.  Samples
+    where every exon of a list has PSI -1 stay -1, otherwise a -1 counts as 0.
+    """
+    if leftOrRight == 'LEFT':
+        matrix = store.matrix('LeftPSI')
+    elif leftOrRight == 'RIGHT':
+        matrix = store.matrix('RightPSI')
+    else:
+        sys.exit('Error in addPSI(): improper leftOrRight value')
+    sizes = np.array([len(exIDs) for exIDs in idLists], dtype=np.int64)
+    if (sizes == 0).any():
+        sys.exit('Error in addPSI(): empty exon ID list')
+    rows = np.array([store.index[exID] for exIDs in idLists for exID in exIDs], dtype=np.int64)
+    starts = np.cumsum(sizes) - sizes
+    PSIsum = np.empty((len(idLists), store.columns))
+    for lo in range(0, len(idLists), chunkSize):
+        chunkSizes = sizes[lo:lo + chunkSize]
+        chunkStarts = starts[lo:lo + chunkSize]
+        total = np.zeros((len(chunkSizes), store.columns))
+        neg1count = np.zeros((len(chunkSizes), store.columns), dtype=np.int64)
+        # Exons are added one at a time in list order, so the sums match summing each list in Python
+        for k in range(chunkSizes.max()):
+            groups = np.flatnonzero(chunkSizes > k)
+            values = matrix[rows[chunkStarts[groups] + k]]
+            total[groups] += values
+            neg1count[groups] += values == -1
+        total = roundPSI(total) + neg1count
+        total[neg1count == chunkSizes[:, None]] = -1
+        PSIsum[lo:lo + chunkSize] = total
+    return PSIsum
+
+
+def sumStr(values):
+    """ Comma-joined summed PSI values; samples that stayed -1 are written as -1 """
+    return ','.join('-1' if x == -1 else repr(x) for x in values.tolist())
 
 
 if __name__ == '__main__':
@@ -271,18 +177,24 @@ if __name__ == '__main__':
     exonList = args.exons
     exonListFile = exonList.split('/')[-1]
     configPreset = args.cfg
-    numProcesses = args.p
-    if numProcesses > 25:
-        numProcesses = 25
+    numProcesses = min(args.p, multiprocessing.cpu_count())
     gtfPath = args.gtf
     minJC = args.min
     makeNewExonList = args.new
     cwd = os.getcwd()
     outputDir = cwd + '/tempdir_' + time.strftime('%m%d%y_%H%M%S') + '_' + exonListFile.split('.')[0]
+    if args.resume is not None:
+        outputDir = os.path.abspath(args.resume).rstrip('/')
+        if not os.path.isdir(outputDir):
+            sys.exit('Cannot find output directory to resume: ' + args.resume)
     dictDir = outputDir + '/dict'
     bulkDir = outputDir + '/bulkOutput/'
     classifyDir = outputDir + '/classifyOutput/'
     classifyInput = bulkDir + '/y_exLR.csv'
+    storeDir = bulkDir + '/psi_store'
+    outStore = args.store
+    if outStore is None:
+        outStore = os.path.splitext(args.out)[0] + '_store'
     newExonListDir = outputDir + '/newExonList/'
     newExonListFile = newExonListDir + exonListFile.rsplit('.', 1)[0] \
                       + time.strftime('_%m%d%y_%H%M%S.') + exonListFile.rsplit('.', 1)[1]
@@ -318,180 +230,116 @@ if __name__ == '__main__':
 
     # =========================================================================================
     # Snaptron bulk query on exon list input
-    qstr = 'python3 ./bin/rsrBulk.py --preset ' + configPreset + ' --input ./input.tab --queries-per-batch 50'
-    inputlist = []
-    counter = 0
+    # Everything is written straight to bulkDir.  After every batch, manifest.jsonl records
+    # how many exons are done and the size of each output file, so a --resume run can
+    # cut off a partly written batch and carry on from there
     batchsize = 200
-    f1 = open('z_leftpsi.csv', 'w')
-    f2 = open('z_rightpsi.csv', 'w')
-    f3 = open('z_avgpsi.csv', 'w')
-    f4 = open('z_leftjc.csv', 'w')
-    f5 = open('z_rightjc.csv', 'w')
-    f6 = open('z_totaljc.csv', 'w')
-    f1.close()
-    f2.close()
-    f3.close()
-    f4.close()
-    f5.close()
-    f6.close()
-    f7 = open('y_inLR.csv', 'w')
-    f8 = open('y_exLR.csv', 'w')
-    f7.close()
-    f8.close()
-
-    def splitOutput(fileToSplit):
-        regex = r"\d"
-        leftpsi_tempfile = open('leftpsi_temp.csv', 'w')
-        rightpsi_tempfile = open('rightpsi_temp.csv', 'w')
-        avgpsi_tempfile = open('avgpsi_temp.csv', 'w')
-        leftjc_tempfile = open('leftjc_temp.csv', 'w')
-        rightjc_tempfile = open('rightjc_temp.csv', 'w')
-        totaljc_tempfile = open('totaljc_temp.csv', 'w')
-
-        with open(fileToSplit, 'r') as f:
-            for line in f:
-                line = line.split(',')
-                if line[1] == 'LeftPSI':
-                    del line[1]
-                    leftpsi_tempfile.write(','.join(line))
-                elif line[1] == 'RightPSI':
-                    del line[1]
-                    rightpsi_tempfile.write(','.join(line))
-                elif line[1] == 'AvgPSI':
-                    del line[1]
-                    avgpsi_tempfile.write(','.join(line))
-                elif line[1] == 'LeftJunctionCount':
-                    del line[1]
-                    leftjc_tempfile.write(','.join(line))
-                elif line[1] == 'RightJunctionCount':
-                    del line[1]
-                    rightjc_tempfile.write(','.join(line))
-                elif line[1] == 'TotalJunctionCount':
-                    del line[1]
-                    totaljc_tempfile.write(','.join(line))
-
-        leftpsi_tempfile.close()
-        rightpsi_tempfile.close()
-        avgpsi_tempfile.close()
-        leftjc_tempfile.close()
-        rightjc_tempfile.close()
-        totaljc_tempfile.close()
-        rightpsi_tempfile = open('rightpsi_temp.csv', 'r')
-        avgpsi_tempfile = open('avgpsi_temp.csv', 'r')
-        leftjc_tempfile = open('leftjc_temp.csv', 'r')
-        rightjc_tempfile = open('rightjc_temp.csv', 'r')
-        totaljc_tempfile = open('totaljc_temp.csv', 'r')
-        leftpsi_file = open('z_leftpsi.csv', 'a')
-        rightpsi_file = open('z_rightpsi.csv', 'a')
-        avgpsi_file = open('z_avgpsi.csv', 'a')
-        leftjc_file = open('z_leftjc.csv', 'a')
-        rightjc_file = open('z_rightjc.csv', 'a')
-        totaljc_file = open('z_totaljc.csv', 'a')
-
-        with open('leftpsi_temp.csv', 'r')  as leftpsi_tempfile:
-            for leftpsi_templine in leftpsi_tempfile:
-                leftpsi_templine = leftpsi_templine.split(',')
-                rightpsi_templine = rightpsi_tempfile.readline().split(',')
-                avgpsi_templine = avgpsi_tempfile.readline().split(',')
-                leftjc_templine = leftjc_tempfile.readline().split(',')
-                rightjc_templine = rightjc_tempfile.readline().split(',')
-                totaljc_templine = totaljc_tempfile.readline().split(',')
-                if re.match(regex, str(leftpsi_templine[1][0])) != None:
-                    if re.match(regex, str(rightpsi_templine[1][0])) != None:
-                        leftpsi_file.write(','.join(leftpsi_templine))
-                        rightpsi_file.write(','.join(rightpsi_templine))
-                        avgpsi_file.write(','.join(avgpsi_templine))
-                        leftjc_file.write(','.join(leftjc_templine))
-                        rightjc_file.write(','.join(rightjc_templine))
-                        totaljc_file.write(','.join(totaljc_templine))
-        rightpsi_tempfile.close()
-        avgpsi_tempfile.close()
-        leftjc_tempfile.close()
-        rightjc_tempfile.close()
-        totaljc_tempfile.close()
-        os.remove('leftpsi_temp.csv')
-        os.remove('rightpsi_temp.csv')
-        os.remove('avgpsi_temp.csv')
-        os.remove('leftjc_temp.csv')
-        os.remove('rightjc_temp.csv')
-        os.remove('totaljc_temp.csv')
-        leftpsi_file.close()
-        rightpsi_file.close()
-        avgpsi_file.close()
-        leftjc_file.close()
-        rightjc_file.close()
-        totaljc_file.close()
-
-    with open(exonList, 'r') as f:
-        for line in f:
-            inputlist.append(line)
-            counter = counter + 1
-            if counter % batchsize == 0:
-                with open('./input.tab', 'w') as exons:
-                    exons.writelines(inputlist)
-                inputlist = []
-                subprocess.run(qstr, shell=True)
-                splitOutput('./bulkoutput.csv')
-                resetfile = open('./bulkoutput.csv', 'w')
-                resetfile.close()
-                print('Exons processed = ' + str(counter) + time.strftime(", %b %d %Y %H:%M:%S"))
-        with open('./input.tab', 'w') as exons:
-            exons.writelines(inputlist)
-        inputlist = []
-        subprocess.run(qstr, shell=True)
-        splitOutput('./bulkoutput.csv')
-        resetfile = open('./bulkoutput.csv', 'w')
-        resetfile.close()
-        print('Total exons processed = ' + str(counter) + time.strftime(", %b %d %Y %H:%M:%S"))
-    os.remove('./input.tab')
-    os.remove('./bulkoutput.csv')
-
-    LPSI_filtered = open(cwd + '/a_LPSIfiltered.csv', 'w')
-    RPSI_filtered = open(cwd + '/a_RPSIfiltered.csv', 'w')
-    leftpsi_file = open(cwd + '/z_leftpsi.csv', 'r')
-    rightpsi_file = open(cwd + '/z_rightpsi.csv', 'r')
-    leftjc_file = open(cwd + '/z_leftjc.csv', 'r')
-    rightjc_file = open(cwd + '/z_rightjc.csv', 'r')
+    queriesPerBatch = 50
+    bulkFiles = ['z_leftpsi.csv', 'z_rightpsi.csv', 'z_avgpsi.csv', 'z_leftjc.csv', 'z_rightjc.csv',
+                 'z_totaljc.csv', 'y_inLR.csv', 'y_exLR.csv']
+    manifestFile = bulkDir + '/manifest.jsonl'
+    with open(exonList, 'rb') as f:
+        runInfo = {'exons': exonList, 'md5': hashlib.md5(f.read()).hexdigest(), 'cfg': configPreset,
+                   'queries_per_batch': queriesPerBatch}
+    checkpoint = None
+    if args.resume is not None and os.path.exists(manifestFile):
+        with open(manifestFile, 'r') as f:
+            manifest = f.read().split('\n')
+        if json.loads(manifest[0]) != runInfo:
+            sys.exit('Error: ' + outputDir + ' was made with a different exon list or config')
+        for line in manifest[1:]:
+            try:
+                checkpoint = json.loads(line)
+            except ValueError:  # blank, or cut off mid-write
+                pass
+    if checkpoint is None:
+        checkpoint = {'exons': 0, 'sizes': {}, 'done': False}
+        for x in bulkFiles:
+            open(bulkDir + '/' + x, 'w').close()
+        with open(manifestFile, 'w') as f:
+            f.write(json.dumps(runInfo) + '\n')
+    else:
+        for x, size in checkpoint['sizes'].items():
+            with open(bulkDir + '/' + x, 'r+b') as f:
+                f.truncate(size)
+        print('Resuming after ' + str(checkpoint['exons']) + ' exons')
+
+    def writeCheckpoint(storeWriter, exonsDone, done):
+        sizes = {}
+        for x in bulkFiles + [os.path.relpath(y, bulkDir) for y in storeWriter.filenames()]:
+            sizes[x] = os.path.getsize(bulkDir + '/' + x)
+        with open(manifestFile, 'a') as f:
+            f.write(json.dumps({'exons': exonsDone, 'sizes': sizes, 'done': done}) + '\n')
+
+    # Batches stream straight from rsrBulk, one record per exon with all of its metrics.
+    # Exons with numeric left and right PSI go to the per-metric z_*.csv tables and to the
+    # binary PSI store (one column per sample); the tables stay open for the whole run
+    if not checkpoint['done']:
+        bulk = BulkQuery(config_section=configPreset, queries_per_batch=queriesPerBatch, junctions=args.junctions,
+                         concurrency=args.q, cache=args.cache, cache_size=args.cachesize * 1024 ** 2)
+        zFiles = [['LeftPSI', 'z_leftpsi.csv'], ['RightPSI', 'z_rightpsi.csv'], ['AvgPSI', 'z_avgpsi.csv'],
+                  ['LeftJunctionCount', 'z_leftjc.csv'], ['RightJunctionCount', 'z_rightjc.csv'],
+                  ['TotalJunctionCount', 'z_totaljc.csv']]
+        for x in zFiles:
+            x[1] = open(bulkDir + '/' + x[1], 'a', buffering=1024 ** 2)
+        printed = checkpoint['exons']
+        with open(exonList, 'r') as f, open(bulkDir + '/y_inLR.csv', 'a') as inLR, \
+                open(bulkDir + '/y_exLR.csv', 'a') as exLR, \
+                StoreWriter(storeDir, bulk.n_groups, append=checkpoint['exons'] > 0) as storeWriter:
+            for records in bulk.batches(f, skip=checkpoint['exons']):
+                for record in records:
+                    if record['inLR'] is not None:
+                        inLR.write(record['inLR'] + '\n')
+                    if record['exLR'] is not None:
+                        exLR.write(record['exLR'] + '\n')
+                    if 'values' in record:
+                        storeWriter.append(record['exon_id'], record['values'])
+                        for metric, zFile in zFiles:
+                            zFile.write(record['exon_id'] + ',' + record[metric] + '\n')
+                for _, zFile in zFiles:
+                    zFile.flush()
+                inLR.flush()
+                exLR.flush()
+                storeWriter.flush()
+                writeCheckpoint(storeWriter, bulk.exons_done, False)
+                if bulk.exons_done - printed >= batchsize:
+                    printed = bulk.exons_done
+                    print('Exons processed = ' + str(printed) + time.strftime(", %b %d %Y %H:%M:%S"))
+            writeCheckpoint(storeWriter, bulk.exons_done, True)
+        for _, zFile in zFiles:
+            zFile.close()
+        print('Total exons processed = ' + str(bulk.exons_done) + time.strftime(", %b %d %Y %H:%M:%S"))
+        if bulk.client.stats() is not None:
+            print(bulk.client.stats())
+        bulk.client.close()
+
+    # PSI/junction count strings and top/bottom 5 PSIs per exon, from the PSI store.
+    # For PSImax/PSImin, PSIs of samples with fewer than minJC junctions are set to -1
+    store = PSIStore(storeDir)
+    PSImax = np.empty((len(store), 10))
+    PSImin = np.empty((len(store), 10))
     leftjc = {}
     rightjc = {}
-    for line in leftpsi_file:
-        LPSI_list = line.strip().split(',')
-        RPSI_list = rightpsi_file.readline().strip().split(',')
-        LJC_temp = leftjc_file.readline().strip().split(',', 1)
-        RJC_temp = rightjc_file.readline().strip().split(',', 1)
-        leftjc[LJC_temp[0]] = LJC_temp[1]
-        rightjc[RJC_temp[0]] = RJC_temp[1]
-        LJC_list = [LJC_temp[0]]
-        LJC_list.extend(LJC_temp[1].split(','))
-        RJC_list = [RJC_temp[0]]
-        RJC_list.extend(RJC_temp[1].split(','))
-        for ix in range(1, len(LPSI_list)):
-            if int(LJC_list[ix]) < minJC:
-                LPSI_list[ix] = '-1'
-            if int(RJC_list[ix]) < minJC:
-                RPSI_list[ix] = '-1'
-        LPSI_filtered.write(','.join(LPSI_list) + '\n')
-        RPSI_filtered.write(','.join(RPSI_list) + '\n')
-    LPSI_filtered.close()
-    RPSI_filtered.close()
-    leftpsi_file.close()
-    rightpsi_file.close()
-    leftjc_file.close()
-    rightjc_file.close()
+    for lo in range(0, len(store), 5000):
+        hi = min(lo + 5000, len(store))
+        LJC_rows = store.matrix('LeftJunctionCount')[lo:hi]
+        RJC_rows = store.matrix('RightJunctionCount')[lo:hi]
+        LPSI_filtered = np.where(LJC_rows < minJC, -1.0, store.matrix('LeftPSI')[lo:hi])
+        RPSI_filtered = np.where(RJC_rows < minJC, -1.0, store.matrix('RightPSI')[lo:hi])
+        PSImax[lo:hi, :5], PSImin[lo:hi, :5] = rankPSI(LPSI_filtered)
+        PSImax[lo:hi, 5:], PSImin[lo:hi, 5:] = rankPSI(RPSI_filtered)
+        for ix in range(hi - lo):
+            exonID = store.exon_ids[lo + ix]
+            leftjc[exonID] = jc_str(LJC_rows[ix])
+            rightjc[exonID] = jc_str(RJC_rows[ix])
+    PSImax = pd.DataFrame(PSImax, index=store.exon_ids,
+                          columns=[side + 'PSImax' + str(x) for side in 'LR' for x in range(1, 6)])
+    PSImin = pd.DataFrame(PSImin, index=store.exon_ids,
+                          columns=[side + 'PSImin' + str(x) for side in 'LR' for x in range(1, 6)])
     pickle.dump(leftjc, open(dictDir + '/leftjc.pickle', 'wb'), protocol=pickle.HIGHEST_PROTOCOL)
     pickle.dump(rightjc, open(dictDir + '/rightjc.pickle', 'wb'), protocol=pickle.HIGHEST_PROTOCOL)
     # leftjc = pickle.load(open(dictDir + '/leftjc.pickle', 'rb'))
     # rightjc = pickle.load(open(dictDir + '/rightjc.pickle', 'rb'))
-    shutil.move(cwd + '/a_LPSIfiltered.csv', bulkDir + '/a_LPSIfiltered.csv')
-    shutil.move(cwd + '/a_RPSIfiltered.csv', bulkDir + '/a_RPSIfiltered.csv')
-    shutil.move(cwd + '/z_leftjc.csv', bulkDir + '/z_leftjc.csv')
-    shutil.move(cwd + '/z_rightjc.csv', bulkDir + '/z_rightjc.csv')
-    shutil.move(cwd + '/y_exLR.csv', bulkDir + '/y_exLR.csv')
-    shutil.move(cwd + '/z_totaljc.csv', bulkDir + '/z_totaljc.csv')
-    shutil.move(cwd + '/z_leftpsi.csv', bulkDir + '/z_leftpsi.csv')
-    shutil.move(cwd + '/z_rightpsi.csv', bulkDir + '/z_rightpsi.csv')
-    shutil.move(cwd + '/z_avgpsi.csv', bulkDir + '/z_avgpsi.csv')
-    shutil.move(cwd + '/y_inLR.csv', bulkDir + '/y_inLR.csv')
 
     with open(bulkDir + '/run_parameters.txt', 'w') as f:
         f.write('Snaptron query saved to: ' + bulkDir)
@@ -513,81 +361,62 @@ if __name__ == '__main__':
     print(time.strftime('%-m/%-d/%Y || %-I:%M%p UTC || Classify exons from Snaptron output'))
 
     exid2loc = pickle.load(open(dictDir + '/exid2loc.pickle', 'rb'))
-    chrList = []
+    # Split the input by chromosome in one pass
+    sdirList = []
+    chrInput = {}
     with open(classifyInput, 'r') as f:
         for line in f:
             chr = exid2loc[line.split(',')[0]].split(':')[0]
-            if chr not in chrList:
-                chrList.append(chr)
+            if chr not in chrInput:
+                sdirList.append([classifyDir + '/' + chr, chr])
+                if not os.path.exists(sdirList[-1][0]):
+                    os.makedirs(sdirList[-1][0])
+                with open(sdirList[-1][0] + '/rsr-cleanup.log', 'w') as log:
+                    log.write('rsr-cleanup timeline:\n')
+                chrInput[chr] = open(sdirList[-1][0] + '/y_input_v1.csv', 'w')
+            chrInput[chr].write(line)
+    for x in chrInput.values():
+        x.close()
 
-    sdirList = []
-    for x in chrList:
-        sdirList.append([classifyDir + '/' + x, x])
-    for x in sdirList:
-        if not os.path.exists(x[0]):
-            os.makedirs(x[0])
-    for x in sdirList:
-        with open(x[0] + '/rsr-cleanup.log', 'w') as f:
-            f.write('rsr-cleanup timeline:\n')
-        with open(x[0] + '/y_input_v1.csv', 'w') as input_v1:
-            with open(classifyInput, 'r') as f:
-                for line in f:
-                    chr = exid2loc[line.split(',')[0]].split(':')[0]
-                    if chr == x[1]:
-                        input_v1.write(line)
-
-    PSImax = {}
-    PSImin = {}
-    with open(bulkDir + '/a_RPSIfiltered.csv', 'r') as R_File:
-        with open(bulkDir + '/a_LPSIfiltered.csv', 'r') as L_File:
-            for line in L_File:
-                LF_line = [x for x in line.strip().split(',') if x != '']
-                RF_line = [x for x in R_File.readline().strip().split(',') if x != '']
-                exonID = LF_line[0]
-                LPSI_list = [float(x) for x in LF_line[1:]]
-                RPSI_list = [float(x) for x in RF_line[1:]]
-                L5high = sorted(LPSI_list, reverse=True)[0:5]
-                R5high = sorted(RPSI_list, reverse=True)[0:5]
-                L5high.extend(R5high)
-                PSImax[exonID] = ','.join(str(x) for x in L5high)
-                L5low = [777 if x == -1 else x for x in LPSI_list]
-                R5low = [777 if x == -1 else x for x in RPSI_list]
-                L5low = sorted(L5low)[0:5]
-                R5low = sorted(R5low)[0:5]
-                L5low.extend(R5low)
-                L5low = [-1 if x == 777 else x for x in L5low]
-                PSImin[exonID] = ','.join(str(x) for x in L5low)
-    LPSI = {}
-    RPSI = {}
-    with open(bulkDir + '/z_rightpsi.csv', 'r') as R_File:
-        with open(bulkDir + '/z_leftpsi.csv', 'r') as L_File:
-            for line in L_File:
-                LF_line = [x for x in line.strip().split(',') if x != '']
-                RF_line = [x for x in R_File.readline().strip().split(',') if x != '']
-                exonID = LF_line[0]
-                LPSI[exonID] = ','.join(LF_line[1:])
-                RPSI[exonID] = ','.join(RF_line[1:])
     pickle.dump(PSImax, open(dictDir + '/PSImax.pickle', "wb"), protocol=pickle.HIGHEST_PROTOCOL)
     pickle.dump(PSImin, open(dictDir + '/PSImin.pickle', "wb"), protocol=pickle.HIGHEST_PROTOCOL)
-    pickle.dump(LPSI, open(dictDir + '/LPSI.pickle', "wb"), protocol=pickle.HIGHEST_PROTOCOL)
-    pickle.dump(RPSI, open(dictDir + '/RPSI.pickle', "wb"), protocol=pickle.HIGHEST_PROTOCOL)
 
     with open('time.log', 'a') as f:
-        f.write(time.strftime('%-m/%-d/%Y || %-I:%M%p UTC || Created PSImax/PSImin/LPSI/RPSI dictionaries\n'))
-    print(time.strftime('%-m/%-d/%Y || %-I:%M%p UTC || Created PSImax/PSImin/LPSI/RPSI dictionaries'))
+        f.write(time.strftime('%-m/%-d/%Y || %-I:%M%p UTC || Created PSImax/PSImin tables\n'))
+    print(time.strftime('%-m/%-d/%Y || %-I:%M%p UTC || Created PSImax/PSImin tables'))
 
     # =========================================================================================
     # First multithreading step
-    manager = Manager()
-    dict_1a = manager.dict()
-    dict_1b = manager.dict()
-    dict_1a.update(LPSI)
-    dict_1b.update(RPSI)
-    pool = multiprocessing.Pool(processes=numProcesses)
-    for x in sdirList:
-        pool.apply_async(worker1, args=(x[0], dictDir, dict_1a, dict_1b,))
+    # Chromosomes are classified in genomic blocks (rsrBlocks), one round of blocks per
+    # classification run.  Blocks run largest first, so a large chromosome no longer
+    # keeps one process busy while the others are idle, and a chromosome's next round
+    # is queued as soon as its own blocks are done.  Job callbacks only report the
+    # finished block; get() takes the result, or raises the worker's error, here
+    chromosomes = [ChromosomeBlocks(x[0], exid2loc, exid2strand, PSImax, PSImin, args.block) for x in sdirList]
+    pool = multiprocessing.Pool(processes=numProcesses, initializer=attachPoolData, initargs=(storeDir, dictDir))
+    finished = queue.Queue()
+    jobs = {}
+    running = {}
+
+    def submitBlocks(blocks):
+        for x in sorted(blocks, key=lambda x: x['size'], reverse=True):
+            done = lambda result, bdir=x['dir']: finished.put(bdir)
+            jobs[x['dir']] = (x, pool.apply_async(worker1, args=(x['dir'], x['context'], x['exons'], args.keep == 1,),
+                                                  callback=done, error_callback=done))
+            running[x['chromosome']] = running.get(x['chromosome'], 0) + 1
+
+    submitBlocks([x for c in chromosomes for x in c.next_blocks()])
+    while len(jobs) > 0:
+        x, job = jobs.pop(finished.get())
+        c = x['chromosome']
+        c.add_result(x, job.get())
+        running[c] = running[c] - 1
+        if running[c] == 0:
+            submitBlocks(c.next_blocks())
     pool.close()
     pool.join()
+    for c in chromosomes:
+        c.write_results()
     df6List = []
     dfcList = []
 
@@ -644,19 +473,6 @@ if __name__ == '__main__':
     df_main['RASS'] = 'No'
     df_main['LINKED'] = 'No'
 
-    ixList = []
-    a = len(df_main.index)
-    b = int(a / 5000)
-    floor = 0
-    fcount = 1
-    fname = ''
-    for x in range(b):
-        ceiling = (x + 1) * 5000
-        fname = 'temp' + str(fcount) + '.csv'
-        ixList.append([floor, ceiling, fname])
-        floor = ceiling + 1
-        fcount = fcount + 1
-    ixList.append([floor, a - 1, 'temp' + str(fcount) + '.csv'])
     df_main['Colon'] = ':'
     df_main['Dash'] = '-'
     df_main['ExonLocation'] = df_main['ExonChr'].map(str) + df_main['Colon'] + df_main['ExonStart'].astype(str) + \
@@ -665,56 +481,75 @@ if __name__ == '__main__':
                               df_main['Dash'] + df_main['1_ERE'].astype(str)
     df_main = df_main.drop(['Colon', 'Dash'], axis=1)
 
-    metaLASS = {}
-    metaRASS = {}
-    for ix in range(len(df_main.index)):
-        exonClass = df_main['ExonID'][ix].split('_')[0]
-        if exonClass == 'LASS':
-            metaLASS[df_main['ExonID'][ix]] = df_main['MetadataLASS'][ix]
-        if exonClass == 'RASS':
-            metaRASS[df_main['ExonID'][ix]] = df_main['MetadataRASS'][ix]
-    LPSI = pickle.load(open(dictDir + '/LPSI.pickle', 'rb'))
-    RPSI = pickle.load(open(dictDir + '/RPSI.pickle', 'rb'))
-
-    with open('time.log', 'a') as f:
-        f.write(time.strftime('%-m/%-d/%Y || %-I:%M%p UTC || Created metaLASS/metaRASS dictionaries\n'))
-    print(time.strftime('%-m/%-d/%Y || %-I:%M%p UTC || Created metaLASS/metaRASS dictionaries'))
-    
-    # =========================================================================================
-    # Second multithreading step
-    dict_2a = manager.dict()
-    dict_2b = manager.dict()
-    dict_2c = manager.dict()
-    dict_2d = manager.dict()
-    dict_2a.update(metaLASS)
-    dict_2b.update(metaRASS)
-    dict_2c.update(LPSI)
-    dict_2d.update(RPSI)
-    pool = multiprocessing.Pool(processes=numProcesses)
-    for x in ixList:
-        dfsubset = df_main.iloc[(df_main.index >= x[0]) & (df_main.index <= x[1])]
-        pool.apply_async(worker2, args=(dfsubset, x[2], dict_2a, dict_2b, dict_2c, dict_2d,))
-    pool.close()
-    pool.join()
-
-    with open('df7temp.csv', 'w') as df7temp:
-        with open(ixList[0][2], 'r') as header:
-            df7temp.write(header.readline())
-        for x in ixList:
-            with open(x[2], 'r') as f:
-                next(f)
-                for line in f:
-                    df7temp.write(line)
-            os.remove(x[2])
-    with open('df7temp.csv', 'r') as f:
-        df_main = pd.read_csv(f, sep=',', index_col=0)
-    os.remove('df7temp.csv')
-    df_main = df_main.reset_index(drop=True)
+    # LeftID/RightID: the exon itself, or the exons merged into its LASS/RASS record
+    hasLASS = df_main['MetadataLASS'] != 'None'
+    hasRASS = df_main['MetadataRASS'] != 'None'
+    firstLASS = df_main['MetadataLASS'].str.split(',', n=1).str[0]
+    firstRASS = df_main['MetadataRASS'].str.split(',', n=1).str[0]
+    df_main['LeftID'] = df_main['ExonID'].mask(hasLASS, df_main['MetadataLASS']).mask(hasRASS, firstRASS)
+    df_main['RightID'] = df_main['ExonID'].mask(hasLASS, firstLASS).mask(hasRASS, df_main['MetadataRASS'])
+    classified = df_main['ExonClass'].isin(['Cassette', 'LASS', 'RASS']) | (df_main['MetadataMUTEX'] != 'None')
+    if (classified & hasLASS & hasRASS).any():
+        sys.exit('Error in LeftID/RightID processing: ExonID is both LASS and RASS')
+
+    # LINKED records take the left side of their first exon and the right side of their second,
+    # resolving LASS/RASS records to their merged exons; a LASS record linked to a RASS record is dropped
+    exonClass = df_main['ExonID'].str.split('_').str[0]
+    metaLASS = dict(zip(df_main['ExonID'][exonClass == 'LASS'], df_main['MetadataLASS'][exonClass == 'LASS']))
+    metaRASS = dict(zip(df_main['ExonID'][exonClass == 'RASS'], df_main['MetadataRASS'][exonClass == 'RASS']))
+    linked = df_main['ExonClass'] == 'LINKED'
+    linkIDs = df_main['MetadataLINKED'][linked].str.split(',')
+    linkLeft = linkIDs.str[0]
+    linkRight = linkIDs.str[1]
+    leftClass = linkLeft.str.split('_').str[0]
+    rightClass = linkRight.str.split('_').str[0]
+    mixed = leftClass.isin(['LASS', 'RASS']) & rightClass.isin(['LASS', 'RASS']) & (leftClass != rightClass)
+    linkLeft = linkLeft.mask(leftClass == 'LASS', linkLeft.map(metaLASS))
+    linkLeft = linkLeft.mask(leftClass == 'RASS', linkLeft.map(metaRASS).str.split(',', n=1).str[0])
+    linkRight = linkRight.mask(rightClass == 'LASS', linkRight.map(metaLASS).str.split(',', n=1).str[0])
+    linkRight = linkRight.mask(rightClass == 'RASS', linkRight.map(metaRASS))
+    df_main.loc[linked, 'LeftID'] = linkLeft
+    df_main.loc[linked, 'RightID'] = linkRight
+    df_main = df_main[(linked & ~mixed.reindex(df_main.index, fill_value=False)) | (~linked & classified)]
+
+    # ExonLength, one length per start site of LASS records and per end site of RASS records
+    exonStart = df_main['ExonStart'].astype(str)
+    exonEnd = df_main['ExonEnd'].astype(str)
+    pipedStart = exonStart.str.contains('|', regex=False)
+    pipedEnd = exonEnd.str.contains('|', regex=False)
+    if (pipedStart & pipedEnd).any():
+        sys.exit('Error in calculating exon length: exon is both LASS and RASS')
+    plain = ~pipedStart & ~pipedEnd
+    lengths = exonEnd[plain].astype(np.int64) - exonStart[plain].astype(np.int64) + 1
+    df_main.loc[plain, 'ExonLength'] = lengths.astype(str)
+    for piped, sites, other, sign in [(pipedStart, exonStart, exonEnd, -1), (pipedEnd, exonEnd, exonStart, 1)]:
+        if piped.any():
+            sites = sites[piped].str.split('|').explode().astype(np.int64)
+            lengths = sign * (sites - other[piped].astype(np.int64).reindex(sites.index)) + 1
+            df_main.loc[piped, 'ExonLength'] = lengths.astype(str).groupby(level=0).agg('|'.join)
+
+    # LeftPSIstr/RightPSIstr, summed over the PSI matrix rows of merged exons.  The sums are kept
+    # for the output store; <side>SumRow is the row of a merged exon in them, -1 for other exons
+    psiSums = {}
+    for side, leftOrRight, strings in [('Left', 'LEFT', PSIStrings(store, 'LeftPSI')),
+                                       ('Right', 'RIGHT', PSIStrings(store, 'RightPSI'))]:
+        exIDs = df_main[side + 'ID'].str.split(',')
+        merged = exIDs.str.len() > 1
+        df_main.loc[~merged, side + 'PSIstr'] = strings.lookup(exIDs[~merged].str[0])
+        psiSums[side] = addPSI(store, exIDs[merged].tolist(), leftOrRight)
+        df_main[side + 'SumRow'] = -1
+        df_main.loc[merged, side + 'SumRow'] = np.arange(merged.sum())
+        df_main.loc[merged, side + 'PSIstr'] = [sumStr(x) for x in psiSums[side]]
+
+    df_main.loc[df_main['MetadataLASS'] != 'None', 'LASS'] = 'Yes'
+    df_main.loc[df_main['MetadataRASS'] != 'None', 'RASS'] = 'Yes'
+    df_main.loc[df_main['MetadataLINKED'] != 'None', 'LINKED'] = 'Yes'
+    df_main = restoreTypes(df_main.reset_index(drop=True))
     df_main.rename(columns={'MetadataMUTEX': 'MUTEX', 'Cassette': 'CASSETTE'}, inplace=True)
 
     with open('time.log', 'a') as f:
-        f.write(time.strftime('%-m/%-d/%Y || %-I:%M%p UTC || Second multithreading step complete\n'))
-    print(time.strftime('%-m/%-d/%Y || %-I:%M%p UTC || Second multithreading step complete'))
+        f.write(time.strftime('%-m/%-d/%Y || %-I:%M%p UTC || Exon metadata added\n'))
+    print(time.strftime('%-m/%-d/%Y || %-I:%M%p UTC || Exon metadata added'))
 
     # =========================================================================================
     # Generate new exon list
@@ -741,69 +576,18 @@ if __name__ == '__main__':
 
     # =========================================================================================
     # Create genesym2attr and boundary2gene dictionaries
-    parseGTF = 1
-    if parseGTF == 1:
-        geneBed = open('geneLocation.bed', 'w')
-        name2id = {}
-        with open(gtfPath, 'r') as gtf:
-            count = 1
-            for line in gtf:
-                if line[0:2] == '##':
-                    pass
-                else:
-                    elem = line.split('\t')
-                    if elem[2] == 'gene':
-                        chr = elem[0]
-                        start = elem[3]
-                        end = elem[4]
-                        strand = elem[6]
-                        gene_id = ''
-                        gene_type = ''
-                        gene_name = ''
-                        attributes = re.split(r'[ ;]', elem[8].replace('"', ''))
-                        for ix in range(len(attributes)):
-                            if attributes[ix] == 'gene_id':
-                                gene_id = attributes[ix + 1]
-                            if attributes[ix] == 'gene_type':
-                                gene_type = attributes[ix + 1]
-                            elif attributes[ix] == 'gene_name':
-                                gene_name = attributes[ix + 1]
-                        geneBed.write('\t'.join([chr, start, end, gene_id, '1', strand]) + '\n')
-                        name2id[gene_id] = gene_name + ',' + gene_type
-        geneBed.close()
-        pickle.dump(name2id, open(dictDir + '/genesym2attr.pickle', 'wb'), protocol=pickle.HIGHEST_PROTOCOL)
-
-    df_main['TempScore'] = '1'
-    boundaryBed = df_main[['ExonChr', '1_ELS', '1_ERE', 'ExonID', 'TempScore', 'ExonStrand']]
-    boundaryBed = boundaryBed.sort_values(['1_ELS', 'ExonChr'], ascending=[True, True])
-    boundaryBed.to_csv('df7b2b.bed', sep='\t', header=False, index=False)
-    subprocess.run('bedtools sort -i df7b2b.bed > df7b2b_sorted.bed', shell=True)
-    subprocess.run('bedtools sort -i geneLocation.bed > geneLocation_sorted.bed', shell=True)
-    subprocess.run('bedtools closest -s -d -k 10 -a df7b2b_sorted.bed \
-                                                 -b geneLocation_sorted.bed > closestGene.bed', shell=True)
-    boundary2gene = {}
-    with open('closestGene.bed', 'r') as f:
-        exID_track = ''
-        dist_track = -1
-        for line in f:
-            a = line.split('\t')
-            chr = a[0]
-            exID = a[3]
-            boundaryStart = int(a[1])
-            boundaryEnd = int(a[2])
-            geneID = a[9]
-            dist = int(a[12])
-            geneType = name2id[geneID].split(',')[1]
-            if exID != exID_track:
-                exID_track = exID
-                dist_track = -1
-                if dist < 10000:
-                    dist_track = dist
-                    boundary2gene[chr + ':' + str(boundaryStart) + '-' + str(boundaryEnd)] = geneID
-            else:
-                if geneType == 'protein_coding' and dist <= dist_track:
-                    dist_track = dist
-                    boundary2gene[chr + ':' + str(boundaryStart) + '-' + str(boundaryEnd)] = geneID
+    genes = gene_table(gtfPath)
+    name2id = dict(zip(genes['gene_id'], genes['gene_name'] + ',' + genes['gene_type']))
+    pickle.dump(name2id, open(dictDir + '/genesym2attr.pickle', 'wb'), protocol=pickle.HIGHEST_PROTOCOL)
+
+    # Closest gene of each exon boundary on its strand, within 10 kb; a protein coding gene wins
+    # a tie.  Exons sharing a boundary are looked up in table order and the last one found is kept
+    geneIndex = GeneIndex(genes['chr'], genes['start'], genes['end'], genes['strand'], genes['gene_id'],
+                          genes['gene_id'].map(name2id).str.split(',').str[1] == 'protein_coding')
+    closestGene = geneIndex.closest(df_main['ExonChr'], df_main['1_ELS'], df_main['1_ERE'], df_main['ExonStrand'],
+                                    10000)
+    found = pd.notnull(closestGene)
+    boundary2gene = dict(zip(df_main['ExonBoundary'][found], closestGene[found]))
     pickle.dump(boundary2gene, open(dictDir + '/boundary2gene.pickle', 'wb'), protocol=pickle.HIGHEST_PROTOCOL)
 
     with open('time.log', 'a') as f:
@@ -824,14 +608,10 @@ if __name__ == '__main__':
     df_main['RJCID'] = df_main['RightID'].str.split(',', expand=True, n=1)[0]
     df_main['LeftJCstr'] = df_main['LJCID'].map(leftjc)
     df_main['RightJCstr'] = df_main['RJCID'].map(rightjc)
-    os.remove('geneLocation.bed')
-    os.remove('df7b2b.bed')
-    os.remove('closestGene.bed')
-    os.remove('geneLocation_sorted.bed')
-    os.remove('df7b2b_sorted.bed')
-    df_main = df_main[['ExonID', 'LeftID', 'RightID', 'CASSETTE', 'LASS', 'RASS', 'LINKED', 'MUTEX',
-                       'GeneID', 'GeneSymbol', 'GeneType', 'ExonLocation', 'ExonBoundary', 'ExonStrand', 'ExonLength',
-                       'LeftJCstr', 'RightJCstr', 'LeftPSIstr', 'RightPSIstr']]
+    outColumns = ['ExonID', 'LeftID', 'RightID', 'CASSETTE', 'LASS', 'RASS', 'LINKED', 'MUTEX',
+                  'GeneID', 'GeneSymbol', 'GeneType', 'ExonLocation', 'ExonBoundary', 'ExonStrand', 'ExonLength',
+                  'LeftJCstr', 'RightJCstr', 'LeftPSIstr', 'RightPSIstr']
+    df_main = df_main[outColumns + ['LeftSumRow', 'RightSumRow']]
 
     dropList = []
     for ix in df_main.index:
@@ -841,7 +621,34 @@ if __name__ == '__main__':
     df_main['MUTEX'] = df_main['MUTEX'].replace('None', 'No')
     df_main.loc[df_main['LASS'] == 'Yes', 'CASSETTE'] = 'No'
     df_main.loc[df_main['RASS'] == 'Yes', 'CASSETTE'] = 'No'
-    df_main.to_csv(args.out, sep='\t', index=False)
+    df_main[outColumns].to_csv(args.out, sep='\t', index=False)
+
+    # Binary LeftPSIstr/RightPSIstr/LeftJCstr/RightJCstr matrices, rows in output order, written
+    # 1000 rows at a time.  Merged PSI rows are taken from the sums above; other rows are
+    # gathered from the store matrices with one read per metric
+    if os.path.exists(outStore):
+        shutil.rmtree(outStore)
+
+    def outRows(rows, side, metric):
+        matrix = np.full((len(rows.index), store.columns), np.nan)
+        storeRows = rows[side + 'ID'].str.split(',', n=1).str[0].map(store.index)
+        found = storeRows.notnull().values
+        matrix[found] = store.matrix(metric)[storeRows[found].astype(np.int64).values]
+        if metric.endswith('PSI'):
+            sumRows = rows[side + 'SumRow'].values
+            matrix[sumRows >= 0] = psiSums[side][sumRows[sumRows >= 0]]
+        return matrix
+
+    outMetrics = [('LeftPSI', 'float64'), ('RightPSI', 'float64'),
+                  ('LeftJunctionCount', 'float64'), ('RightJunctionCount', 'float64')]
+    with StoreWriter(outStore, store.columns, outMetrics) as out:
+        for lo in range(0, len(df_main.index), 1000):
+            rows = df_main.iloc[lo:lo + 1000]
+            out.append_rows(rows['ExonID'].tolist(), {
+                'LeftPSI': outRows(rows, 'Left', 'LeftPSI'),
+                'RightPSI': outRows(rows, 'Right', 'RightPSI'),
+                'LeftJunctionCount': outRows(rows, 'Left', 'LeftJunctionCount'),
+                'RightJunctionCount': outRows(rows, 'Right', 'RightJunctionCount')})
 
     with open('time.log', 'a') as f:
         f.write(time.strftime('%-m/%-d/%Y || %-I:%M%p UTC || Run Complete\n'))
@@ -8,6 +8,7 @@ import pandas as pd
 pd.options.mode.chained_assignment = None
 import warnings
 warnings.simplefilter(action='ignore', category=FutureWarning)
+from rsrStore import PSIStore
 
 
 parser = argparse.ArgumentParser(formatter_class=RawTextHelpFormatter, description="""
@@ -35,6 +36,10 @@ parser.add_argument('--f', action='store',
                     type=float,
                     default=0.5,
                     help='PSI fraction cutoff')
+parser.add_argument('--store', action='store',
+                    default=None,
+                    help='PSI/junction count store written by rsrMain.py for --i;\n'
+                         'read instead of parsing the PSI/JC strings')
 args = parser.parse_args()
 
 # ==========================================================
@@ -59,7 +64,7 @@ for a in linkedSamples:
 # Merge sample PSI
 # ==========================================================
 
-df_main = pd.read_csv(exondata, sep='\t')
+df_main = pd.read_csv(exondata, sep='\t', dtype={'ExonID': str})
 # Available metadata:
 #   'ExonID', 'CASSETTE', 'LASS', 'RASS', 'LINKED', 'MUTEX',
 #   'GeneID', 'GeneSymbol', 'GeneType',
@@ -71,14 +76,24 @@ df_rpsi = df_main[['ExonID', 'RightPSIstr']]
 df_ljc = df_main[['ExonID', 'LeftJCstr']]
 df_rjc = df_main[['ExonID', 'RightJCstr']]
 
-df_lpsi[columns] = df_lpsi['LeftPSIstr'].str.split(',', expand=True).astype(float)
-print('Split LeftPSIstr')
-df_rpsi[columns] = df_rpsi['RightPSIstr'].str.split(',', expand=True).astype(float)
-print('Split RightPSIstr')
-df_ljc[columns] = df_ljc['LeftJCstr'].str.split(',', expand=True).astype(float)
-print('Split LeftJCstr')
-df_rjc[columns] = df_rjc['RightJCstr'].str.split(',', expand=True).astype(float)
-print('Split RightJCstr')
+if args.store is not None:
+    store = PSIStore(args.store)
+    if store.exon_ids != df_main['ExonID'].tolist():
+        raise RuntimeError('--store does not match --i: ' + args.store)
+    df_lpsi[columns] = pd.DataFrame(store.matrix('LeftPSI'), index=df_main.index, columns=columns)
+    df_rpsi[columns] = pd.DataFrame(store.matrix('RightPSI'), index=df_main.index, columns=columns)
+    df_ljc[columns] = pd.DataFrame(store.matrix('LeftJunctionCount'), index=df_main.index, columns=columns)
+    df_rjc[columns] = pd.DataFrame(store.matrix('RightJunctionCount'), index=df_main.index, columns=columns)
+    print('Loaded PSI/JC matrices from ' + args.store)
+else:
+    df_lpsi[columns] = df_lpsi['LeftPSIstr'].str.split(',', expand=True).astype(float)
+    print('Split LeftPSIstr')
+    df_rpsi[columns] = df_rpsi['RightPSIstr'].str.split(',', expand=True).astype(float)
+    print('Split RightPSIstr')
+    df_ljc[columns] = df_ljc['LeftJCstr'].str.split(',', expand=True).astype(float)
+    print('Split LeftJCstr')
+    df_rjc[columns] = df_rjc['RightJCstr'].str.split(',', expand=True).astype(float)
+    print('Split RightJCstr')
 df_lpsi.drop(['ExonID', 'LeftPSIstr'], axis=1, inplace=True)
 df_rpsi.drop(['ExonID', 'RightPSIstr'], axis=1, inplace=True)
 df_ljc.drop(['ExonID', 'LeftJCstr'], axis=1, inplace=True)
@@ -2,12 +2,14 @@ import argparse
 from argparse import RawTextHelpFormatter
 import configparser
 import os
+import sys
 import numpy as np
-import re
 import pandas as pd
 pd.options.mode.chained_assignment = None
 import warnings
 warnings.simplefilter(action='ignore', category=FutureWarning)
+from rsrGenes import gene_table
+from rsrGzip import open_binary
 
 
 parser = argparse.ArgumentParser(formatter_class=RawTextHelpFormatter, description="""
@@ -23,10 +25,15 @@ parser.add_argument('--cfglinked', action='store',
                     help='Linked config preset')
 parser.add_argument('--gc', action='store',
                     required=True,
-                    help='Snaptron gene coverage normalized file')
+                    help='Snaptron gene coverage normalized file (plain, gzip or BGZF compressed),\n'
+                         'or a comma-separated list of them for a config with several data sources')
 parser.add_argument('--gco', action='store',
                     default='merged_gene_coverage.tsv',
                     help='Gene coverage output')
+parser.add_argument('--chunk', action='store',
+                    type=int,
+                    default=2000,
+                    help='Genes read from the gene coverage file(s) at a time')
 parser.add_argument('--gtf', action='store',
                     default='gencode.vM15.basic.annotation.gtf',
                     help='Reference GTF')
@@ -35,9 +42,10 @@ args = parser.parse_args()
 # ==========================================================
 linkedPreset = args.cfglinked
 allPreset = args.cfgall
-genecov = args.gc
+genecov = args.gc.split(',')
 nauc_output = args.gco
 reference_gtf = args.gtf
+chunkRows = args.chunk
 
 # ==========================================================
 cwd = os.getcwd()
@@ -54,55 +62,82 @@ for a in linkedSamples:
 # Merge gene coverage
 # ==========================================================
 
-# Parse gencode GTF, make name2id dictionary
-geneid2genesymbol = {}
-with open(reference_gtf, 'r') as gtf:
-    for line in gtf:
-        if line[0:2] == '##':
-            pass
-        else:
-            elem = line.split('\t')
-            if elem[2] == 'gene':
-                chr = elem[0]
-                start = elem[3]
-                end = elem[4]
-                strand = elem[6]
-                gene_id = ''
-                gene_type = ''
-                gene_name = ''
-                attributes = re.split(r'[ ;]', elem[8].replace('"', ''))
-                for ix in range(len(attributes)):
-                    if attributes[ix] == 'gene_id':
-                        gene_id = attributes[ix + 1].split('.')[0]
-                    if attributes[ix] == 'gene_type':
-                        gene_type = attributes[ix + 1]
-                    if attributes[ix] == 'gene_name':
-                        gene_name = attributes[ix + 1]
-                geneid2genesymbol[gene_id] = gene_name
+# Gene symbols by version-stripped gene ID, from the compiled gene table of the GTF
+genes = gene_table(reference_gtf)
+geneid2genesymbol = dict(zip(genes['gene_base_id'], genes['gene_name']))
 
 
-df_genecov = pd.read_csv(genecov, sep='\t')
-columns = df_genecov.columns.values.tolist()[1:]
-
-# Convert sColumns and columns from int to str
+# Convert sColumns from int to str
 for x in range(len(sColumns)):
     for y in range(len(sColumns[x])):
         sColumns[x][y] = str(sColumns[x][y])
-for x in range(len(columns)):
-    columns[x] = str(columns[x])
+needed = set(c for x in sColumns for c in x)
 
+# Label grouping, compiled once per coverage file into a samples x labels weight matrix; every
+# label's mean is the sum of its sample columns divided by scalingfactor * samples.  Labels that
+# appear more than once keep their last sample list, as before
 scalingfactor = 1000
-for i in range(len(sLabels)):
-    print('GeneCov: ' + sLabels[i])
-    print(sColumns[i])
-    df_genecov[sLabels[i]] = df_genecov[sColumns[i]].sum(axis=1)/(scalingfactor*len(sColumns[i]))
-df_genecov.drop(columns, axis=1, inplace=True)
+labelIndex = dict((sLabels[i], i) for i in range(len(sLabels)))
+labels = list(dict.fromkeys(sLabels))
+labelSamples = [sColumns[labelIndex[x]] for x in labels]
+denominator = np.array([scalingfactor * len(x) for x in labelSamples], dtype=np.float64)
+for i in range(len(labels)):
+    print('GeneCov: ' + labels[i])
+    print(labelSamples[i])
+
+
+def labelMatrix(columns):
+    """
+    Samples x labels matrix over the sample columns 'columns' of one coverage
+    file, counting how often each label lists each sample
+    """
+    colIndex = dict((columns[i], i) for i in range(len(columns)))
+    weights = np.zeros((len(columns), len(labels)))
+    for j in range(len(labels)):
+        cols = np.array([colIndex[c] for c in labelSamples[j] if c in colIndex], dtype=np.int64)
+        np.add.at(weights[:, j], cols, 1)
+    return weights
+
+
+# Label sums of each coverage file, read in chunks of 'chunkRows' genes and only for the sample
+# columns of the linked config, so memory is bounded by the chunk instead of genes x samples.
+# The sums are the product of a chunk with the label matrix; the product's summation order
+# differs from the per-label pandas row sums, so the means may differ in the last bits (about
+# 1e-15 relative).  Several Snaptron compilations are joined on gene ID and their label sums added
+labelSums = []
+found = set()
+for x in genecov:
+    with open_binary(x) as f:
+        header = f.readline().decode().rstrip('\r\n').split('\t')
+    usecols = [header[0]] + [c for c in header[1:] if c in needed]
+    found.update(usecols[1:])
+    weights = labelMatrix(usecols[1:])
+    geneIDs = []
+    chunkSums = []
+    with open_binary(x) as f:
+        for chunk in pd.read_csv(f, sep='\t', usecols=usecols, index_col=0, chunksize=chunkRows,
+                                 dtype=dict((c, np.float64) for c in usecols[1:])):
+            values = chunk.values
+            if np.isnan(values).any():
+                values = np.where(np.isnan(values), 0, values)
+            geneIDs.append(chunk.index.values)
+            chunkSums.append(values @ weights)
+    labelSums.append(pd.DataFrame(np.concatenate(chunkSums), index=np.concatenate(geneIDs)))
+if len(needed - found) > 0:
+    sys.exit('Error: samples ' + ','.join(sorted(needed - found, key=int)) + ' not found in ' + args.gc)
+if len(labelSums) > 1:
+    labelSums = pd.concat(labelSums, axis=1, keys=range(len(labelSums))).fillna(0)
+    geneIDs = labelSums.index
+    sums = labelSums[0].values.copy()
+    for x in range(1, len(labelSums.columns.levels[0])):
+        sums += labelSums[x].values
+else:
+    geneIDs = labelSums[0].index
+    sums = labelSums[0].values
 
-df_genecov[['gene_id', 'gid_version']] = df_genecov['gene_id'].str.split('.', expand=True)
-df_genecov.drop(['gid_version'], axis=1, inplace=True)
-df_genecov['gene_symbol'] = df_genecov['gene_id'].map(geneid2genesymbol)
-col = list(df_genecov.columns.values)
-col.remove('gene_symbol')
-col.insert(1, 'gene_symbol')
-df_genecov = df_genecov[col]
+# Output table: gene ID without version, gene symbol and the label means
+geneIDs = pd.Series(geneIDs).str.split('.').str[0]
+df_genecov = pd.DataFrame(sums / denominator, columns=labels)
+df_genecov.insert(0, 'gene_id', geneIDs.values)
+df_genecov.insert(1, 'gene_symbol', geneIDs.map(geneid2genesymbol).values)
 df_genecov.to_csv(nauc_output, sep='\t', index=False)
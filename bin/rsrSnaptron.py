@@ -0,0 +1,430 @@
+"""
+In-process Snaptron junction query client.
+
+Replaces the 'qs --bulk-query-file' round trip used by rsrBulk.py: queries are
+(region, filters, samples, group) tuples, the same four columns the bulk query
+file carried, and results are parsed straight into a DataFrame laid out like
+qs' '.snap_results.tsv' (a 'Group' column followed by the Snaptron junction
+fields).  Nothing is written to disk and no process is spawned per batch.
+
+Backends:
+  HttpBackend   Snaptron REST server, one keep-alive connection pool per client
+  LocalBackend  Snaptron junction dump(s) on disk, filtered in-process
+  CachedBackend persistent SQLite response cache in front of another backend
+"""
+import hashlib
+import http.client
+import io
+import os
+import queue
+import re
+import socket
+import sqlite3
+import threading
+import time
+import urllib.parse
+import zlib
+
+import numpy as np
+import pandas as pd
+
+from rsrGzip import is_bgzf, is_gzip, open_binary, open_virtual
+
+SNAPTRON_URL = 'http://snaptron.cs.jhu.edu'
+JUNCTION_FIELDS = ['DataSource:Type', 'snaptron_id', 'chromosome', 'start', 'end', 'length', 'strand',
+                   'annotated', 'left_motif', 'right_motif', 'left_annotated', 'right_annotated',
+                   'samples', 'samples_count', 'coverage_sum', 'coverage_avg', 'coverage_median',
+                   'source_dataset_id']
+MAX_GET_LENGTH = 8000  # longer requests (e.g. thousands of sample ids) are sent as POST
+
+
+def _str(x):
+    if isinstance(x, bytes):
+        return x.decode('utf-8')
+    return str(x)
+
+
+def parse_filters(filters):
+    """ Split 'coverage_sum>=10&length<=200000&strand=+' into (field, op, value) """
+    parsed = []
+    for flt in _str(filters).split('&'):
+        if flt == '':
+            continue
+        m = re.match(r'^(\w+)(>=|<=|>|<|=)(.*)$', flt)
+        if m is None:
+            raise RuntimeError('Malformed Snaptron filter: ' + flt)
+        parsed.append(m.groups())
+    return parsed
+
+
+class HttpBackend(object):
+    """
+    Query the Snaptron REST API over a pool of persistent HTTP connections.
+    Safe to share between threads; at most 'connections' requests are open
+    at once.
+    """
+    rfilter_ops = {'>=': '>:', '<=': '<:', '=': ':', '>': '>', '<': '<'}
+
+    def __init__(self, datasrc, url=SNAPTRON_URL, connections=4, timeout=300, retries=3):
+        parsed = urllib.parse.urlsplit(url)
+        self.host = parsed.netloc
+        self.https = parsed.scheme == 'https'
+        self.prefix = parsed.path.rstrip('/')
+        self.datasrc = _str(datasrc).split(',')
+        self.timeout = timeout
+        self.retries = retries
+        self.pool = queue.LifoQueue()
+        for _ in range(connections):
+            self.pool.put(None)
+
+    def _connect(self):
+        if self.https:
+            return http.client.HTTPSConnection(self.host, timeout=self.timeout)
+        return http.client.HTTPConnection(self.host, timeout=self.timeout)
+
+    def _params(self, region, filters, samples):
+        params = [('regions', _str(region))]
+        for field, op, value in parse_filters(filters):
+            params.append(('rfilter', field + self.rfilter_ops[op] + value))
+        samples = _str(samples)
+        if samples != '':
+            params.append(('sids', samples))
+        return urllib.parse.urlencode(params, safe=':,')
+
+    def _request(self, conn, path, params):
+        if len(path) + len(params) + 1 <= MAX_GET_LENGTH:
+            conn.request('GET', path + '?' + params)
+        else:
+            conn.request('POST', path, body=params,
+                         headers={'Content-Type': 'application/x-www-form-urlencoded'})
+        resp = conn.getresponse()
+        body = resp.read()
+        if resp.status != 200:
+            raise RuntimeError('Snaptron query returned HTTP %d: %s' % (resp.status, path))
+        return body.decode('utf-8')
+
+    def query(self, region, filters, samples):
+        """ Return Snaptron junction rows (list of tab-split fields) for one query """
+        params = self._params(region, filters, samples)
+        rows = []
+        conn = self.pool.get()
+        try:
+            for src in self.datasrc:
+                path = self.prefix + '/' + src + '/snaptron'
+                for attempt in range(self.retries):
+                    if conn is None:
+                        conn = self._connect()
+                    try:
+                        body = self._request(conn, path, params)
+                        break
+                    except (http.client.HTTPException, socket.error):
+                        conn.close()
+                        conn = None
+                        if attempt == self.retries - 1:
+                            raise
+                for line in body.splitlines():
+                    if line == '' or line.startswith('DataSource:Type'):
+                        continue
+                    rows.append(line.split('\t'))
+        finally:
+            self.pool.put(conn)
+        return rows
+
+
+class LocalBackend(object):
+    """
+    Answer queries from Snaptron junction files on disk, e.g. the
+    'junctions.bgz' dumps at http://snaptron.cs.jhu.edu/data/<datasrc>/.
+    'path' may contain '{datasrc}', which is filled in with each compilation
+    listed in snaptron_datasrc.  A file is scanned once, on its compilation's
+    first query, into an index of chunks of up to CHUNK_ROWS consecutive
+    junctions of one chromosome, holding only each chunk's file offset, row
+    count and start/end span.  Region queries read back the chunks that
+    overlap them and return the overlapping junctions as the server does, so
+    junction rows are never held in memory beyond the query that needs them.
+    Files are seeked by BGZF virtual offsets or, uncompressed, byte offsets;
+    plain gzip cannot be seeked and has to be recompressed with bgzip.  With a
+    sample list, junctions are restricted to those samples and their summary
+    columns recomputed before filters are applied.
+    """
+    CHUNK_ROWS = 256
+
+    def __init__(self, datasrc, path):
+        self.datasrc = _str(datasrc).split(',')
+        self.paths = dict((src, path.replace('{datasrc}', src)) for src in self.datasrc)
+        self.index = {}  # datasrc -> (BGZF?, chromosome -> (offsets, rows, min start, max end, follows))
+        self.lock = threading.Lock()
+
+    def _chunks(self, src):
+        with self.lock:
+            if src not in self.index:
+                self.index[src] = self._scan(self.paths[src])
+        return self.index[src]
+
+    def _scan(self, fn):
+        """ Chunk index of one junction file """
+        bgzf = is_bgzf(fn)
+        if not bgzf and is_gzip(fn):
+            raise IOError(fn + ' is gzip but not BGZF compressed; recompress it with bgzip to query it')
+        chunks = {}
+        chrom, rows, pos, follows = None, 0, 0, False
+        with open_binary(fn, record_blocks=True) as f:
+            for line in f:
+                fields = line.split(b'\t', 5)
+                if fields[0] in (b'snaptron_id', b'DataSource:Type'):
+                    pos = pos + len(line)
+                    chrom, follows = None, False
+                    continue
+                s = 0 if fields[0].isdigit() else 1  # 1 if already tagged with DataSource:Type
+                st, en = int(fields[2 + s]), int(fields[3 + s])
+                if fields[1 + s] != chrom or rows == self.CHUNK_ROWS:
+                    follows = fields[1 + s] == chrom
+                    chrom, rows = fields[1 + s], 0
+                    chunk = chunks.setdefault(chrom.decode('utf-8'), ([], [], [], [], []))
+                    for x, value in zip(chunk, (pos, 0, st, en, follows)):
+                        x.append(value)
+                rows = rows + 1
+                chunk[1][-1] = rows
+                chunk[2][-1] = min(chunk[2][-1], st)
+                chunk[3][-1] = max(chunk[3][-1], en)
+                pos = pos + len(line)
+            if bgzf:
+                ustarts = np.array(f.raw.block_uoffsets, dtype=np.int64)
+                cstarts = np.array(f.raw.block_coffsets, dtype=np.int64)
+        for chrom, chunk in chunks.items():
+            offsets = np.array(chunk[0], dtype=np.int64)
+            if bgzf:  # uncompressed positions -> virtual offsets
+                block = np.searchsorted(ustarts, offsets, side='right') - 1
+                offsets = (cstarts[block] << 16) | (offsets - ustarts[block])
+            chunks[chrom] = (offsets, np.array(chunk[1], dtype=np.int64), np.array(chunk[2], dtype=np.int64),
+                             np.array(chunk[3], dtype=np.int64), np.array(chunk[4], dtype=bool))
+        return bgzf, chunks
+
+    def _read(self, src, bgzf, offset, nrows):
+        """ nrows junction lines from offset of src's file """
+        if bgzf:
+            f = open_virtual(self.paths[src], int(offset))
+        else:
+            f = open(self.paths[src], 'rb')
+            f.seek(int(offset))
+        with f:
+            return [f.readline().decode('utf-8') for i in range(nrows)]
+
+    @staticmethod
+    def _restrict(row, sids):
+        counts = [x for x in row[12].split(',') if x != '' and x.split(':')[0] in sids]
+        if not counts:
+            return None
+        row = list(row)
+        values = sorted(int(x.split(':')[1]) for x in counts)
+        mid = len(values) // 2
+        row[12] = ',' + ','.join(counts)
+        row[13] = str(len(values))
+        row[14] = str(sum(values))
+        row[15] = str(round(sum(values) / len(values), 3))
+        row[16] = str(values[mid] if len(values) % 2 else (values[mid - 1] + values[mid]) / 2)
+        return row
+
+    def query(self, region, filters, samples):
+        """ Return Snaptron junction rows (list of fields) for one query """
+        chrom, st, en = re.split('[:-]', _str(region))
+        st, en = int(st), int(en)
+        flts = [(JUNCTION_FIELDS.index(field), op, value) for field, op, value in parse_filters(filters)]
+        samples = _str(samples)
+        sids = set(samples.split(',')) if samples != '' else None
+        rows = []
+        for src in self.datasrc:
+            bgzf, chunks = self._chunks(src)
+            if chrom not in chunks:
+                continue
+            offsets, nrows, starts, ends, follows = chunks[chrom]
+            hit = np.flatnonzero((starts <= en) & (ends >= st))
+            # Chunks that follow each other in the file are read in one go
+            for run in np.split(hit, np.flatnonzero((np.diff(hit) != 1) | ~follows[hit[1:]]) + 1):
+                if len(run) == 0:
+                    continue
+                for line in self._read(src, bgzf, offsets[run[0]], int(nrows[run].sum())):
+                    fields = line.rstrip('\n').split('\t')
+                    if not fields[0].isdigit():  # already tagged with DataSource:Type
+                        fields = fields[1:]
+                    row = [src + ':I'] + fields
+                    if int(row[3]) > en or int(row[4]) < st:
+                        continue
+                    if sids is not None:
+                        row = self._restrict(row, sids)
+                        if row is None:
+                            continue
+                    if all(self._match(row[ix], op, value) for ix, op, value in flts):
+                        rows.append(row)
+        return rows
+
+    @staticmethod
+    def _match(x, op, value):
+        if op == '=':
+            return x == value
+        x, value = float(x), float(value)
+        if op == '>=':
+            return x >= value
+        if op == '<=':
+            return x <= value
+        if op == '>':
+            return x > value
+        return x < value
+
+
+class CachedBackend(object):
+    """
+    Persistent response cache in front of another backend, stored in a single
+    SQLite file so it can be reused across runs and exon lists.  Responses
+    are content-addressed by (source, datasrc, region, filters, sample set);
+    filters and sample ids are normalized so that equivalent queries share an
+    entry.  Entries are zlib-compressed; once the cache grows past 'max_size'
+    bytes the least recently used entries are evicted.  Hits only read the
+    database: their use times are kept in memory and written in one
+    transaction by flush() (after every bulk query), before an eviction and
+    on close().
+    """
+    def __init__(self, backend, path, source, max_size=2 * 1024 ** 3):
+        self.backend = backend
+        self.source = source
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.used = {}  # key -> last use of entries hit since the last flush
+        self.lock = threading.Lock()
+        if os.path.dirname(path) != '' and not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS responses '
+                        '(key TEXT PRIMARY KEY, size INTEGER, used REAL, data BLOB)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS responses_used ON responses (used)')
+        self.db.commit()
+        self.size = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    def key(self, region, filters, samples):
+        samples = _str(samples)
+        sids = sorted(set(samples.split(','))) if samples != '' else []
+        parts = [self.source, ','.join(self.backend.datasrc), _str(region),
+                 '&'.join(sorted(f + op + v for f, op, v in parse_filters(filters))),
+                 ','.join(sids)]
+        return hashlib.sha256('\t'.join(parts).encode('utf-8')).hexdigest()
+
+    def query(self, region, filters, samples):
+        key = self.key(region, filters, samples)
+        with self.lock:
+            row = self.db.execute('SELECT data FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is not None:
+                self.hits += 1
+                self.used[key] = time.time()
+        if row is not None:
+            text = zlib.decompress(row[0]).decode('utf-8')
+            return [line.split('\t') for line in text.split('\n') if line != '']
+        rows = self.backend.query(region, filters, samples)
+        data = zlib.compress('\n'.join('\t'.join(r) for r in rows).encode('utf-8'))
+        with self.lock:
+            self.misses += 1
+            old = self.db.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+            self.size += len(data) - (old[0] if old is not None else 0)
+            self.db.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)',
+                            (key, len(data), time.time(), data))
+            if self.size > self.max_size:
+                self._evict()
+            self.db.commit()
+        return rows
+
+    def _write_used(self):
+        self.db.executemany('UPDATE responses SET used = ? WHERE key = ?',
+                            [(used, key) for key, used in self.used.items()])
+        self.used = {}
+
+    def flush(self):
+        """ Write the use times of the entries hit since the last flush """
+        with self.lock:
+            if self.used:
+                self._write_used()
+                self.db.commit()
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+    def _evict(self):
+        """ Drop least recently used entries until the cache is back under 90% of max_size """
+        self._write_used()
+        target = self.max_size * 0.9
+        cur = self.db.execute('SELECT key, size FROM responses ORDER BY used')
+        drop = []
+        for key, size in cur:
+            if self.size <= target:
+                break
+            drop.append((key,))
+            self.size -= size
+        cur.close()
+        self.db.executemany('DELETE FROM responses WHERE key = ?', drop)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return ('Snaptron cache: %d hits, %d misses (%.1f%% hit rate), %.1f MB stored'
+                % (self.hits, self.misses, 100.0 * self.hits / total if total else 0.0,
+                   self.size / 1024.0 ** 2))
+
+
+class SnaptronClient(object):
+    """ Run bulk junction queries against a backend and parse them into DataFrames """
+    def __init__(self, backend):
+        self.backend = backend
+
+    def query(self, region, filters, samples):
+        return self.backend.query(region, filters, samples)
+
+    def stats(self):
+        """ Cache hit/miss summary, or None if responses aren't cached """
+        if isinstance(self.backend, CachedBackend):
+            return self.backend.stats()
+        return None
+
+    def close(self):
+        """ Write pending cache use times and close the cache """
+        if isinstance(self.backend, CachedBackend):
+            self.backend.close()
+
+    def bulk_query(self, queries, keep=None):
+        """
+        queries: iterable of (region, filters, samples, group)
+        keep: optional (query_fn, result_fn) pair; the bulk query and its
+              responses are also written there in qs' file formats
+        Returns a DataFrame with a 'Group' column, one row per junction.
+        """
+        out = io.StringIO()
+        out.write('\t'.join(['Group'] + JUNCTION_FIELDS) + '\n')
+        queries = list(queries)
+        for region, filters, samples, group in queries:
+            group = _str(group)
+            for row in self.query(region, filters, samples):
+                out.write(group + '\t' + '\t'.join(row) + '\n')
+        if isinstance(self.backend, CachedBackend):
+            self.backend.flush()
+        if keep is not None:
+            with open(keep[0], 'w') as f:
+                f.write('\t'.join(['region', 'filters', 'samples', 'group']) + '\n')
+                for q in queries:
+                    f.write('\t'.join(_str(x) for x in q) + '\n')
+            with open(keep[1], 'w') as f:
+                f.write(out.getvalue())
+        out.seek(0)
+        return pd.read_csv(out, sep='\t')
+
+
+def make_client(datasrc, junctions=None, url=SNAPTRON_URL, connections=4, cache=None,
+                cache_size=2 * 1024 ** 3):
+    """
+    LocalBackend if a junction file is given, otherwise the Snaptron server.
+    Server responses are cached in the SQLite file 'cache' if one is given.
+    """
+    if junctions is not None:
+        return SnaptronClient(LocalBackend(datasrc, junctions))
+    backend = HttpBackend(datasrc, url=url, connections=connections)
+    if cache is not None:
+        backend = CachedBackend(backend, cache, url, max_size=cache_size)
+    return SnaptronClient(backend)
@@ -0,0 +1,144 @@
+"""
+Binary columnar store for per-sample PSI and junction count matrices.
+
+A store is a directory holding one raw C-order matrix per metric
+('<metric>.bin', exons x samples), the row index ('exon_ids.txt', one exon ID
+per line) and 'store.json' with the column count and each metric's dtype.
+Rows are appended as exons are processed.  Readers open the matrices with
+np.memmap, so no stage parses numbers back out of text and only the pages
+that are touched are read.
+"""
+import json
+import os
+
+import numpy as np
+
+# Metrics rsrBulk reports for every exon
+BULK_METRICS = [('LeftPSI', 'float64'), ('RightPSI', 'float64'), ('AvgPSI', 'float64'),
+                ('LeftJunctionCount', 'int64'), ('RightJunctionCount', 'int64'),
+                ('TotalJunctionCount', 'int64')]
+
+
+def psi_str(values):
+    """ Comma-joined PSI values, formatted as pandas' to_csv formats floats """
+    return ','.join(repr(x) for x in values.tolist())
+
+
+def jc_str(values):
+    """ Comma-joined junction counts """
+    return ','.join(str(x) for x in values.tolist())
+
+
+class StoreWriter(object):
+    """
+    Create a store at 'path' and append rows to it.  With append=True the rows
+    of an existing store at 'path' are kept and new rows added after them.
+    """
+    def __init__(self, path, columns, metrics=BULK_METRICS, append=False):
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self.path = path
+        self.columns = columns
+        self.metrics = metrics
+        with open(os.path.join(path, 'store.json'), 'w') as f:
+            json.dump({'columns': columns, 'metrics': metrics}, f)
+        mode = 'a' if append else 'w'
+        self.files = dict((metric, open(self.filename(metric), mode + 'b')) for metric, _ in metrics)
+        self.ids = open(self.filename(), mode)
+
+    def filename(self, metric=None):
+        """ Matrix file of 'metric', or the row index file """
+        if metric is None:
+            return os.path.join(self.path, 'exon_ids.txt')
+        return os.path.join(self.path, metric + '.bin')
+
+    def filenames(self):
+        return [self.filename(metric) for metric, _ in self.metrics] + [self.filename()]
+
+    def append(self, exon_id, values):
+        """ values: metric -> row of 'columns' values """
+        for metric, dtype in self.metrics:
+            row = np.ascontiguousarray(values[metric], dtype=dtype)
+            assert row.shape == (self.columns,)
+            self.files[metric].write(row.tobytes())
+        self.ids.write(exon_id + '\n')  # last, so a row is only indexed once all its matrices hold it
+
+    def append_rows(self, exon_ids, values):
+        """ Several rows at once; values: metric -> (rows x 'columns') matrix """
+        for metric, dtype in self.metrics:
+            rows = np.ascontiguousarray(values[metric], dtype=dtype)
+            assert rows.shape == (len(exon_ids), self.columns)
+            self.files[metric].write(rows.tobytes())
+        self.ids.write(''.join(exon_id + '\n' for exon_id in exon_ids))
+
+    def flush(self):
+        for f in self.files.values():
+            f.flush()
+        self.ids.flush()
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        self.ids.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class PSIStore(object):
+    """ Read-only, memory-mapped view of a store """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'store.json'), 'r') as f:
+            meta = json.load(f)
+        self.columns = meta['columns']
+        self.metrics = dict(meta['metrics'])
+        with open(os.path.join(path, 'exon_ids.txt'), 'r') as f:
+            self.exon_ids = [line.rstrip('\n') for line in f]
+        self.index = dict((exon_id, i) for i, exon_id in enumerate(self.exon_ids))
+        self.matrices = {}
+
+    def __len__(self):
+        return len(self.exon_ids)
+
+    def __contains__(self, exon_id):
+        return exon_id in self.index
+
+    def matrix(self, metric):
+        """ exons x samples matrix of 'metric', rows in exon_ids order """
+        if metric not in self.matrices:
+            dtype = np.dtype(self.metrics[metric])
+            if len(self.exon_ids) == 0:
+                self.matrices[metric] = np.zeros((0, self.columns), dtype=dtype)
+            else:
+                self.matrices[metric] = np.memmap(os.path.join(self.path, metric + '.bin'), dtype=dtype,
+                                                  mode='r', shape=(len(self.exon_ids), self.columns))
+        return self.matrices[metric]
+
+    def row(self, metric, exon_id):
+        return self.matrix(metric)[self.index[exon_id]]
+
+
+class PSIStrings(object):
+    """
+    Read-only exon ID -> comma-joined PSI string mapping over one metric of a
+    store, for code written against the old LPSI/RPSI string dictionaries.
+    Strings are formatted from the memory-mapped row on lookup.
+    """
+    def __init__(self, store, metric):
+        self.store = store
+        self.metric = metric
+
+    def __getitem__(self, exon_id):
+        return psi_str(self.store.row(self.metric, exon_id))
+
+    def lookup(self, exon_ids):
+        """ Strings of several exons, gathered from the matrix in one read """
+        rows = [self.store.index[exon_id] for exon_id in exon_ids]
+        return [psi_str(row) for row in self.store.matrix(self.metric)[rows]]
+
+    def __contains__(self, exon_id):
+        return exon_id in self.store